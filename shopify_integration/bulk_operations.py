@@ -0,0 +1,355 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import TYPE_CHECKING, Dict, Iterator, Optional, TextIO
+from urllib.request import urlopen
+
+from shopify import Image, Option, Product, Variant
+
+import frappe
+from frappe import _
+from frappe.utils import cint, now_datetime
+
+from shopify_integration.products import (
+	SHOPIFY_VARIANTS_ATTR_LIST,
+	sync_failed_products,
+	sync_in_batches,
+	sync_product,
+	update_product_sync_datetime,
+)
+from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
+	make_shopify_log,
+)
+from shopify_integration.utils import get_shopify_datetime
+
+if TYPE_CHECKING:
+	from shopify_integration.shopify_integration.doctype.shopify_settings.shopify_settings import (
+		ShopifySettings,
+	)
+
+# ref: https://shopify.dev/docs/api/usage/bulk-operations/queries
+BULK_PRODUCTS_QUERY = """
+{
+	products(query: "%(search)s") {
+		edges {
+			node {
+				id
+				title
+				descriptionHtml
+				productType
+				vendor
+				status
+				updatedAt
+				options {
+					name
+					values
+				}
+				featuredImage {
+					url
+				}
+				variants {
+					edges {
+						node {
+							id
+							title
+							sku
+							price
+							weight
+							weightUnit
+							selectedOptions {
+								name
+								value
+							}
+						}
+					}
+				}
+			}
+		}
+	}
+}
+"""
+
+BULK_OPERATION_RUN_MUTATION = """
+mutation bulkOperationRunQuery($query: String!) {
+	bulkOperationRunQuery(query: $query) {
+		bulkOperation {
+			id
+			status
+		}
+		userErrors {
+			field
+			message
+		}
+	}
+}
+"""
+
+CURRENT_BULK_OPERATION_QUERY = """
+{
+	currentBulkOperation {
+		id
+		status
+		errorCode
+		objectCount
+		url
+	}
+}
+"""
+
+BULK_OPERATION_POLL_SECONDS = 10
+BULK_OPERATION_TIMEOUT_SECONDS = 2 * 60 * 60
+
+# GraphQL returns enum values for weight units, while the REST API
+# returns the abbreviations that are mapped in `products.WEIGHT_UOM_MAP`
+GRAPHQL_WEIGHT_UNIT_MAP = {
+	"GRAMS": "g",
+	"KILOGRAMS": "kg",
+	"OUNCES": "oz",
+	"POUNDS": "lb",
+}
+
+
+def sync_items_from_bulk_operation(shop_name: str, incremental: bool = False):
+	"""
+	For a given Shopify store, sync all active products and their variants through
+	a GraphQL bulk operation, instead of paging through the REST API.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param incremental: (optional) Only sync products changed since the last sync,
+		defaults to False
+	"""
+
+	frappe.set_user("Administrator")
+	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
+
+	# products changed while the sync is running are picked up by the next sync
+	sync_started_at = now_datetime()
+	updated_at_min = None
+	if incremental and shopify_settings.last_product_sync_datetime:
+		updated_at_min = shopify_settings.last_product_sync_datetime
+
+	try:
+		if updated_at_min:
+			sync_failed_products(shop_name)
+
+		result_url = run_bulk_operation(
+			shopify_settings, get_bulk_products_query(updated_at_min)
+		)
+	except Exception as e:
+		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
+		return
+
+	# bulk operations without any results don't return a file
+	if not result_url:
+		update_product_sync_datetime(shop_name, sync_started_at)
+		return
+
+	# products that fail to sync are rolled back and logged individually, so
+	# only errors in the result file itself end the sync here
+	file_path = None
+	try:
+		file_path = download_bulk_operation_result(result_url)
+		with open(file_path) as result_file:
+			sync_in_batches(
+				shopify_settings,
+				iter_bulk_products(result_file),
+				lambda product: sync_product(
+					shopify_settings, product, update=bool(updated_at_min), commit=False
+				),
+			)
+	except Exception as e:
+		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
+		return
+	finally:
+		if file_path and os.path.exists(file_path):
+			os.remove(file_path)
+
+	# failed items are synced again by the next sync, so they
+	# don't hold back the watermark
+	update_product_sync_datetime(shop_name, sync_started_at)
+
+
+def get_bulk_products_query(updated_at_min: Optional[str] = None) -> str:
+	"""
+	Build the bulk query for active products.
+
+	:param updated_at_min: (optional) Only include products changed after this time
+	:return: The GraphQL query for the bulk operation
+	"""
+
+	search = "status:active"
+	if updated_at_min:
+		search += f" AND updated_at:>'{get_shopify_datetime(updated_at_min)}'"
+
+	return BULK_PRODUCTS_QUERY % {"search": search}
+
+
+def run_bulk_operation(
+	shopify_settings: "ShopifySettings", query: str
+) -> Optional[str]:
+	"""
+	Submit a bulk query to Shopify and wait for it to finish.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param query: The GraphQL query to run as a bulk operation
+	:return: The URL of the JSONL result file, if the operation returned any objects
+	"""
+
+	response = shopify_settings.execute_graphql(
+		BULK_OPERATION_RUN_MUTATION, variables={"query": query}
+	)
+
+	result = response.get("bulkOperationRunQuery") or {}
+	user_errors = result.get("userErrors")
+	if user_errors:
+		frappe.throw(
+			_("Shopify bulk operation could not be started: {0}").format(
+				", ".join(error.get("message") for error in user_errors)
+			)
+		)
+
+	started_at = time.monotonic()
+	while time.monotonic() - started_at < BULK_OPERATION_TIMEOUT_SECONDS:
+		time.sleep(BULK_OPERATION_POLL_SECONDS)
+
+		response = shopify_settings.execute_graphql(CURRENT_BULK_OPERATION_QUERY)
+		operation = response.get("currentBulkOperation") or {}
+		status = operation.get("status")
+
+		if status == "COMPLETED":
+			return operation.get("url")
+
+		if status in ("FAILED", "CANCELED", "EXPIRED"):
+			frappe.throw(
+				_("Shopify bulk operation {0} ended with status {1} ({2})").format(
+					operation.get("id"), status, operation.get("errorCode")
+				)
+			)
+
+	frappe.throw(_("Timed out waiting for the Shopify bulk operation to finish"))
+
+
+def download_bulk_operation_result(url: str) -> str:
+	"""
+	Download a bulk operation's JSONL result into a temporary file. The file is
+	streamed to disk, so it is never fully loaded into memory.
+
+	:param url: The URL of the JSONL result file
+	:return: The path of the downloaded file
+	"""
+
+	with urlopen(url) as response, tempfile.NamedTemporaryFile(
+		mode="wb", suffix=".jsonl", delete=False
+	) as result_file:
+		shutil.copyfileobj(response, result_file)
+
+	return result_file.name
+
+
+def iter_bulk_products(result_file: TextIO) -> Iterator[Product]:
+	"""
+	Parse a bulk operation's JSONL result file line by line, and yield Shopify
+	products along with their variants.
+
+	Bulk operations flatten nested connections into separate lines, where child
+	objects follow their parent and reference it through `__parentId`. Only the
+	current product and its variants are kept in memory at any time.
+
+	:param result_file: The JSONL result file, opened in text mode
+	:return: A generator of Shopify products, in the REST API's format
+	"""
+
+	product: Optional[Product] = None
+
+	for line in result_file:
+		line = line.strip()
+		if not line:
+			continue
+
+		data: Dict = json.loads(line)
+		parent_id = data.get("__parentId")
+
+		if not parent_id:
+			if product:
+				yield product
+			product = make_bulk_product(data)
+		elif product and get_legacy_id(parent_id) == product.id:
+			product.attributes["variants"].append(make_bulk_variant(data, product))
+
+	if product:
+		yield product
+
+
+def make_bulk_product(data: Dict) -> Product:
+	"Convert a product line from a bulk operation into a Shopify `Product`"
+
+	options = []
+	for option_data in data.get("options") or []:
+		option = Option()
+		option.attributes.update(
+			{"name": option_data.get("name"), "values": option_data.get("values") or []}
+		)
+		options.append(option)
+
+	image = None
+	if data.get("featuredImage"):
+		image = Image()
+		image.attributes.update({"src": data.get("featuredImage").get("url")})
+
+	product = Product()
+	product.attributes.update(
+		{
+			"id": get_legacy_id(data.get("id")),
+			"title": data.get("title"),
+			"body_html": data.get("descriptionHtml"),
+			"product_type": data.get("productType"),
+			"vendor": data.get("vendor"),
+			"status": (data.get("status") or "").lower(),
+			"updated_at": data.get("updatedAt"),
+			"options": options,
+			"image": image,
+			"variants": [],
+		}
+	)
+	return product
+
+
+def make_bulk_variant(data: Dict, product: Product) -> Variant:
+	"Convert a variant line from a bulk operation into a Shopify `Variant`"
+
+	# nested variants from the REST API carry their parent product ID in
+	# the prefix options, instead of their attributes
+	variant = Variant(prefix_options={"product_id": product.id})
+	variant.attributes.update(
+		{
+			"id": get_legacy_id(data.get("id")),
+			"title": data.get("title"),
+			"sku": data.get("sku"),
+			"price": data.get("price"),
+			"weight": data.get("weight"),
+			"weight_unit": GRAPHQL_WEIGHT_UNIT_MAP.get(data.get("weightUnit")),
+		}
+	)
+
+	# map selected options to the positional option fields from the REST API
+	option_names = [
+		option.attributes.get("name") for option in product.attributes.get("options")
+	]
+	for selected_option in data.get("selectedOptions") or []:
+		if selected_option.get("name") not in option_names:
+			continue
+
+		index = option_names.index(selected_option.get("name"))
+		if index < len(SHOPIFY_VARIANTS_ATTR_LIST):
+			option_field = SHOPIFY_VARIANTS_ATTR_LIST[index]
+			variant.attributes[option_field] = selected_option.get("value")
+
+	return variant
+
+
+def get_legacy_id(gid: str) -> int:
+	"Convert a GraphQL global ID, like 'gid://shopify/Product/123', into a REST ID"
+
+	return cint((gid or "").rsplit("/", 1)[-1])
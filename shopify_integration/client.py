@@ -0,0 +1,245 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from pyactiveresource.connection import ClientError, ServerError
+from shopify.base import ShopifyResource
+
+import frappe
+
+# ref: https://shopify.dev/docs/api/usage/rate-limits#rest-admin-api-rate-limits
+# the response header is formatted as "<used>/<bucket size>", for example "32/40"
+CALL_LIMIT_HEADER = "X-Shopify-Shop-Api-Call-Limit"
+
+# standard plans use a bucket of 40 requests, leaking 2 requests per second;
+# Shopify Plus stores have larger buckets that leak proportionally faster
+DEFAULT_BUCKET_SIZE = 40
+BUCKET_LEAK_SECONDS = 20
+
+# keep some headroom in the bucket for other apps and webhook handlers
+BUCKET_THRESHOLD = 0.8
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+
+# the bucket is shared by all workers syncing a store, through Redis
+BUCKET_KEY = "shopify_api_bucket|{0}"
+STATS_KEY = "shopify_api_stats|{0}"
+STATS_FIELDS = ("requests", "throttles", "retries")
+
+# atomically leak the shared bucket, reserve a request in it, and return the
+# delay before the request can be made; floats are returned as strings, since
+# Redis truncates numbers returned from scripts into integers
+RESERVE_REQUEST_SCRIPT = """
+local now = tonumber(ARGV[1])
+local size = tonumber(redis.call("hget", KEYS[1], "size") or ARGV[2])
+local level = tonumber(redis.call("hget", KEYS[1], "level") or 0)
+local updated = tonumber(redis.call("hget", KEYS[1], "updated") or now)
+local leak_rate = size / tonumber(ARGV[3])
+
+level = math.max(level - math.max(now - updated, 0) * leak_rate, 0)
+local delay = (level + 1 - size * tonumber(ARGV[4])) / leak_rate
+
+redis.call("hset", KEYS[1], "size", size, "level", level + 1, "updated", now)
+redis.call("expire", KEYS[1], ARGV[3])
+return tostring(delay)
+"""
+
+_clients: Dict[str, "ShopifyAPIClient"] = {}
+_clients_lock = threading.Lock()
+
+
+class ShopifyAPIClient:
+	"""
+	Pace and retry requests to Shopify's REST Admin API for a single store.
+
+	The client mirrors Shopify's leaky bucket in Redis, using the call limit
+	header from every response, and waits before a request would overflow the
+	bucket. Since the bucket is shared, parallel workers syncing the same store
+	pace their requests together. Throttled (429) and server (5xx) responses
+	are retried with jittered exponential backoff, honoring the `Retry-After`
+	header.
+
+	Request counters are kept for the current process in `stats`, and for
+	all processes in Redis.
+	"""
+
+	def __init__(self, shop_name: str):
+		self.shop_name = shop_name
+		self.stats = frappe._dict(requests=0, throttles=0, retries=0)
+
+	@property
+	def bucket_key(self) -> str:
+		return frappe.cache().make_key(BUCKET_KEY.format(self.shop_name))
+
+	def request(self, method: Callable, *args, **kwargs):
+		"""
+		Call a Shopify resource method, such as `Product.find`, within the rate
+		limits for the store.
+
+		:param method: The Shopify resource method to call
+		:return: The return value of the method
+		"""
+
+		attempt = 0
+		while True:
+			self.wait()
+			self.increment_stat("requests")
+
+			try:
+				response = method(*args, **kwargs)
+			except (ClientError, ServerError) as e:
+				if not is_retryable_error(e) or attempt >= MAX_RETRIES:
+					raise
+
+				if e.code == 429:
+					self.increment_stat("throttles")
+					# Shopify considers the bucket full until it leaks again
+					self.set_bucket_level(self.get_bucket_size())
+
+				self.increment_stat("retries")
+				time.sleep(get_backoff_delay(attempt, get_retry_after(e)))
+				attempt += 1
+			else:
+				self.update_bucket()
+				return response
+
+	def wait(self):
+		"Block until the shared bucket has room for another request"
+
+		delay = float(
+			frappe.cache().eval(
+				RESERVE_REQUEST_SCRIPT,
+				1,
+				self.bucket_key,
+				time.time(),
+				DEFAULT_BUCKET_SIZE,
+				BUCKET_LEAK_SECONDS,
+				BUCKET_THRESHOLD,
+			)
+		)
+
+		if delay > 0:
+			time.sleep(delay)
+
+	def get_bucket_size(self) -> int:
+		size = frappe.cache().hmget(self.bucket_key, ["size"])[0]
+		return int(float(size)) if size else DEFAULT_BUCKET_SIZE
+
+	def set_bucket_level(self, level: float, size: Optional[int] = None):
+		mapping = {"level": level, "updated": time.time()}
+		if size:
+			mapping["size"] = size
+
+		cache = frappe.cache()
+		pipeline = cache.pipeline()
+		pipeline.hset(self.bucket_key, mapping=mapping)
+		pipeline.expire(self.bucket_key, BUCKET_LEAK_SECONDS)
+		pipeline.execute()
+
+	def increment_stat(self, stat: str):
+		self.stats[stat] += 1
+		frappe.cache().hincrby(
+			frappe.cache().make_key(STATS_KEY.format(self.shop_name)), stat, 1
+		)
+
+	def update_bucket(self):
+		"Sync the shared bucket with the call limit header from the last response"
+
+		call_limit = get_call_limit(ShopifyResource.connection.response)
+		if call_limit:
+			used, size = call_limit
+			self.set_bucket_level(used, size)
+
+
+def get_api_client(shop_name: str) -> ShopifyAPIClient:
+	"""
+	Get the shared API client for a Shopify store in the current process.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:return: The API client for the store
+	"""
+
+	with _clients_lock:
+		if shop_name not in _clients:
+			_clients[shop_name] = ShopifyAPIClient(shop_name)
+		return _clients[shop_name]
+
+
+def get_api_stats(shop_name: Optional[str] = None) -> Dict:
+	"""
+	Get the request, throttle and retry counters for Shopify stores, across
+	all processes.
+
+	:param shop_name: (optional) The name of the Shopify configuration for the
+		store; if not set, counters for all stores are returned
+	:return: A map of store names to their counters
+	"""
+
+	shop_names = (
+		[shop_name] if shop_name else frappe.get_all("Shopify Settings", pluck="name")
+	)
+
+	cache = frappe.cache()
+	stats = {}
+	for name in shop_names:
+		values = cache.hmget(cache.make_key(STATS_KEY.format(name)), STATS_FIELDS)
+		stats[name] = {
+			field: int(value or 0) for field, value in zip(STATS_FIELDS, values)
+		}
+
+	return stats
+
+
+def get_call_limit(response) -> Optional[tuple]:
+	headers = getattr(response, "headers", None) or {}
+
+	# header names are case-insensitive
+	call_limit = None
+	for header, value in headers.items():
+		if header.lower() == CALL_LIMIT_HEADER.lower():
+			call_limit = value
+			break
+
+	if not call_limit:
+		return
+
+	try:
+		used, size = call_limit.split("/")
+		return int(used), int(size)
+	except ValueError:
+		return
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+	response = getattr(error, "response", None)
+	headers = getattr(response, "headers", None) or {}
+
+	for header, value in headers.items():
+		if header.lower() == "retry-after":
+			try:
+				return float(value)
+			except (TypeError, ValueError):
+				return
+
+	return
+
+
+def get_backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+	if retry_after:
+		# Shopify tells us exactly when to retry; add a little jitter so that
+		# parallel workers don't all retry at the same time
+		return retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+
+	# exponential backoff with full jitter
+	return random.uniform(
+		0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+	)
+
+
+def is_retryable_error(error: Exception) -> bool:
+	if isinstance(error, ServerError):
+		return True
+	return getattr(error, "code", None) == 429
@@ -1,20 +1,25 @@
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 import frappe
 from frappe import _
 from frappe.utils import cstr, validate_phone_number
 
+from shopify_integration.utils import get_shopify_settings
+
 if TYPE_CHECKING:
 	from erpnext.selling.doctype.customer.customer import Customer
 	from shopify import Address, Customer as ShopifyCustomer, Order
 
 
-def validate_customer(shop_name: str, shopify_order: "Order"):
+def validate_customer(shop_name: str, shopify_order: "Order") -> Optional[str]:
 	customer = shopify_order.attributes.get("customer", frappe._dict())
-	if customer.id and not frappe.db.get_value(
+	if not customer.id:
+		return None
+
+	existing_customer = frappe.db.get_value(
 		"Customer", {"shopify_customer_id": customer.id}, "name"
-	):
-		create_customer(shop_name, customer)
+	)
+	return existing_customer or create_customer(shop_name, customer)
 
 
 def create_customer(shop_name: str, shopify_customer: "ShopifyCustomer"):
@@ -34,9 +39,7 @@ def create_customer(shop_name: str, shopify_customer: "ShopifyCustomer"):
 				"name": shopify_customer.id,
 				"customer_name": cust_name,
 				"shopify_customer_id": shopify_customer.id,
-				"customer_group": frappe.db.get_value(
-					"Shopify Settings", shop_name, "customer_group"
-				),
+				"customer_group": get_shopify_settings(shop_name).customer_group,
 				"territory": get_root_of("Territory"),
 				"customer_type": _("Individual"),
 				"exempt_from_sales_tax": shopify_customer.attributes.get("tax_exempt"),
@@ -53,6 +56,8 @@ def create_customer(shop_name: str, shopify_customer: "ShopifyCustomer"):
 	except Exception as e:
 		raise e
 
+	return customer.name
+
 
 def create_customer_address(customer: "Customer", shopify_customer: "ShopifyCustomer"):
 	addresses = shopify_customer.attributes.get("addresses") or []
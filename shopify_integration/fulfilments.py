@@ -1,20 +1,18 @@
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Optional
 
 import frappe
 from erpnext.selling.doctype.sales_order.sales_order import make_delivery_note
 from frappe.utils import cint, getdate
 
-from shopify_integration.orders import get_shopify_order
-from shopify_integration.products import get_item_code
-from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import make_shopify_log
-from shopify_integration.utils import get_shopify_document
+from shopify_integration.orders import ShopifyOrderContext, get_shopify_order
+from shopify_integration.products import get_item_codes
+from shopify_integration.utils import get_shopify_document, get_shopify_settings
 
 if TYPE_CHECKING:
 	from erpnext.selling.doctype.sales_order.sales_order import SalesOrder
 	from erpnext.stock.doctype.delivery_note.delivery_note import DeliveryNote
 	from erpnext.stock.doctype.delivery_note_item.delivery_note_item import DeliveryNoteItem
 	from shopify import Fulfillment, LineItem, Order
-	from shopify_integration.shopify_integration.doctype.shopify_settings.shopify_settings import ShopifySettings
 
 
 def prepare_delivery_note(shop_name: str, order_id: str, log_id: str = str()):
@@ -43,7 +41,8 @@ def create_shopify_delivery(
 	shopify_order: "Order",
 	sales_order: "SalesOrder" = None,
 	log_id: str = str(),
-	rollback: bool = False
+	rollback: bool = False,
+	context: Optional[ShopifyOrderContext] = None
 ):
 	"""
 	Create Delivery Note documents for each Shopify delivery.
@@ -56,6 +55,9 @@ def create_shopify_delivery(
 		log_id (str, optional): The ID of an existing Shopify Log. Defaults to an empty string.
 		rollback (bool, optional): If an error occurs while processing the order, all
 			transactions will be rolled back, if this field is `True`. Defaults to False.
+		context (ShopifyOrderContext, optional): The processing context for the
+			order. If set, the result is recorded on the context instead of being
+			logged.
 
 	Returns:
 		list: The list of created Delivery Note documents, if any, otherwise an empty list.
@@ -68,21 +70,33 @@ def create_shopify_delivery(
 	if not sales_order or sales_order.docstatus != 1:
 		return []
 
-	frappe.flags.log_id = log_id
+	own_context = not context
+	if own_context:
+		context = ShopifyOrderContext(shop_name, shopify_order, log_id)
+
+	delivery_notes = []
 	try:
-		delivery_notes = create_delivery_notes(shop_name, shopify_order, sales_order)
+		delivery_notes = create_delivery_notes(
+			shop_name, shopify_order, sales_order, context=context
+		)
 	except Exception as e:
-		make_shopify_log(shop_name, status="Error", response_data=shopify_order.to_dict(), exception=e, rollback=rollback)
-		return []
+		if rollback:
+			frappe.db.rollback()
+		context.add_result("Delivery Note", "Error", exception=e)
 	else:
-		make_shopify_log(shop_name, status="Success", response_data=shopify_order.to_dict())
-		return delivery_notes
+		context.add_result("Delivery Note", "Success")
+
+	if own_context:
+		context.make_log()
+
+	return delivery_notes
 
 
 def create_delivery_notes(
 	shop_name: str,
 	shopify_order: "Order",
-	sales_order: "SalesOrder"
+	sales_order: "SalesOrder",
+	context: Optional[ShopifyOrderContext] = None
 ) -> List["DeliveryNote"]:
 	"""
 	Helper function to create Delivery Note documents for a Shopify order.
@@ -91,12 +105,17 @@ def create_delivery_notes(
 		shop_name (str): The name of the Shopify configuration for the store.
 		shopify_order (Order): The Shopify order data.
 		sales_order (SalesOrder): The reference Sales Order document for the Shopify order.
+		context (ShopifyOrderContext, optional): The processing context for the order.
 
 	Returns:
 		list: The list of created Delivery Note documents, if any, otherwise an empty list.
 	"""
 
-	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
+	if context:
+		shopify_settings = context.settings
+	else:
+		shopify_settings = get_shopify_settings(shop_name)
+
 	if not cint(shopify_settings.sync_delivery_note):
 		return []
 
@@ -122,7 +141,9 @@ def create_delivery_notes(
 				"naming_series": shopify_settings.delivery_note_series or "DN-Shopify-",
 			})
 
-			update_fulfillment_items(dn.items, fulfillment.attributes.get("line_items"))
+			update_fulfillment_items(
+				dn.items, fulfillment.attributes.get("line_items"), shop_name, context
+			)
 
 			dn.flags.ignore_mandatory = True
 			dn.save()
@@ -135,11 +156,21 @@ def create_delivery_notes(
 
 def update_fulfillment_items(
 	dn_items: List["DeliveryNoteItem"],
-	fulfillment_items: List["LineItem"]
+	fulfillment_items: List["LineItem"],
+	shop_name: str = str(),
+	context: Optional[ShopifyOrderContext] = None
 ):
+	# resolve the item codes for all fulfillment items once, instead of
+	# once for every delivery item; fulfillment items share their IDs with
+	# the order's line items, so their codes may already be resolved
+	if context:
+		item_codes = context.get_item_codes(fulfillment_items)
+	else:
+		item_codes = get_item_codes(fulfillment_items, shop_name)
+
 	for dn_item in dn_items:
 		# TODO: figure out a better way to add items without setting valuation rate to zero
 		dn_item.allow_zero_valuation_rate = True
-		for item in fulfillment_items:
-			if get_item_code(item) == dn_item.item_code:
+		for item, item_code in zip(fulfillment_items, item_codes):
+			if item_code == dn_item.item_code:
 				dn_item.qty = item.attributes.get("quantity")
@@ -2,6 +2,12 @@ from typing import TYPE_CHECKING
 from urllib.parse import urljoin
 
 import frappe
+from frappe.utils.password import get_decrypted_password
+
+from shopify_integration.webhooks import (
+	clear_webhook_signing_keys,
+	store_previous_webhook_secret,
+)
 
 if TYPE_CHECKING:
 	from frappe.integrations.doctype.connected_app.connected_app import ConnectedApp
@@ -14,3 +20,29 @@ def validate_redirect_uri(connected_app: "ConnectedApp", method: str):
 			"/api/method/shopify_integration.oauth.callback/" + connected_app.name
 		)
 		connected_app.redirect_uri = urljoin(base_url, callback_path)
+
+
+def store_previous_client_secret(connected_app: "ConnectedApp", method: str):
+	# passwords are only saved after validation, so the stored
+	# client secret is still the previous secret at this point
+	if connected_app.is_new() or not connected_app.client_secret:
+		return
+
+	if connected_app.is_dummy_password(connected_app.client_secret):
+		return
+
+	previous_secret = get_decrypted_password(
+		"Connected App", connected_app.name, "client_secret", raise_exception=False
+	)
+
+	if not previous_secret or previous_secret == connected_app.client_secret:
+		return
+
+	for shop_name in frappe.get_all(
+		"Shopify Settings", filters={"connected_app": connected_app.name}, pluck="name"
+	):
+		store_previous_webhook_secret(shop_name, previous_secret)
+
+
+def invalidate_webhook_signing_keys(connected_app: "ConnectedApp", method: str):
+	clear_webhook_signing_keys()
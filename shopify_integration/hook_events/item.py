@@ -1,10 +1,21 @@
-from typing import Union
+from typing import TYPE_CHECKING, Union
 
 from shopify import LineItem, Product, Variant
 
 import frappe
 from frappe.utils import cstr
 
+from shopify_integration.item_index import clear_item_code_index
+
+if TYPE_CHECKING:
+	from erpnext.stock.doctype.item.item import Item
+
+
+def invalidate_item_code_index(item: "Item", method: str, *args, **kwargs):
+	# any change in item codes, SKUs, Shopify IDs or aliases can change how
+	# Shopify line items are matched with items
+	clear_item_code_index()
+
 
 def get_item_alias(shopify_item: Union[LineItem, Product, Variant]):
 	# ref: https://github.com/ParsimonyGit/parsimony/
@@ -86,8 +86,18 @@ before_migrate = "shopify_integration.setup.setup_custom_fields"
 
 doc_events = {
 	"Connected App": {
-		"validate": "shopify_integration.hook_events.connected_app.validate_redirect_uri",
-	}
+		"validate": [
+			"shopify_integration.hook_events.connected_app.validate_redirect_uri",
+			"shopify_integration.hook_events.connected_app.store_previous_client_secret",
+		],
+		"on_update": "shopify_integration.hook_events.connected_app.invalidate_webhook_signing_keys",
+		"on_trash": "shopify_integration.hook_events.connected_app.invalidate_webhook_signing_keys",
+	},
+	"Item": {
+		"on_update": "shopify_integration.hook_events.item.invalidate_item_code_index",
+		"after_rename": "shopify_integration.hook_events.item.invalidate_item_code_index",
+		"on_trash": "shopify_integration.hook_events.item.invalidate_item_code_index",
+	},
 }
 
 # Scheduled Tasks
@@ -95,7 +105,8 @@ doc_events = {
 
 scheduler_events = {
 	"daily_long": [
-		"shopify_integration.payouts.sync_all_payouts"
+		"shopify_integration.payouts.sync_all_payouts",
+		"shopify_integration.products.sync_all_products",
 	]
 }
 
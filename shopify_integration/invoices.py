@@ -1,19 +1,27 @@
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 import frappe
 from erpnext.accounts.doctype.sales_invoice.sales_invoice import make_sales_return
 from erpnext.selling.doctype.sales_order.sales_order import make_sales_invoice
 from frappe.utils import cint, flt, get_datetime, getdate
 
-from shopify_integration.orders import get_shopify_order
-from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import make_shopify_log
-from shopify_integration.utils import get_shopify_document, get_tax_account_head
+from shopify_integration.orders import ShopifyOrderContext, get_shopify_order
+from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
+	make_shopify_log,
+)
+from shopify_integration.utils import (
+	get_shopify_document,
+	get_shopify_settings,
+	get_tax_account_head,
+)
 
 if TYPE_CHECKING:
 	from erpnext.accounts.doctype.sales_invoice.sales_invoice import SalesInvoice
 	from erpnext.selling.doctype.sales_order.sales_order import SalesOrder
 	from shopify import Order
-	from shopify_integration.shopify_integration.doctype.shopify_settings.shopify_settings import ShopifySettings
+
+# invoices are only created for orders that have been paid
+INVOICE_FINANCIAL_STATUSES = ("paid", "partially_refunded", "refunded")
 
 
 def prepare_sales_invoice(shop_name: str, order_id: str, log_id: str = str()):
@@ -56,7 +64,8 @@ def create_shopify_invoice(
 	shop_name: str,
 	shopify_order: "Order",
 	sales_order: "SalesOrder",
-	log_id: str = str()
+	log_id: str = str(),
+	context: Optional[ShopifyOrderContext] = None
 ):
 	"""
 	Create a Sales Invoice document for a Shopify order. If the Shopify order is refunded
@@ -68,32 +77,53 @@ def create_shopify_invoice(
 		sales_order (SalesOrder, optional): The reference Sales Order document for the
 			Shopify order. Defaults to None.
 		log_id (str, optional): The ID of an existing Shopify Log. Defaults to an empty string.
+		context (ShopifyOrderContext, optional): The processing context for the
+			order. If set, the result is recorded on the context instead of being
+			logged.
 
 	Returns:
-		SalesInvoice: The created Sales Invoice document, if any, otherwise None.
+		SalesInvoice | dict: The created Sales Invoice document, or the name and
+			docstatus of an existing Sales Invoice, if any, otherwise None.
 	"""
 
-	if not shopify_order.attributes.get("financial_status") in ["paid", "partially_refunded", "refunded"]:
+	financial_status = shopify_order.attributes.get("financial_status")
+	if financial_status not in INVOICE_FINANCIAL_STATUSES:
 		return
 
-	frappe.flags.log_id = log_id
+	own_context = not context
+	if own_context:
+		context = ShopifyOrderContext(shop_name, shopify_order, log_id)
+
+	sales_invoice = None
 	try:
-		sales_invoice = create_sales_invoice(shop_name, shopify_order, sales_order)
+		sales_invoice = create_sales_invoice(
+			shop_name, shopify_order, sales_order, context=context
+		)
 		if sales_invoice and sales_invoice.docstatus == 1:
 			create_sales_return(
 				shop_name=shop_name,
 				shopify_order_id=shopify_order.id,
-				shopify_financial_status=shopify_order.attributes.get("financial_status"),
+				shopify_financial_status=financial_status,
 				sales_invoice=sales_invoice
 			)
 	except Exception as e:
-		make_shopify_log(shop_name, status="Error", response_data=shopify_order.to_dict(), exception=e)
+		sales_invoice = None
+		context.add_result("Sales Invoice", "Error", exception=e)
 	else:
-		make_shopify_log(shop_name, status="Success", response_data=shopify_order.to_dict())
-		return sales_invoice
+		context.add_result("Sales Invoice", "Success")
+
+	if own_context:
+		context.make_log()
+
+	return sales_invoice
 
 
-def create_sales_invoice(shop_name: str, shopify_order: "Order", sales_order: "SalesOrder"):
+def create_sales_invoice(
+	shop_name: str,
+	shopify_order: "Order",
+	sales_order: "SalesOrder",
+	context: Optional[ShopifyOrderContext] = None
+):
 	"""
 	Helper function to create a Sales Invoice document for a Shopify order.
 
@@ -101,21 +131,28 @@ def create_sales_invoice(shop_name: str, shopify_order: "Order", sales_order: "S
 		shop_name (str): The name of the Shopify configuration for the store.
 		shopify_order (Order): The Shopify order data.
 		sales_order (SalesOrder): The reference Sales Order document for the Shopify order.
+		context (ShopifyOrderContext, optional): The processing context for the order.
 
 	Returns:
-		SalesInvoice: The created or existing Sales Invoice document, if any, otherwise None.
+		SalesInvoice | dict: The created Sales Invoice document, or the name and
+			docstatus of an existing Sales Invoice, if any, otherwise None.
 	"""
 
-	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
+	if context:
+		shopify_settings = context.settings
+	else:
+		shopify_settings = get_shopify_settings(shop_name)
+
 	if not cint(shopify_settings.sync_sales_invoice):
 		return
 
 	shopify_order_name = shopify_order.attributes.get("name")
 	shopify_order_name = shopify_order_name.split("#")[-1]
 
-	existing_invoice = get_shopify_document(shop_name=shop_name, doctype="Sales Invoice", order=shopify_order)
+	# only the name and docstatus are needed, to make a return against the invoice
+	existing_invoice = get_shopify_document(shop_name=shop_name,
+		doctype="Sales Invoice", order=shopify_order, fields=["docstatus"])
 	if existing_invoice:
-		existing_invoice: "SalesInvoice"
 		frappe.db.set_value("Sales Invoice", existing_invoice.name, {
 			"shopify_settings": shopify_settings.name,
 			"shopify_order_id": shopify_order.id,
@@ -167,7 +204,7 @@ def create_sales_return(
 			If no refunds are found, returns None.
 	"""
 
-	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
+	shopify_settings = get_shopify_settings(shop_name)
 	refunds = shopify_settings.get_refunds(order_id=shopify_order_id)
 
 	refund_dates = [refund.processed_at or refund.created_at
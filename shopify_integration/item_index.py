@@ -0,0 +1,201 @@
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+import frappe
+from frappe.utils import cstr
+
+if TYPE_CHECKING:
+	from shopify import LineItem
+
+# the version is bumped whenever an Item changes, so that indexes
+# in other processes know to drop their cached item codes
+INDEX_VERSION_KEY = "shopify_item_code_index_version"
+
+# drop cached keys once an index grows past this size, to keep
+# long-running workers from slowly loading the entire item master;
+# the size is only checked before a lookup, so that keys loaded for
+# the current line items are never dropped halfway through
+MAX_INDEX_SIZE = 50000
+
+# the Item fields to match line items against, in order of priority;
+# the first element of each tuple is the line item key to match with
+ITEM_KEY_FIELDS: List[Tuple[str, str]] = [
+	("sku", "name"),
+	("sku", "shopify_sku"),
+	("variant_id", "shopify_variant_id"),
+	("product_id", "shopify_product_id"),
+	("title", "item_name"),
+]
+
+_indexes: Dict[str, "ItemCodeIndex"] = {}
+_indexes_lock = threading.Lock()
+
+
+class ItemCodeIndex:
+	"""
+	An in-process index of Shopify line item references to Item codes.
+
+	Keys are loaded in bulk, with one query per key type for all unresolved
+	line items, and cached until any Item document is changed. Only matched
+	keys are cached, so that items created later are always found.
+	"""
+
+	def __init__(self, shop_name: str):
+		self.shop_name = shop_name
+		self.version = None
+		self.keys: Dict[str, Dict[str, Optional[str]]] = {}
+		self._lock = threading.Lock()
+
+	def get_item_codes(self, line_items: Iterable["LineItem"]) -> List[Optional[str]]:
+		"""
+		Resolve the Item codes for a list of Shopify line items in one pass.
+
+		For every line item, the order of priority for the reference field is:
+		- Item Alias (if the Parsimony app is installed)
+		- SKU, against the item code
+		- SKU, against the Shopify SKU
+		- Variant ID
+		- Product ID
+		- Item Title
+
+		:param line_items: The Shopify line items
+		:return: The Item code for each line item, in the same order, or None if
+			no matching Item is found
+		"""
+
+		line_items = list(line_items)
+		line_item_keys = [get_line_item_keys(line_item) for line_item in line_items]
+
+		with self._lock:
+			self.validate_version()
+			if self.get_size() > MAX_INDEX_SIZE:
+				self.clear()
+
+			self.load_alias_keys(line_item_keys)
+
+			# lower priority keys are only loaded for line items that aren't
+			# matched yet, since misses aren't cached and would be queried again
+			pending_keys = [
+				keys
+				for keys in line_item_keys
+				if not self.keys.get("alias", {}).get(keys.get("alias"))
+			]
+			for key, fieldname in ITEM_KEY_FIELDS:
+				self.load_item_keys(fieldname, {keys.get(key) for keys in pending_keys})
+				pending_keys = [
+					keys
+					for keys in pending_keys
+					if not self.keys.get(fieldname, {}).get(keys.get(key))
+				]
+
+			return [self.get_item_code(keys) for keys in line_item_keys]
+
+	def get_item_code(self, line_item_keys: Dict) -> Optional[str]:
+		item_code = self.keys.get("alias", {}).get(line_item_keys.get("alias"))
+
+		for key, fieldname in ITEM_KEY_FIELDS:
+			if item_code:
+				break
+			item_code = self.keys.get(fieldname, {}).get(line_item_keys.get(key))
+
+		return item_code
+
+	def load_alias_keys(self, line_item_keys: List[Dict]):
+		# ref: https://github.com/ParsimonyGit/parsimony/
+		# check if the Parsimony app is installed on the current site;
+		# `frappe.db.table_exists` returns a false positive if any other
+		# site on the bench has the Parsimony app installed instead
+		if "parsimony" not in frappe.get_installed_apps():
+			return
+
+		alias_keys = self.get_missing_keys(
+			"alias", {keys.get("alias") for keys in line_item_keys}
+		)
+		if not alias_keys:
+			return
+
+		item_aliases = frappe.get_all(
+			"Item Alias",
+			filters={"sku": ["in", list(alias_keys)]},
+			fields=["sku", "parent"],
+		)
+
+		self.update_keys("alias", [(alias.sku, alias.parent) for alias in item_aliases])
+
+	def load_item_keys(self, fieldname: str, values: Set[str]):
+		missing_keys = self.get_missing_keys(fieldname, values)
+		if not missing_keys:
+			return
+
+		items = frappe.get_all(
+			"Item",
+			filters={fieldname: ["in", list(missing_keys)]},
+			fields=[fieldname, "item_code"],
+			order_by="modified desc",
+		)
+
+		self.update_keys(
+			fieldname, [(item.get(fieldname), item.item_code) for item in items]
+		)
+
+	def get_missing_keys(self, key_type: str, values: Set[str]) -> Set[str]:
+		cached_keys = self.keys.setdefault(key_type, {})
+		return {value for value in values if value and value.lower() not in cached_keys}
+
+	def update_keys(self, key_type: str, results: List[Tuple[str, str]]):
+		cached_keys = self.keys.setdefault(key_type, {})
+
+		# the database matches values case-insensitively, so we do the same
+		for key, item_code in results:
+			key = cstr(key).lower()
+			if not cached_keys.get(key):
+				cached_keys[key] = item_code
+
+	def validate_version(self):
+		version = frappe.cache().get_value(INDEX_VERSION_KEY, expires=True)
+		if version != self.version:
+			self.clear()
+			self.version = version
+
+	def get_size(self) -> int:
+		return sum(len(keys) for keys in self.keys.values())
+
+	def clear(self):
+		self.keys = {}
+
+
+def get_line_item_keys(line_item: "LineItem") -> Dict[str, str]:
+	sku = cstr(line_item.attributes.get("sku")).strip()
+	variant_id = cstr(line_item.attributes.get("variant_id"))
+	product_id = cstr(line_item.attributes.get("product_id"))
+	title = cstr(line_item.attributes.get("title")).strip()
+
+	keys = {
+		"alias": sku or variant_id or product_id or title,
+		"sku": sku,
+		"variant_id": variant_id,
+		"product_id": product_id,
+		"title": title,
+	}
+
+	return {key: value.lower() for key, value in keys.items()}
+
+
+def get_item_code_index(shop_name: str) -> ItemCodeIndex:
+	"""
+	Get the shared item code index for a Shopify store in the current process.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:return: The item code index for the store
+	"""
+
+	with _indexes_lock:
+		if shop_name not in _indexes:
+			_indexes[shop_name] = ItemCodeIndex(shop_name)
+		return _indexes[shop_name]
+
+
+def clear_item_code_index():
+	"Invalidate the item code indexes in all processes"
+
+	frappe.cache().set_value(INDEX_VERSION_KEY, frappe.generate_hash(length=10))
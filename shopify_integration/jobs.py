@@ -0,0 +1,131 @@
+from typing import Dict, List, Optional
+
+import frappe
+
+# job groups are tracked in Redis, with the group's metadata stored as a
+# cached value and its counters in a separate hash for atomic updates
+JOB_GROUP_KEY = "shopify_job_group|{0}"
+JOB_GROUP_COUNTERS_KEY = "shopify_job_group_counters|{0}"
+JOB_GROUP_COUNTERS = ("total", "remaining", "failed")
+JOB_GROUP_EXPIRY_SECONDS = 24 * 60 * 60
+
+
+def enqueue_job_group(
+	jobs: List[Dict],
+	on_complete: str,
+	queue: str = "long",
+	timeout: Optional[int] = None,
+	**on_complete_kwargs,
+) -> str:
+	"""
+	Enqueue a group of background jobs that can run in parallel on separate
+	workers, and run a callback once all of them have finished.
+
+	The callback receives the group ID as `job_group`, along with any other
+	keyword arguments, and can check the group's progress for failures.
+
+	:param jobs: The keyword arguments for each job, including its `method`
+	:param on_complete: The dotted path of the method to run once all jobs are done
+	:param queue: (optional) The queue for the jobs, defaults to "long"
+	:param timeout: (optional) The timeout for each job, in seconds
+	:return: The ID of the job group
+	"""
+
+	group_id = frappe.generate_hash(length=10)
+
+	frappe.cache().set_value(
+		JOB_GROUP_KEY.format(group_id),
+		{"on_complete": on_complete, "kwargs": on_complete_kwargs, "queue": queue},
+		expires_in_sec=JOB_GROUP_EXPIRY_SECONDS,
+	)
+
+	set_job_group_counters(group_id, total=len(jobs), remaining=len(jobs), failed=0)
+
+	if not jobs:
+		complete_job_group(group_id)
+		return group_id
+
+	for job in jobs:
+		job = dict(job)
+		frappe.enqueue(
+			"shopify_integration.jobs.run_group_job",
+			queue=queue,
+			timeout=timeout,
+			is_async=True,
+			job_group=group_id,
+			job_method=job.pop("method"),
+			job_kwargs=job,
+		)
+
+	return group_id
+
+
+def run_group_job(job_group: str, job_method: str, job_kwargs: Dict):
+	"""
+	Run a single job from a job group, and run the group's callback if this is
+	the last job in the group to finish. Jobs that fail are counted against the
+	group, and the error is raised as usual.
+
+	:param job_group: The ID of the job group
+	:param job_method: The dotted path of the method to run
+	:param job_kwargs: The keyword arguments for the method
+	"""
+
+	try:
+		frappe.get_attr(job_method)(**job_kwargs)
+	except Exception:
+		frappe.db.rollback()
+		increment_job_group_counter(job_group, "failed")
+		raise
+	finally:
+		if increment_job_group_counter(job_group, "remaining", -1) <= 0:
+			complete_job_group(job_group)
+
+
+def complete_job_group(group_id: str):
+	job_group: Optional[Dict] = frappe.cache().get_value(JOB_GROUP_KEY.format(group_id))
+	if not job_group:
+		return
+
+	frappe.enqueue(
+		job_group.get("on_complete"),
+		queue=job_group.get("queue"),
+		is_async=True,
+		job_group=group_id,
+		**job_group.get("kwargs"),
+	)
+
+
+def get_job_group_progress(group_id: str) -> Dict[str, int]:
+	"""
+	Get the progress of a job group.
+
+	:param group_id: The ID of the job group
+	:return: The total number of jobs in the group, and the number of jobs that
+		are still remaining or have failed
+	"""
+
+	cache = frappe.cache()
+	values = cache.hmget(
+		cache.make_key(JOB_GROUP_COUNTERS_KEY.format(group_id)), JOB_GROUP_COUNTERS
+	)
+	return {
+		counter: int(value or 0) for counter, value in zip(JOB_GROUP_COUNTERS, values)
+	}
+
+
+def increment_job_group_counter(group_id: str, counter: str, amount: int = 1) -> int:
+	cache = frappe.cache()
+	return cache.hincrby(
+		cache.make_key(JOB_GROUP_COUNTERS_KEY.format(group_id)), counter, amount
+	)
+
+
+def set_job_group_counters(group_id: str, **counters):
+	cache = frappe.cache()
+	key = cache.make_key(JOB_GROUP_COUNTERS_KEY.format(group_id))
+
+	pipeline = cache.pipeline()
+	pipeline.hset(key, mapping=counters)
+	pipeline.expire(key, JOB_GROUP_EXPIRY_SECONDS)
+	pipeline.execute()
@@ -9,6 +9,8 @@ from shopify.utils.shop_url import sanitize_shop_domain
 import frappe
 from frappe import _
 
+from shopify_integration.utils import get_shop_for_domain
+
 if TYPE_CHECKING:
 	from frappe.integrations.doctype.connected_app.connected_app import ConnectedApp
 	from frappe.integrations.doctype.token_cache.token_cache import TokenCache
@@ -26,19 +28,16 @@ def install_custom_app(*args, **kwargs):
 	if not shop_url:
 		frappe.throw(_("Invalid shop URL"))
 
-	shops: List["ShopifySettings"] = frappe.get_all(
-		"Shopify Settings",
-		filters={
-			"enable_shopify": True,
-			"shopify_url": ["LIKE", f"%{kwargs.get('shop')}%"],
-		},
-		fields=["name", "connected_app"],
-	)
-
-	if not shops:
+	shop_name = get_shop_for_domain(shop_url)
+	if not shop_name:
 		frappe.throw(_(f"No Shopify Settings found for {kwargs.get('shop')}"))
 
-	shopify_settings = shops[0]
+	shopify_settings = frappe._dict(
+		name=shop_name,
+		connected_app=frappe.db.get_value(
+			"Shopify Settings", shop_name, "connected_app"
+		),
+	)
 
 	# remove Frappe's argument to properly validate HMAC
 	kwargs.pop("cmd")
@@ -1,12 +1,19 @@
-from typing import TYPE_CHECKING, List
+import json
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Dict, List, Optional
 
 import frappe
-from frappe.utils import flt, getdate, nowdate
+from frappe.utils import cint, cstr, flt, getdate, nowdate
 
 from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
+	get_message,
 	make_shopify_log,
 )
-from shopify_integration.utils import get_shopify_document, get_tax_account_head
+from shopify_integration.utils import (
+	get_shopify_document,
+	get_shopify_settings,
+	get_tax_account_head,
+)
 
 if TYPE_CHECKING:
 	from erpnext.selling.doctype.sales_order.sales_order import SalesOrder
@@ -16,6 +23,108 @@ if TYPE_CHECKING:
 	)
 
 
+class ShopifyOrderContext:
+	"""
+	The shared state for processing a single Shopify order into its Sales Order,
+	Sales Invoice and Delivery Notes.
+
+	The store's settings, the serialized order, and the order's customer and item
+	codes are resolved once and reused by every stage. Each stage records its
+	result on the context, and `make_log` writes a single log for the order.
+	"""
+
+	def __init__(self, shop_name: str, shopify_order: "Order", log_id: str = str()):
+		self.shop_name = shop_name
+		self.shopify_order = shopify_order
+		self.log_id = log_id
+
+		self.settings = get_shopify_settings(shop_name)
+		self.customer: Optional[str] = None
+		self.item_codes: Dict[str, Optional[str]] = {}
+		self.results: List[frappe._dict] = []
+		self._order_data: Optional[Dict] = None
+
+	@property
+	def order_data(self) -> Dict:
+		"The serialized Shopify order, for logging"
+
+		if self._order_data is None:
+			self._order_data = self.shopify_order.to_dict()
+		return self._order_data
+
+	def get_item_codes(self, line_items: List["LineItem"]) -> List[Optional[str]]:
+		"""
+		Get the item codes for an order's line items, or for the line items in
+		its fulfillments, which share the same IDs.
+
+		:param line_items: The Shopify line items
+		:return: The item code for each line item, in the same order
+		"""
+
+		from shopify_integration.products import get_item_codes
+
+		missing_items = [
+			item for item in line_items if cstr(item.id) not in self.item_codes
+		]
+		if missing_items:
+			item_codes = get_item_codes(missing_items, self.shop_name)
+			for item, item_code in zip(missing_items, item_codes):
+				self.item_codes[cstr(item.id)] = item_code
+
+		return [self.item_codes.get(cstr(item.id)) for item in line_items]
+
+	def add_result(
+		self, stage: str, status: str, exception: Optional[Exception] = None
+	):
+		"""
+		Record the result of a processing stage.
+
+		:param stage: The doctype created by the stage
+		:param status: The log status for the stage
+		:param exception: (optional) The error raised by the stage
+		"""
+
+		self.results.append(
+			frappe._dict(
+				stage=stage,
+				status=status,
+				message=get_message(exception) if exception else None,
+				traceback=frappe.get_traceback() if exception else None,
+			)
+		)
+
+	def make_log(self):
+		"Write a single Shopify Log for all processing stages"
+
+		if not self.results:
+			return
+
+		statuses = {result.status for result in self.results}
+		if "Error" in statuses:
+			status = "Error"
+		elif "Success" in statuses:
+			status = "Success"
+		else:
+			status = "Skipped"
+
+		message = "\n".join(
+			f"{result.stage}: {result.message or result.status}"
+			for result in self.results
+		)
+		traceback = "\n".join(
+			result.traceback for result in self.results if result.traceback
+		)
+
+		frappe.flags.log_id = self.log_id
+		make_shopify_log(
+			self.shop_name,
+			status=status,
+			message=message,
+			response_data=self.order_data,
+			traceback=traceback or None,
+		)
+
+
 def create_shopify_documents(
 	shop_name: str, order_id: str, log_id: str = str(), amended_from: str = str()
 ):
@@ -42,16 +151,38 @@ def create_shopify_documents(
 	if not order:
 		return
 
-	sales_order = create_shopify_order(shop_name, order, log_id, amended_from)
+	context = ShopifyOrderContext(shop_name, order, log_id)
+
+	sales_order = create_shopify_order(
+		shop_name, order, log_id, amended_from, context=context
+	)
 	if sales_order:
-		create_shopify_invoice(shop_name, order, sales_order, log_id)
-		create_shopify_delivery(shop_name, order, sales_order, log_id)
+		create_shopify_invoice(shop_name, order, sales_order, log_id, context=context)
+		create_shopify_delivery(shop_name, order, sales_order, log_id, context=context)
+
+	context.make_log()
 
 
 def get_shopify_order(shop_name: str, order_id: str, log_id: str = str()):
+	"""
+	Get a Shopify order, either from a webhook's stored payload (if enabled in
+	the Shopify settings), or from Shopify.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param order_id: The Shopify order ID
+	:param log_id: (optional) The ID of an existing Shopify Log
+	:return: The Shopify order, if found
+	"""
+
 	frappe.flags.log_id = log_id
 
-	settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
+	settings = get_shopify_settings(shop_name)
+
+	if settings.use_webhook_payload:
+		order = get_shopify_order_from_log(settings, order_id, log_id)
+		if order:
+			return order
+
 	orders = settings.get_orders(order_id)
 	if not orders:
 		make_shopify_log(
@@ -66,11 +197,62 @@ def get_shopify_order(shop_name: str, order_id: str, log_id: str = str()):
 	return order
 
 
+def get_shopify_order_from_log(
+	settings: "ShopifySettings", order_id: str, log_id: str
+) -> Optional["Order"]:
+	"""
+	Build a Shopify order from the payload of an order webhook, to avoid
+	requesting the order from Shopify again.
+
+	:param settings: The Shopify configuration for the store
+	:param order_id: The Shopify order ID
+	:param log_id: The ID of the Shopify Log for the webhook
+	:return: The Shopify order, or None if the log doesn't contain the order, or
+		if the order data is older than allowed in the Shopify settings
+	"""
+
+	from shopify import Order
+
+	if not log_id:
+		return
+
+	request_data = frappe.db.get_value("Shopify Log", log_id, "request_data")
+	if not request_data:
+		return
+
+	data: Dict = json.loads(request_data)
+
+	# webhooks for other resources, like order edits, don't carry the full order
+	if cstr(data.get("id")) != cstr(order_id) or "line_items" not in data:
+		return
+
+	max_age = cint(settings.webhook_payload_max_age)
+	if max_age:
+		# the payload's age can't be checked without a timestamp, so the order is
+		# requested from Shopify instead
+		timestamp = data.get("updated_at") or data.get("created_at")
+		if not timestamp:
+			return
+
+		updated_at = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+		if not updated_at.tzinfo:
+			return
+
+		if datetime.now(timezone.utc) - updated_at > timedelta(minutes=max_age):
+			return
+
+	# building a resource from its attributes requires an active session,
+	# but doesn't make any requests to Shopify
+	with settings.get_shopify_session(temp=True):
+		return Order(data)
+
+
 def create_shopify_order(
 	shop_name: str,
 	shopify_order: "Order",
 	log_id: str = str(),
 	amended_from: str = str(),
+	context: Optional[ShopifyOrderContext] = None,
 ):
 	"""
 	Create a Sales Order document for a Shopify order.
@@ -79,41 +261,41 @@ def create_shopify_order(
 	:param order_id: The Shopify order ID
 	:param log_id: (optional) The ID of an existing Shopify Log
 	:param amended_from: (optional) The name of the original cancelled Sales Order
+	:param context: (optional) The processing context for the order; if set, the
+		result is recorded on the context instead of being logged
 	:return: The created Sales Order document, if any, otherwise None
 	"""
 
 	from shopify_integration.customers import validate_customer
 	from shopify_integration.products import validate_items
 
-	frappe.flags.log_id = log_id
+	own_context = not context
+	if own_context:
+		context = ShopifyOrderContext(shop_name, shopify_order, log_id)
 
+	sales_order = None
 	if existing_so := get_shopify_document(
 		shop_name=shop_name, doctype="Sales Order", order=shopify_order
 	):
 		existing_so: "SalesOrder"
-		make_shopify_log(
-			shop_name, status="Skipped", response_data=shopify_order.to_dict()
-		)
-		return existing_so
-
-	try:
-		validate_customer(shop_name, shopify_order)
-		validate_items(shop_name, shopify_order)
-		sales_order = create_sales_order(
-			shop_name, shopify_order, amended_from=amended_from
-		)
-	except Exception as e:
-		make_shopify_log(
-			shop_name,
-			status="Error",
-			response_data=shopify_order.to_dict(),
-			exception=e,
-		)
+		sales_order = existing_so
+		context.add_result("Sales Order", "Skipped")
 	else:
-		make_shopify_log(
-			shop_name, status="Success", response_data=shopify_order.to_dict()
-		)
-		return sales_order
+		try:
+			context.customer = validate_customer(shop_name, shopify_order)
+			validate_items(shop_name, shopify_order)
+			sales_order = create_sales_order(
+				shop_name, shopify_order, amended_from=amended_from, context=context
+			)
+		except Exception as e:
+			context.add_result("Sales Order", "Error", exception=e)
+		else:
+			context.add_result("Sales Order", "Success")
+
+	if own_context:
+		context.make_log()
+
+	return sales_order
 
 
 def update_shopify_order(shop_name: str, order_id: str, log_id: str = str()):
@@ -129,16 +311,18 @@ def update_shopify_order(shop_name: str, order_id: str, log_id: str = str()):
 	"""
 
 	if existing_so := get_shopify_document(
-		shop_name=shop_name, doctype="Sales Order", order_id=order_id
+		shop_name=shop_name, doctype="Sales Order", order_id=order_id, exists_only=True
 	):
 		cancel_shopify_order(shop_name, order_id, log_id)
-		create_shopify_documents(
-			shop_name, order_id, log_id, amended_from=existing_so.name
-		)
+		create_shopify_documents(shop_name, order_id, log_id, amended_from=existing_so)
 
 
 def create_sales_order(
-	shop_name: str, shopify_order: "Order", *, amended_from: str = str()
+	shop_name: str,
+	shopify_order: "Order",
+	*,
+	amended_from: str = str(),
+	context: Optional[ShopifyOrderContext] = None,
 ):
 	"""
 	Helper function to create a Sales Order document for a Shopify order.
@@ -146,14 +330,22 @@ def create_sales_order(
 	:param shop_name: The name of the Shopify configuration for the store
 	:param shopify_order: The Shopify order data
 	:param amended_from: (optional) The name of the original cancelled Sales Order
+	:param context: (optional) The processing context for the order
 	:return: The created Sales Order document, if any, otherwise None
 	"""
 
-	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
-	shopify_customer = shopify_order.attributes.get("customer", frappe._dict())
-	customer = frappe.db.get_value(
-		"Customer", {"shopify_customer_id": shopify_customer.id}, "name"
-	)
+	if context:
+		shopify_settings = context.settings
+		customer = context.customer
+	else:
+		shopify_settings = get_shopify_settings(shop_name)
+		customer = None
+
+	if not customer:
+		shopify_customer = shopify_order.attributes.get("customer", frappe._dict())
+		customer = frappe.db.get_value(
+			"Customer", {"shopify_customer_id": shopify_customer.id}, "name"
+		)
 
 	shopify_order_name = shopify_order.attributes.get("name")
 	shopify_order_name = shopify_order_name.split("#")[-1]
@@ -173,7 +365,9 @@ def create_sales_order(
 			"selling_price_list": shopify_settings.price_list,
 			"ignore_pricing_rule": 1,
 			"items": get_order_items(
-				shopify_order.attributes.get("line_items", []), shopify_settings
+				shopify_order.attributes.get("line_items", []),
+				shopify_settings,
+				context,
 			),
 			"taxes": get_order_taxes(shopify_order, shopify_settings),
 			"apply_discount_on": "Grand Total",
@@ -192,18 +386,33 @@ def create_sales_order(
 
 
 def get_order_items(
-	shopify_order_items: List["LineItem"], shopify_settings: "ShopifySettings"
+	shopify_order_items: List["LineItem"],
+	shopify_settings: "ShopifySettings",
+	context: Optional[ShopifyOrderContext] = None,
 ):
+	from shopify_integration.products import get_item_codes
+
+	# resolve the item codes for all line items at once
+	if context:
+		item_codes = context.get_item_codes(shopify_order_items)
+	else:
+		item_codes = get_item_codes(shopify_order_items, shopify_settings.name)
+
 	items = []
-	for shopify_item in shopify_order_items:
-		items.append(get_order_item(shopify_item, shopify_settings))
+	for shopify_item, item_code in zip(shopify_order_items, item_codes):
+		items.append(get_order_item(shopify_item, shopify_settings, item_code))
 	return items
 
 
-def get_order_item(shopify_item: "LineItem", shopify_settings: "ShopifySettings"):
+def get_order_item(
+	shopify_item: "LineItem",
+	shopify_settings: "ShopifySettings",
+	item_code: Optional[str] = None,
+):
 	from shopify_integration.products import get_item_code
 
-	item_code = get_item_code(shopify_item)
+	if not item_code:
+		item_code = get_item_code(shopify_item, shopify_settings.name)
 	item_name = shopify_item.attributes.get("name", str())[:140]
 	item_group = (
 		frappe.db.get_value("Item", item_code, "item_group")
@@ -329,16 +538,20 @@ def cancel_shopify_order(shop_name: str, order_id: str, log_id: str = str()):
 
 	doctypes = ["Delivery Note", "Sales Invoice", "Sales Order"]
 	for doctype in doctypes:
-		doc = get_shopify_document(shop_name=shop_name, doctype=doctype, order=order)
+		# the document is only loaded if it needs to be cancelled
+		doc = get_shopify_document(
+			shop_name=shop_name, doctype=doctype, order=order, fields=["docstatus"]
+		)
 		if not doc:
 			continue
 
 		# recursively cancel all Shopify documents
 		if doc.docstatus == 1:
 			try:
+				cancel_doc = frappe.get_doc(doctype, doc.name)
 				# ignore document links to Shopify Payout while cancelling
-				doc.flags.ignore_links = True
-				doc.cancel()
+				cancel_doc.flags.ignore_links = True
+				cancel_doc.cancel()
 			except Exception as e:
 				make_shopify_log(
 					shop_name,
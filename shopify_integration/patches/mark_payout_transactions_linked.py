@@ -0,0 +1,8 @@
+import frappe
+
+
+def execute():
+	frappe.reload_doc("shopify_integration", "doctype", "shopify_payout")
+
+	# existing payouts were linked to their sales documents when they were created
+	frappe.db.sql("UPDATE `tabShopify Payout` SET transactions_linked = 1")
@@ -0,0 +1,12 @@
+import frappe
+
+
+def execute():
+	frappe.reload_doc("shopify_integration", "doctype", "shopify_settings")
+
+	# existing stores only registered order webhooks, so register the
+	# product webhooks as well, without waiting for their settings to be saved
+	for shop_name in frappe.get_all(
+		"Shopify Settings", filters={"enable_shopify": True}, pluck="name"
+	):
+		frappe.get_doc("Shopify Settings", shop_name).enqueue_webhook_update()
@@ -2,18 +2,38 @@
 # Copyright (c) 2021, Parsimony, LLC and contributors
 # For license information, please see license.txt
 
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
 
 import frappe
-from frappe.utils import flt, get_datetime_str, get_first_day, getdate, now, today
+from frappe.utils import (
+	add_to_date,
+	cstr,
+	flt,
+	get_datetime_str,
+	get_first_day,
+	getdate,
+	now,
+	now_datetime,
+	today,
+)
 
 from shopify_integration.fulfilments import create_shopify_delivery
-from shopify_integration.invoices import create_shopify_invoice
-from shopify_integration.orders import create_shopify_order
+from shopify_integration.invoices import (
+	INVOICE_FINANCIAL_STATUSES,
+	create_shopify_invoice,
+)
+from shopify_integration.jobs import enqueue_job_group, get_job_group_progress
+from shopify_integration.orders import ShopifyOrderContext, create_shopify_order
 from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
 	make_shopify_log,
 )
-from shopify_integration.utils import get_shopify_document
+from shopify_integration.utils import (
+	SHOPIFY_ORDER_DOCTYPES,
+	SHOPIFY_PAGE_LIMIT,
+	create_batches,
+	get_shopify_documents,
+	get_shopify_settings,
+)
 
 if TYPE_CHECKING:
 	from shopify import Order, Payouts, Transactions
@@ -27,6 +47,10 @@ if TYPE_CHECKING:
 		ShopifyPayout,
 	)
 
+# payouts that are still unlinked after this long are assumed to have been
+# interrupted, and are retried by the next payout sync
+PAYOUT_RETRY_AFTER_HOURS = 12
+
 
 def sync_all_payouts():
 	"""
@@ -69,37 +93,175 @@ def create_shopify_payouts(shop_name: str, start_date: str = str()):
 			**{"shop_name": shop_name, "payout_id": payout.id},
 		)
 
+	# retry payouts that failed or were interrupted before they were linked
+	for payout_id in get_unlinked_payout_ids(shop_name):
+		frappe.enqueue(
+			method="shopify_integration.payouts.create_shopify_payout",
+			queue="long",
+			timeout=3600,
+			is_async=True,
+			**{"shop_name": shop_name, "payout_id": payout_id},
+		)
+
 	shopify_settings.last_sync_datetime = now()
 	shopify_settings.save()
 
 
+def get_unlinked_payout_ids(shop_name: str) -> List[str]:
+	"""
+	Get the draft payouts whose transactions were never linked to their sales
+	documents, and that aren't being linked anymore.
+
+	Args:
+		shop_name (str): The name of the Shopify configuration for the store.
+
+	Returns:
+		list of str: The Shopify payout IDs.
+	"""
+
+	retry_before = add_to_date(now_datetime(), hours=-PAYOUT_RETRY_AFTER_HOURS)
+	return frappe.get_all(
+		"Shopify Payout",
+		filters={
+			"shop_name": shop_name,
+			"docstatus": 0,
+			"transactions_linked": 0,
+			"modified": ["<", retry_before],
+		},
+		pluck="payout_id",
+	)
+
+
 def create_shopify_payout(shop_name: str, payout_id: str):
-	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
-	payouts: List["Payouts"] = shopify_settings.get_payouts(payout_id)
-	payout = payouts[0]
+	shopify_settings = get_shopify_settings(shop_name)
+
+	# the payout's transactions are only requested once, and saved with the
+	# payout; they're linked to their sales documents once all missing
+	# orders have been created
+	existing_payout = frappe.db.get_value(
+		"Shopify Payout",
+		{"payout_id": payout_id},
+		["name", "docstatus", "transactions_linked"],
+		as_dict=True,
+	)
 
-	payout_order_ids = []
-	try:
-		payout_transactions: List[
-			"Transactions"
-		] = shopify_settings.get_payout_transactions(payout_id=payout_id)
-	except Exception as e:
-		make_shopify_log(
-			shop_name=shop_name,
-			status="Payout Transactions Error",
-			response_data=payout.to_dict(),
-			exception=e,
+	if existing_payout:
+		if existing_payout.docstatus != 0 or existing_payout.transactions_linked:
+			return
+
+		# retry linking the transactions saved with the payout
+		payout_doc: "ShopifyPayout" = frappe.get_doc(
+			"Shopify Payout", existing_payout.name
 		)
+		if not payout_doc.transactions:
+			payout = shopify_settings.get_payouts(payout_id)[0]
+			set_payout_transactions(shopify_settings, payout_doc, payout)
 	else:
-		payout_order_ids = [
-			transaction.source_order_id
-			for transaction in payout_transactions
-			if transaction.source_order_id
-		]
+		payout = shopify_settings.get_payouts(payout_id)[0]
+		payout_doc = _create_shopify_payout(shopify_settings, payout)
+
+	# leave payouts without transactions to be retried
+	if payout_doc.flags.transactions_error:
+		return
+
+	payout_order_ids = [
+		transaction.source_order_id
+		for transaction in payout_doc.transactions
+		if transaction.source_order_id
+	]
+
+	# create missing orders in parallel, and complete the payout once they're done
+	enqueue_job_group(
+		jobs=[
+			{
+				"method": "shopify_integration.payouts.create_missing_orders_by_ids",
+				"shop_name": shop_name,
+				"order_ids": batch,
+			}
+			for batch in create_batches(
+				get_incomplete_order_ids(shopify_settings, payout_order_ids)
+			)
+		],
+		on_complete="shopify_integration.payouts.complete_shopify_payout",
+		timeout=3600,
+		shop_name=shop_name,
+		payout_name=payout_doc.name,
+	)
+
+
+def complete_shopify_payout(shop_name: str, payout_name: str, job_group: str):
+	"""
+	Link a Shopify Payout's transactions to their sales documents, once the
+	payout's missing orders have been created, and update the invoice fees.
 
-	create_missing_orders(shopify_settings, payout_order_ids)
-	payout_doc: "ShopifyPayout" = _create_shopify_payout(shopify_settings, payout)
+	Args:
+		shop_name (str): The name of the Shopify configuration for the store.
+		payout_name (str): The name of the Shopify Payout document.
+		job_group (str): The ID of the job group that created the missing orders.
+	"""
+
+	payout_doc: "ShopifyPayout" = frappe.get_doc("Shopify Payout", payout_name)
+
+	# leave the payout unlinked if any orders failed, so that it's retried
+	progress = get_job_group_progress(job_group)
+	if progress.get("failed"):
+		frappe.flags.log_id = None
+		make_shopify_log(
+			shop_name,
+			status="Payout Error",
+			message=(
+				f"Missing orders for Shopify Payout '{payout_name}' could not be "
+				f"created in {progress.get('failed')} of {progress.get('total')} "
+				"batches; the payout will be retried by the next payout sync"
+			),
+		)
+		return
+
+	shopify_docs = get_shopify_documents(
+		shop_name,
+		[transaction.source_order_id for transaction in payout_doc.transactions],
+	)
+
+	# orders can also be left without a Sales Order without failing a job,
+	# since order creation logs some errors instead of raising them
+	missing_order_ids = {
+		cstr(transaction.source_order_id)
+		for transaction in payout_doc.transactions
+		if transaction.source_order_id
+		and cstr(transaction.source_order_id) not in shopify_docs["Sales Order"]
+	}
+	if missing_order_ids:
+		frappe.flags.log_id = None
+		make_shopify_log(
+			shop_name,
+			status="Payout Error",
+			message=(
+				f"Sales Orders for {len(missing_order_ids)} orders in Shopify Payout "
+				f"'{payout_name}' are still missing; the payout will be retried by "
+				"the next payout sync"
+			),
+		)
+		return
+
+	for transaction in payout_doc.transactions:
+		if not transaction.source_order_id:
+			continue
+
+		shopify_order_id = cstr(transaction.source_order_id)
+		for doctype in SHOPIFY_ORDER_DOCTYPES:
+			shopify_doc = shopify_docs[doctype].get(shopify_order_id)
+			transaction.set(
+				frappe.scrub(doctype), shopify_doc.name if shopify_doc else None
+			)
+
+	payout_doc.save(ignore_permissions=True)
+	frappe.db.commit()
+
+	# only mark the payout as linked once the fees are added, so that it's
+	# retried otherwise; fees are only added to draft invoices
 	payout_doc.update_invoice_fees()
+	payout_doc.db_set("transactions_linked", 1)
+	frappe.db.commit()
 
 
 def get_payouts(shopify_settings: "ShopifySettings", start_date: str = str()):
@@ -137,54 +299,154 @@ def get_payouts(shopify_settings: "ShopifySettings", start_date: str = str()):
 		return payouts
 
 
+def get_incomplete_order_ids(
+	shopify_settings: "ShopifySettings",
+	shopify_order_ids: List[str],
+	shopify_docs: Optional[Dict[str, Dict]] = None,
+) -> List[str]:
+	"""
+	Find the Shopify orders that are missing a Sales Order, Sales Invoice or
+	Delivery Note.
+
+	Args:
+		shopify_settings (ShopifySettings): The Shopify configuration for the store.
+		shopify_order_ids (list of str): The Shopify order IDs to check.
+		shopify_docs (dict, optional): The existing documents for the orders, from
+			`get_shopify_documents`. Looked up if not set.
+
+	Returns:
+		list of str: The unique IDs of orders with missing documents.
+	"""
+
+	if shopify_docs is None:
+		shopify_docs = get_shopify_documents(shopify_settings.name, shopify_order_ids)
+
+	incomplete_order_ids = []
+	shopify_order_ids = [cstr(order_id) for order_id in shopify_order_ids]
+	for shopify_order_id in dict.fromkeys(shopify_order_ids):
+		if not all(
+			shopify_order_id in shopify_docs[doctype]
+			for doctype in SHOPIFY_ORDER_DOCTYPES
+		):
+			incomplete_order_ids.append(shopify_order_id)
+
+	return incomplete_order_ids
+
+
+def create_missing_orders_by_ids(shop_name: str, order_ids: List[str]):
+	"""
+	Create missing documents for a batch of Shopify orders, as part of a payout sync.
+
+	Args:
+		shop_name (str): The name of the Shopify configuration for the store.
+		order_ids (list of str): The Shopify order IDs.
+	"""
+
+	frappe.set_user("Administrator")
+	create_missing_orders(get_shopify_settings(shop_name), order_ids)
+
+
 def create_missing_orders(
 	shopify_settings: "ShopifySettings", shopify_order_ids: List[str]
 ):
 	"""
 	Create missing Sales Orders, Sales Invoices and Delivery Notes, if enabled in Shopify Settings.
 
+	Existing documents are looked up for all orders at once, and incomplete orders
+	are requested from Shopify in batches, using the `ids` filter. Orders that
+	fail are logged individually, and then fail the call as a whole, so that a
+	payout sync job isn't counted as successful.
+
 	Args:
 		shopify_settings (ShopifySettings): The Shopify configuration for the store.
 		shopify_order_ids (list of str): The Shopify order IDs to create documents against.
 	"""
 
-	for shopify_order_id in shopify_order_ids:
-		sales_order = get_shopify_document(
-			shop_name=shopify_settings.name,
-			doctype="Sales Order",
-			order_id=shopify_order_id,
-		)
-		sales_invoice = get_shopify_document(
-			shop_name=shopify_settings.name,
-			doctype="Sales Invoice",
-			order_id=shopify_order_id,
+	shop_name = shopify_settings.name
+	shopify_docs = get_shopify_documents(
+		shop_name, shopify_order_ids, fields={"Sales Order": ["per_delivered"]}
+	)
+
+	incomplete_order_ids = get_incomplete_order_ids(
+		shopify_settings, shopify_order_ids, shopify_docs
+	)
+
+	failed_orders = 0
+	for batch in create_batches(incomplete_order_ids):
+		orders: List["Order"] = shopify_settings.get_orders(
+			ids=",".join(batch), status="any", limit=SHOPIFY_PAGE_LIMIT
 		)
-		delivery_note = get_shopify_document(
-			shop_name=shopify_settings.name,
-			doctype="Delivery Note",
-			order_id=shopify_order_id,
+
+		for order in orders:
+			# an error in one order shouldn't discard the rest of the batch
+			try:
+				create_missing_order_documents(shopify_settings, order, shopify_docs)
+			except Exception as e:
+				failed_orders += 1
+				frappe.flags.log_id = None
+				make_shopify_log(
+					shop_name,
+					status="Error",
+					response_data=order.to_dict(),
+					exception=e,
+					rollback=True,
+				)
+
+	if failed_orders:
+		frappe.throw(
+			f"{failed_orders} of {len(incomplete_order_ids)} Shopify orders "
+			"could not be created"
 		)
 
-		if all([sales_order, sales_invoice, delivery_note]):
-			continue
 
-		orders: List["Order"] = shopify_settings.get_orders(shopify_order_id)
-		if not orders:
-			continue
+def create_missing_order_documents(
+	shopify_settings: "ShopifySettings", order: "Order", shopify_docs: Dict[str, Dict]
+):
+	"""
+	Create an order's missing Sales Order, Sales Invoice and Delivery Note.
+
+	An existing Sales Order is only loaded if an invoice or delivery will be
+	created against it.
+
+	Args:
+		shopify_settings (ShopifySettings): The Shopify configuration for the store.
+		order (Order): The Shopify order data.
+		shopify_docs (dict): The existing documents for the order, from
+			`get_shopify_documents`, including the Sales Order's `per_delivered`.
+	"""
+
+	shop_name = shopify_settings.name
+	shopify_order_id = cstr(order.id)
+	sales_order = shopify_docs["Sales Order"].get(shopify_order_id)
+	sales_invoice = shopify_docs["Sales Invoice"].get(shopify_order_id)
+	delivery_note = shopify_docs["Delivery Note"].get(shopify_order_id)
 
-		order = orders[0]
+	needs_invoice = not sales_invoice and (
+		order.attributes.get("financial_status") in INVOICE_FINANCIAL_STATUSES
+	)
+	# multiple deliveries can be made against a single order
+	needs_delivery = bool(order.attributes.get("fulfillments")) and (
+		not delivery_note or (sales_order and flt(sales_order.per_delivered) < 100)
+	)
 
-		# create an order, invoice and delivery, if missing
-		if not sales_order:
-			sales_order = create_shopify_order(shopify_settings.name, order)
+	if sales_order and not (needs_invoice or needs_delivery):
+		return
 
-		if sales_order:
-			sales_order: "SalesOrder"
-			if not sales_invoice:
-				create_shopify_invoice(shopify_settings.name, order, sales_order)
-			if not delivery_note or sales_order.per_delivered < 100:
-				# multiple deliveries can be made against a single order
-				create_shopify_delivery(shopify_settings.name, order, sales_order)
+	# create an order, invoice and delivery, if missing
+	context = ShopifyOrderContext(shop_name, order)
+	if sales_order:
+		sales_order = frappe.get_doc("Sales Order", sales_order.name)
+	else:
+		sales_order = create_shopify_order(shop_name, order, context=context)
+
+	if sales_order:
+		sales_order: "SalesOrder"
+		if needs_invoice:
+			create_shopify_invoice(shop_name, order, sales_order, context=context)
+		if needs_delivery:
+			create_shopify_delivery(shop_name, order, sales_order, context=context)
+
+	context.make_log()
 
 
 def _create_shopify_payout(shopify_settings: "ShopifySettings", payout: "Payouts"):
@@ -213,11 +475,53 @@ def _create_shopify_payout(shopify_settings: "ShopifySettings", payout: "Payouts
 		}
 	)
 
+	set_payout_transactions(shopify_settings, payout_doc, payout)
+	return payout_doc
+
+
+def set_payout_transactions(
+	shopify_settings: "ShopifySettings", payout_doc: "ShopifyPayout", payout: "Payouts"
+):
+	"""
+	Request a payout's transactions from Shopify, and save them in the Shopify
+	Payout document. If the transactions can't be requested, the payout is saved
+	without them, and `flags.transactions_error` is set on the document.
+
+	Args:
+		shopify_settings (ShopifySettings): The Shopify configuration for the store.
+		payout_doc (ShopifyPayout): The Shopify Payout document.
+		payout (Payouts): The Payout payload from Shopify.
+	"""
+
+	payout_doc.set("transactions", [])
 	try:
-		payout_transactions: List[
+		payout_transactions: Iterator[
 			"Transactions"
-		] = shopify_settings.get_payout_transactions(payout_id=payout.id)
+		] = shopify_settings.get_payout_transactions(payout_id=payout.id, stream=True)
+
+		# rows are built as each page is received from Shopify, so only the
+		# rows are kept in memory, instead of every transaction
+		transaction_rows = [
+			get_payout_transaction(transaction) for transaction in payout_transactions
+		]
+
+		# transactions for orders that aren't found in Shopify are left out
+		financial_statuses = get_order_financial_statuses(
+			shopify_settings, [row.get("source_order_id") for row in transaction_rows]
+		)
+
+		for row in transaction_rows:
+			shopify_order_id = row.get("source_order_id")
+			if shopify_order_id:
+				order_financial_status = financial_statuses.get(cstr(shopify_order_id))
+				if not order_financial_status:
+					continue
+				row["source_order_financial_status"] = order_financial_status
+
+			payout_doc.append("transactions", row)
 	except Exception as e:
+		payout_doc.set("transactions", [])
+		payout_doc.flags.transactions_error = True
 		payout_doc.save(ignore_permissions=True)
 		make_shopify_log(
 			shop_name=shopify_settings.name,
@@ -225,70 +529,80 @@ def _create_shopify_payout(shopify_settings: "ShopifySettings", payout: "Payouts
 			response_data=payout.to_dict(),
 			exception=e,
 		)
-		return payout_doc
+		return
 
-	payout_doc.set("transactions", [])
-	for transaction in payout_transactions:
-		shopify_order_id = transaction.source_order_id
+	payout_doc.save(ignore_permissions=True)
+	frappe.db.commit()
 
-		order_financial_status = sales_order = sales_invoice = delivery_note = None
-		if shopify_order_id:
-			orders = shopify_settings.get_orders(
-				shopify_order_id, fields="financial_status"
-			)
-			if not orders:
-				continue
-			order = orders[0]
-			order_financial_status = frappe.unscrub(order.financial_status)
-
-			sales_order = get_shopify_document(
-				shop_name=shopify_settings.name,
-				doctype="Sales Order",
-				order_id=shopify_order_id,
-			)
-			sales_invoice = get_shopify_document(
-				shop_name=shopify_settings.name,
-				doctype="Sales Invoice",
-				order_id=shopify_order_id,
-			)
-			delivery_note = get_shopify_document(
-				shop_name=shopify_settings.name,
-				doctype="Delivery Note",
-				order_id=shopify_order_id,
-			)
 
-		total_amount = (
-			-flt(transaction.amount)
-			if transaction.type == "payout"
-			else flt(transaction.amount)
-		)
-		net_amount = (
-			-flt(transaction.net)
-			if transaction.type == "payout"
-			else flt(transaction.net)
-		)
+def get_order_financial_statuses(
+	shopify_settings: "ShopifySettings", shopify_order_ids: List[str]
+) -> Dict[str, str]:
+	"""
+	Request the financial status of many Shopify orders, in batches using the
+	`ids` filter.
 
-		payout_doc.append(
-			"transactions",
-			{
-				"transaction_id": transaction.id,
-				"transaction_type": frappe.unscrub(transaction.type),
-				"processed_at": getdate(transaction.processed_at),
-				"total_amount": total_amount,
-				"fee": flt(transaction.fee),
-				"net_amount": net_amount,
-				"currency": transaction.currency,
-				"sales_order": sales_order.name if sales_order else None,
-				"sales_invoice": sales_invoice.name if sales_invoice else None,
-				"delivery_note": delivery_note.name if delivery_note else None,
-				"source_id": transaction.source_id,
-				"source_type": frappe.unscrub(transaction.source_type or ""),
-				"source_order_financial_status": order_financial_status,
-				"source_order_id": shopify_order_id,
-				"source_order_transaction_id": transaction.source_order_transaction_id,
-			},
+	Args:
+		shopify_settings (ShopifySettings): The Shopify configuration for the store.
+		shopify_order_ids (list of str): The Shopify order IDs.
+
+	Returns:
+		dict: A map of order IDs to their financial status, for orders found in Shopify.
+	"""
+
+	shopify_order_ids = sorted(
+		{cstr(order_id) for order_id in shopify_order_ids if order_id}
+	)
+
+	financial_statuses = {}
+	for batch in create_batches(shopify_order_ids):
+		orders: List["Order"] = shopify_settings.get_orders(
+			ids=",".join(batch),
+			status="any",
+			fields="id,financial_status",
+			limit=SHOPIFY_PAGE_LIMIT,
 		)
 
-	payout_doc.save(ignore_permissions=True)
-	frappe.db.commit()
-	return payout_doc
+		for order in orders:
+			financial_statuses[cstr(order.id)] = frappe.unscrub(order.financial_status)
+
+	return financial_statuses
+
+
+def get_payout_transaction(transaction: "Transactions") -> Dict:
+	"""
+	Build a Shopify Payout Transaction row from Shopify's transaction information.
+	The order's financial status and sales documents are filled in separately,
+	for all transactions at once.
+
+	Args:
+		transaction (Transactions): The payout transaction payload from Shopify.
+
+	Returns:
+		dict: The payout transaction row.
+	"""
+
+	total_amount = (
+		-flt(transaction.amount)
+		if transaction.type == "payout"
+		else flt(transaction.amount)
+	)
+	net_amount = (
+		-flt(transaction.net)
+		if transaction.type == "payout"
+		else flt(transaction.net)
+	)
+
+	return {
+		"transaction_id": transaction.id,
+		"transaction_type": frappe.unscrub(transaction.type),
+		"processed_at": getdate(transaction.processed_at),
+		"total_amount": total_amount,
+		"fee": flt(transaction.fee),
+		"net_amount": net_amount,
+		"currency": transaction.currency,
+		"source_id": transaction.source_id,
+		"source_type": frappe.unscrub(transaction.source_type or ""),
+		"source_order_id": transaction.source_order_id,
+		"source_order_transaction_id": transaction.source_order_transaction_id,
+	}
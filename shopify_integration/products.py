@@ -1,15 +1,39 @@
-from typing import TYPE_CHECKING, Dict, List, Optional, Union
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import (
+	TYPE_CHECKING,
+	Callable,
+	Dict,
+	Iterable,
+	List,
+	Optional,
+	Set,
+	Tuple,
+	Union,
+)
 
 from shopify import Product, Variant
 
 import frappe
 from frappe import _
-from frappe.utils import cint, cstr
+from frappe.utils import cint, cstr, flt, get_datetime, getdate, now_datetime
 
 from shopify_integration.hook_events.item import get_item_alias
+from shopify_integration.item_index import get_item_code_index
 from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
+	get_message,
 	make_shopify_log,
 )
+from shopify_integration.utils import (
+	RELEASE_LOCK_SCRIPT,
+	SHOPIFY_PAGE_LIMIT,
+	create_batches,
+	get_shopify_datetime,
+	get_shopify_settings,
+)
 
 if TYPE_CHECKING:
 	from shopify import LineItem, Option, Order
@@ -23,46 +47,565 @@ if TYPE_CHECKING:
 
 SHOPIFY_VARIANTS_ATTR_LIST = ["option1", "option2", "option3"]
 
+# parent product fields required to sync variants, and the number of
+# parent products to keep in memory during a sync run
+PARENT_PRODUCT_FIELDS = "id,title,image,vendor"
+PRODUCT_CACHE_SIZE = 500
+
+# the number of items to commit together, if not set in the Shopify settings
+DEFAULT_PRODUCT_SYNC_BATCH_SIZE = 100
+
+# parallel product syncs run one job for each page of product IDs
+PARALLEL_SYNC_JOB_KEY = "shopify_product_sync_job_group|{0}"
+PARALLEL_SYNC_TIMEOUT_SECONDS = 60 * 60
+
+# incremental syncs request changed products in windows of this length, and
+# advance the watermark as soon as each window's batches are committed
+INCREMENTAL_SYNC_WINDOW = timedelta(hours=1)
+
+# products that fail to sync don't hold back the watermark; instead, their IDs
+# are kept until a later product sync syncs them successfully
+FAILED_PRODUCTS_KEY = "shopify_failed_product_ids|{0}"
+
+# Suppliers are named by a series, so parallel syncs can't rely on a duplicate
+# entry error to avoid creating the same vendor twice; instead, a missing vendor
+# is locked only while its Supplier is created and committed
+SUPPLIER_LOCK_KEY = "shopify_supplier_lock|{0}"
+SUPPLIER_LOCK_TTL_SECONDS = 60
+SUPPLIER_LOCK_WAIT_SECONDS = 2 * 60
+
+# the number of times to save an Item Attribute that a parallel sync updated
+ITEM_ATTRIBUTE_SAVE_ATTEMPTS = 3
+
 # Weight units gathered from:
 # https://shopify.dev/docs/admin-api/graphql/reference/products-and-collections/weightunit
 WEIGHT_UOM_MAP = {"g": "Gram", "kg": "Kg", "oz": "Ounce", "lb": "Pound"}
 
 
-def sync_items_from_shopify(shop_name: str):
+def sync_all_products():
+	"""
+	Daily hook to sync changed products in all Shopify stores that have been
+	fully synced at least once.
+	"""
+
+	for shop in frappe.get_all(
+		"Shopify Settings",
+		filters={"enable_shopify": True, "last_product_sync_datetime": ["is", "set"]},
+	):
+		shop_doc: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop.name)
+		shop_doc.sync_products(incremental=True)
+
+
+def sync_items_from_shopify(shop_name: str, incremental: bool = False):
 	"""
 	For a given Shopify store, sync all active products and create Item
 	documents for missing products.
 
+	If `incremental` is set, only products changed in Shopify since the last
+	product sync are requested, and their existing items are updated as well.
+
 	:param shop_name: The name of the Shopify configuration for the store
+	:param incremental: (optional) Only sync products changed since the last sync,
+		defaults to False
 	"""
 
 	frappe.set_user("Administrator")
 	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
 
-	try:
-		products = shopify_settings.get_products(status="active")
-	except Exception as e:
-		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
+	# products changed while the sync is running are picked up by the next sync
+	sync_started_at = now_datetime()
+
+	if incremental and shopify_settings.last_product_sync_datetime:
+		try:
+			sync_failed_products(shop_name)
+			sync_changed_products(shopify_settings, sync_started_at)
+		except Exception as e:
+			make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
 		return
 
-	product: Product
-	for product in products:
+	# stream products and variants page by page, so that only a single page
+	# of the catalog is held in memory at any time
+	products = shopify_settings.get_products(status="active", stream=True)
+
+	def sync_product_item(product: Product):
 		if has_variants(product):
 			# if template/variant creation is disabled, don't create parent items
 			if shopify_settings.create_variant_items:
-				make_item(shopify_settings, product)
+				make_item(shopify_settings, product, commit=False)
 		else:
-			make_item(shopify_settings, product)
+			make_item(shopify_settings, product, commit=False)
 
 	try:
-		variants = shopify_settings.get_variants(status="active")
+		sync_in_batches(shopify_settings, products, sync_product_item)
 	except Exception as e:
 		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
 		return
 
-	for variant in variants:
-		variant: Variant
-		make_item(shopify_settings, variant)
+	variants = shopify_settings.get_variants(status="active", stream=True)
+
+	try:
+		sync_in_batches(
+			shopify_settings,
+			variants,
+			lambda variant: make_item(shopify_settings, variant, commit=False),
+		)
+	except Exception as e:
+		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
+		return
+
+	update_product_sync_datetime(shop_name, sync_started_at)
+
+
+def sync_changed_products(shopify_settings: "ShopifySettings", sync_until: str):
+	"""
+	Sync the products changed since the store's product sync watermark, and update
+	their existing items.
+
+	Shopify doesn't list products in the order they were changed, so changed
+	products are requested in time windows instead, and the watermark advances
+	to the end of each window once its batches are committed. An interrupted
+	sync then resumes from the last committed window.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param sync_until: The time the product sync was started
+	"""
+
+	window_start = get_datetime(shopify_settings.last_product_sync_datetime)
+	sync_until = get_datetime(sync_until)
+
+	while window_start < sync_until:
+		window_end = min(window_start + INCREMENTAL_SYNC_WINDOW, sync_until)
+		products = shopify_settings.get_products(
+			status="active",
+			updated_at_min=get_shopify_datetime(window_start),
+			updated_at_max=get_shopify_datetime(window_end),
+			stream=True,
+		)
+
+		sync_in_batches(
+			shopify_settings,
+			products,
+			lambda product: sync_product(
+				shopify_settings, product, update=True, commit=False
+			),
+		)
+
+		update_product_sync_datetime(shopify_settings.name, window_end)
+		window_start = window_end
+
+
+def sync_failed_products(shop_name: str):
+	"""
+	Sync the products that failed to sync in earlier product syncs again, and
+	update their existing items.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	"""
+
+	product_ids = get_failed_product_ids(shop_name)
+	if product_ids:
+		sync_products_by_ids(shop_name, list(product_ids), update=True)
+
+
+def start_parallel_product_sync(shop_name: str, incremental: bool = False):
+	"""
+	For a given Shopify store, split the product sync into a job for each page of
+	active products, so that the pages can be synced in parallel by separate
+	workers. All jobs share the store's API rate limit, and the last job to
+	finish completes the sync.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param incremental: (optional) Only sync products changed since the last sync,
+		defaults to False
+	"""
+
+	from shopify_integration.jobs import enqueue_job_group
+
+	frappe.set_user("Administrator")
+	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
+
+	# products changed while the sync is running are picked up by the next sync
+	sync_started_at = now_datetime()
+
+	filters = {"status": "active"}
+	update = False
+	if incremental and shopify_settings.last_product_sync_datetime:
+		filters["updated_at_min"] = get_shopify_datetime(
+			shopify_settings.last_product_sync_datetime
+		)
+		update = True
+
+	try:
+		products: Iterable[Product] = shopify_settings.get_products(
+			fields="id", page_size=SHOPIFY_PAGE_LIMIT, stream=True, **filters
+		)
+		product_ids = [cstr(product.id) for product in products]
+	except Exception as e:
+		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
+		return
+
+	# products that failed to sync before are synced again along with them
+	product_ids.extend(get_failed_product_ids(shop_name).difference(product_ids))
+
+	group_id = enqueue_job_group(
+		jobs=[
+			{
+				"method": "shopify_integration.products.sync_products_by_ids",
+				"shop_name": shop_name,
+				"product_ids": batch,
+				"update": update,
+			}
+			for batch in create_batches(product_ids)
+		],
+		on_complete="shopify_integration.products.complete_parallel_product_sync",
+		timeout=PARALLEL_SYNC_TIMEOUT_SECONDS,
+		shop_name=shop_name,
+		sync_started_at=str(sync_started_at),
+	)
+
+	frappe.cache().set_value(PARALLEL_SYNC_JOB_KEY.format(shop_name), group_id)
+
+
+def sync_products_by_ids(shop_name: str, product_ids: List[str], update: bool = False):
+	"""
+	Sync a page of Shopify products, along with their variants, as part of a
+	parallel product sync.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param product_ids: The Shopify product IDs
+	:param update: (optional) Set if existing items should be updated, defaults to False
+	"""
+
+	frappe.set_user("Administrator")
+	shopify_settings = get_shopify_settings(shop_name)
+
+	products = get_products_by_ids(shopify_settings, set(product_ids))
+
+	# products deleted from Shopify since can't be synced again
+	remove_failed_products(
+		shop_name, set(product_ids).difference(cstr(product.id) for product in products)
+	)
+
+	# failed items are logged individually and synced again by the next sync
+	sync_in_batches(
+		shopify_settings,
+		products,
+		lambda product: sync_product(
+			shopify_settings, product, update=update, commit=False
+		),
+	)
+
+
+def complete_parallel_product_sync(
+	shop_name: str, sync_started_at: str, job_group: str
+):
+	"""
+	Report the result of a parallel product sync, once all of its jobs are done,
+	and advance the product sync watermark if none of the jobs failed. Products
+	that failed to sync within a job don't fail it, since they are retried.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param sync_started_at: The time the product sync was started
+	:param job_group: The ID of the sync's job group
+	"""
+
+	from shopify_integration.jobs import get_job_group_progress
+
+	progress = get_job_group_progress(job_group)
+	if progress.get("failed"):
+		make_shopify_log(
+			shop_name,
+			status="Error",
+			message=_("{0} of {1} product sync jobs failed").format(
+				progress.get("failed"), progress.get("total")
+			),
+		)
+		return
+
+	update_product_sync_datetime(shop_name, sync_started_at)
+	make_shopify_log(
+		shop_name,
+		status="Success",
+		message=_("Product sync completed in {0} jobs").format(progress.get("total")),
+	)
+
+
+def get_product_sync_progress(shop_name: str) -> Optional[Dict[str, int]]:
+	"""
+	Get the progress of the last parallel product sync for a Shopify store.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:return: The total, remaining and failed number of sync jobs, if any sync
+		is being tracked
+	"""
+
+	from shopify_integration.jobs import get_job_group_progress
+
+	group_id = frappe.cache().get_value(PARALLEL_SYNC_JOB_KEY.format(shop_name))
+	if not group_id:
+		return
+
+	return get_job_group_progress(group_id)
+
+
+def sync_in_batches(
+	shopify_settings: "ShopifySettings",
+	shopify_items: Iterable[Union[Product, Variant]],
+	sync_method: Callable[[Union[Product, Variant]], None],
+	commit: bool = True,
+) -> int:
+	"""
+	Sync Shopify products or variants, and commit the synced items in batches
+	instead of one transaction per item.
+
+	Each item is synced within its own savepoint, so that an item that fails
+	to sync is rolled back and logged without affecting the rest of its batch.
+	Once a batch is committed, the products of its failed items are kept, so
+	that they are synced again by the next product sync.
+	New attribute values of the products in a batch are saved together first,
+	so that each Item Attribute is saved at most once per batch.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param shopify_items: The Shopify `Product` or `Variant` data
+	:param sync_method: The method to sync a single Shopify item
+	:param commit: (optional) Set if batches should be committed; otherwise, the
+		caller commits the synced items and handles failed items, defaults to True
+	:return: The number of items that failed to sync
+	"""
+
+	batch_size = (
+		cint(shopify_settings.product_sync_batch_size)
+		or DEFAULT_PRODUCT_SYNC_BATCH_SIZE
+	)
+
+	item_prices = get_item_price_queue(shopify_settings.name)
+
+	failed_items = 0
+	for batch in create_batches(shopify_items, batch_size):
+		failed_product_ids = set()
+
+		# new Suppliers and attribute values are committed as soon as they are
+		# saved, so they can only be saved between batches that are committed here
+		if commit:
+			create_batch_suppliers(shopify_settings, batch)
+
+			if shopify_settings.create_variant_items:
+				create_batch_attribute_values(
+					[product for product in batch if isinstance(product, Product)]
+				)
+
+		for shopify_item in batch:
+			# savepoints need unique names, since syncs can be nested for variants
+			save_point = f"shopify_item_{shopify_item.id}"
+			frappe.db.savepoint(save_point)
+			queued_prices = len(item_prices)
+
+			try:
+				sync_method(shopify_item)
+			except Exception as e:
+				frappe.db.rollback(save_point=save_point)
+				# attributes and masters saved by the failed item are rolled back too
+				clear_sync_caches()
+				del item_prices[queued_prices:]
+
+				# logging commits the transaction, which would release the
+				# caller's savepoints, so let the caller handle the failure
+				if not commit:
+					raise
+
+				failed_items += 1
+				failed_product_ids.add(get_shopify_product_id(shopify_item))
+				make_shopify_log(
+					shopify_settings.name,
+					status="Error",
+					message=(
+						f"Failed to sync Shopify {type(shopify_item).__name__.lower()} "
+						f"'{shopify_item.id}': {get_message(e)}"
+					),
+					response_data=shopify_item.to_dict(),
+					exception=e,
+				)
+
+		if commit:
+			write_item_prices(shopify_settings)
+			frappe.db.commit()
+
+			# products are only considered synced once their batch is committed
+			remove_failed_products(
+				shopify_settings.name,
+				{
+					cstr(shopify_item.id)
+					for shopify_item in batch
+					if isinstance(shopify_item, Product)
+				}
+				- failed_product_ids,
+			)
+			add_failed_products(shopify_settings.name, failed_product_ids)
+
+	return failed_items
+
+
+def get_shopify_product_id(shopify_item: Union[Product, Variant]) -> str:
+	if isinstance(shopify_item, Product):
+		return cstr(shopify_item.id)
+
+	# nested variants carry their product ID in the prefix options instead
+	return cstr(
+		shopify_item.attributes.get("product_id")
+		or shopify_item._prefix_options.get("product_id")
+	)
+
+
+def get_failed_product_ids(shop_name: str) -> Set[str]:
+	"""
+	Get the IDs of the products that failed to sync in earlier product syncs.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:return: The Shopify product IDs
+	"""
+
+	return {
+		cstr(product_id)
+		for product_id in frappe.cache().smembers(FAILED_PRODUCTS_KEY.format(shop_name))
+	}
+
+
+def add_failed_products(shop_name: str, product_ids: Set[str]):
+	product_ids.discard("")
+	if product_ids:
+		frappe.cache().sadd(FAILED_PRODUCTS_KEY.format(shop_name), *product_ids)
+
+
+def remove_failed_products(shop_name: str, product_ids: Set[str]):
+	if product_ids:
+		frappe.cache().srem(FAILED_PRODUCTS_KEY.format(shop_name), *product_ids)
+
+
+def update_product_sync_datetime(shop_name: str, sync_datetime: str):
+	"""
+	Advance the store's product sync watermark. This should only be called once
+	the items synced up to it have been committed; items that failed to sync
+	don't hold it back, since their products are synced again by the next sync.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param sync_datetime: The time the product sync was started
+	"""
+
+	frappe.db.set_value(
+		"Shopify Settings", shop_name, "last_product_sync_datetime", sync_datetime
+	)
+	frappe.clear_document_cache("Shopify Settings", shop_name)
+	frappe.db.commit()
+
+
+def sync_product(
+	shopify_settings: "ShopifySettings",
+	product: Product,
+	update: bool = False,
+	commit: bool = True,
+):
+	"""
+	Sync a single Shopify product along with all of its variants.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param product: The Shopify product data, including its variants
+	:param update: (optional) Set if existing items should be updated, defaults to False
+	:param commit: (optional) Set if synced items should be committed, defaults to True
+	"""
+
+	# avoid refetching the parent product for each of its variants
+	cache_product(shopify_settings, product)
+
+	if has_variants(product):
+		# template items sync their variant items along with them; if
+		# template/variant creation is disabled, don't create parent items
+		if shopify_settings.create_variant_items:
+			make_item(shopify_settings, product, update=update, commit=commit)
+			return
+	else:
+		make_item(shopify_settings, product, update=update, commit=commit)
+
+	variant: Variant
+	for variant in product.attributes.get("variants", []):
+		# nested variants don't carry the product ID in their attributes
+		variant.attributes.setdefault("product_id", product.id)
+		make_item(shopify_settings, variant, update=update, commit=commit)
+
+
+def sync_shopify_product(shop_name: str, product_id: str, log_id: str = str()):
+	"""
+	Webhook handler for product creates and updates, to sync a single Shopify
+	product along with its variants. Items for products that are no longer
+	active in Shopify are marked as disabled on Shopify instead.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param product_id: The Shopify product ID
+	:param log_id: (optional) The ID of an existing Shopify Log
+	"""
+
+	frappe.set_user("Administrator")
+	frappe.flags.log_id = log_id
+
+	shopify_settings = get_shopify_settings(shop_name)
+
+	try:
+		products: List[Product] = shopify_settings.get_products(product_id)
+		product = products[0] if products else None
+
+		if not product or product.attributes.get("status") != "active":
+			disable_product_items(product_id)
+			make_shopify_log(
+				shop_name,
+				status="Success",
+				message=f"Items for Shopify product '{product_id}' disabled",
+			)
+			return
+
+		sync_product(shopify_settings, product, update=True)
+	except Exception as e:
+		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
+	else:
+		make_shopify_log(shop_name, status="Success", response_data=product.to_dict())
+
+
+def delete_shopify_product(shop_name: str, product_id: str, log_id: str = str()):
+	"""
+	Webhook handler for product deletes, to disable the Items created for the
+	Shopify product and its variants.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param product_id: The Shopify product ID
+	:param log_id: (optional) The ID of an existing Shopify Log
+	"""
+
+	frappe.set_user("Administrator")
+	frappe.flags.log_id = log_id
+
+	disable_product_items(product_id)
+	make_shopify_log(
+		shop_name,
+		status="Success",
+		message=f"Items for Shopify product '{product_id}' disabled",
+	)
+
+
+def disable_product_items(product_id: str):
+	"""
+	Mark all Items for a Shopify product, including its variants, as disabled
+	on Shopify. Syncing the product again re-enables them.
+
+	The sync hash is cleared as well, since the product's data is unchanged if
+	it is reactivated, and the items would otherwise be skipped.
+
+	:param product_id: The Shopify product ID
+	"""
+
+	frappe.db.set_value(
+		"Item",
+		{"shopify_product_id": cstr(product_id)},
+		{"disabled_on_shopify": True, "shopify_sync_hash": None},
+	)
+	frappe.db.commit()
 
 
 def validate_items(shop_name: str, shopify_order: "Order"):
@@ -74,95 +617,185 @@ def validate_items(shop_name: str, shopify_order: "Order"):
 	- Variant ID
 	- Item Title
 
+	All products and variants missing from ERPNext are gathered up front and
+	requested from Shopify in batches, instead of once for every line item.
+
 	:param shop_name: The name of the Shopify configuration for the store
 	:param shopify_order: The Shopify order data
 	"""
 
-	shopify_settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
-	for shopify_item in shopify_order.attributes.get("line_items", []):
-		shopify_item: "LineItem"
+	shopify_settings = get_shopify_settings(shop_name)
+	line_items: List["LineItem"] = shopify_order.attributes.get("line_items", [])
 
-		product_id = shopify_item.attributes.get("product_id")
-		if product_id and not frappe.db.exists(
-			"Item", {"shopify_product_id": product_id}
-		):
-			shopify_products: List[Product] = shopify_settings.get_products(product_id)
-			for product in shopify_products:
-				if has_variants(product):
-					if shopify_settings.create_variant_items:
-						# create the parent product item if it does not exist, and if template/variants
-						# is enabled in the Shopify settings instance
-						make_item(shopify_settings, product)
-				else:
-					make_item(shopify_settings, product)
-
-		# create the child variant item if it does not exist
-		variant_id = shopify_item.attributes.get("variant_id")
-		if variant_id and not frappe.db.exists(
-			"Item", {"shopify_variant_id": variant_id}
-		):
-			shopify_variants: List[Variant] = shopify_settings.get_variants(variant_id)
-			for variant in shopify_variants:
-				make_item(shopify_settings, variant)
-
-		# Shopify somehow allows non-existent products to be added to an order;
-		# for such cases, we create the item using the line item"s title
-		if not (product_id or variant_id):
-			line_item_title = shopify_item.attributes.get("title", "").strip()
-			if line_item_title and not frappe.db.exists(
-				"Item", {"item_code": line_item_title}
-			):
-				shopify_products: List[Product] = shopify_settings.get_products(
-					title=shopify_item.attributes.get("title")
-				)
+	product_ids = {
+		cstr(line_item.attributes.get("product_id"))
+		for line_item in line_items
+		if line_item.attributes.get("product_id")
+	}
+	variant_ids = {
+		cstr(line_item.attributes.get("variant_id"))
+		for line_item in line_items
+		if line_item.attributes.get("variant_id")
+	}
 
-				if not shopify_products:
-					make_item_by_title(shopify_settings, line_item_title)
-					return
+	missing_product_ids = product_ids - get_existing_item_keys(
+		"shopify_product_id", product_ids
+	)
+	missing_variant_ids = variant_ids - get_existing_item_keys(
+		"shopify_variant_id", variant_ids
+	)
 
-				for product in shopify_products:
-					make_item(shopify_settings, product)
+	# missing variants are fetched along with their parent products
+	variant_product_ids = {
+		cstr(line_item.attributes.get("product_id"))
+		for line_item in line_items
+		if line_item.attributes.get("product_id")
+		and cstr(line_item.attributes.get("variant_id")) in missing_variant_ids
+	}
 
+	shopify_products = get_products_by_ids(
+		shopify_settings, missing_product_ids | variant_product_ids
+	)
+
+	# avoid refetching the parent products while syncing their variants
+	for product in shopify_products:
+		cache_product(shopify_settings, product)
 
-def get_item_code(shopify_item: "LineItem") -> Optional[str]:
-	item_code = get_item_alias(shopify_item)
+	for product in shopify_products:
+		if cstr(product.id) not in missing_product_ids:
+			continue
+
+		if has_variants(product):
+			if shopify_settings.create_variant_items:
+				# create the parent product item if it does not exist, and if
+				# template/variants is enabled in the Shopify settings instance
+				make_item(shopify_settings, product)
+		else:
+			make_item(shopify_settings, product)
 
-	if not item_code:
-		item_code = frappe.db.get_value(
-			"Item", shopify_item.attributes.get("sku"), "item_code"
+	# create the child variant items that still don't exist,
+	# since template items also create their variants
+	missing_variant_ids -= get_existing_item_keys(
+		"shopify_variant_id", missing_variant_ids
+	)
+	for product in shopify_products:
+		variant: Variant
+		for variant in product.attributes.get("variants", []):
+			if cstr(variant.id) not in missing_variant_ids:
+				continue
+
+			# nested variants don't carry the product ID in their attributes
+			variant.attributes.setdefault("product_id", product.id)
+			make_item(shopify_settings, variant)
+			missing_variant_ids.discard(cstr(variant.id))
+
+	# variants without a known parent product are requested individually
+	for variant_id in missing_variant_ids:
+		shopify_variants: List[Variant] = shopify_settings.get_variants(variant_id)
+		for variant in shopify_variants:
+			make_item(shopify_settings, variant)
+
+	# Shopify somehow allows non-existent products to be added to an order;
+	# for such cases, we create the item using the line item"s title
+	line_item_titles = {
+		line_item.attributes.get("title", "").strip()
+		for line_item in line_items
+		if not (
+			line_item.attributes.get("product_id")
+			or line_item.attributes.get("variant_id")
 		)
+	}
+	line_item_titles.discard("")
+
+	missing_titles = line_item_titles - get_existing_item_keys(
+		"item_code", line_item_titles
+	)
+	for line_item_title in missing_titles:
+		shopify_products: List[Product] = shopify_settings.get_products(
+			title=line_item_title
+		)
+
+		if not shopify_products:
+			make_item_by_title(shopify_settings, line_item_title)
+			continue
+
+		for product in shopify_products:
+			make_item(shopify_settings, product)
+
+
+def get_existing_item_keys(fieldname: str, values: Set[str]) -> Set[str]:
+	"""
+	Check which of the given values already exist for a field in Item documents.
+
+	:param fieldname: The Item field to check against
+	:param values: The values to check
+	:return: The values that exist in at least one Item
+	"""
+
+	if not values:
+		return set()
+
+	existing_values = frappe.get_all(
+		"Item",
+		filters={fieldname: ["in", list(values)]},
+		pluck=fieldname,
+		distinct=True,
+	)
+
+	return {cstr(value) for value in existing_values}
+
+
+def get_products_by_ids(
+	shopify_settings: "ShopifySettings", product_ids: Set[str]
+) -> List[Product]:
+	"""
+	Request Shopify products in batches, using the `ids` filter.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param product_ids: The Shopify product IDs
+	:return: The Shopify products found for the IDs
+	"""
+
+	products = []
+	for batch in create_batches(sorted(product_ids)):
+		products.extend(
+			shopify_settings.get_products(ids=",".join(batch), limit=SHOPIFY_PAGE_LIMIT)
+		)
+	return products
+
+
+def get_item_code(shopify_item: "LineItem", shop_name: str = str()) -> Optional[str]:
+	"""
+	Get the Item code for a Shopify line item.
+
+	:param shopify_item: The Shopify line item
+	:param shop_name: (optional) The name of the Shopify configuration for the store
+	:return: The matching Item code, if any
+	"""
 
-	if not item_code:
-		item_code = frappe.db.get_value(
-			"Item", {"shopify_sku": shopify_item.attributes.get("sku")}, "item_code"
-		)
+	return get_item_codes([shopify_item], shop_name)[0]
 
-	if not item_code:
-		item_code = frappe.db.get_value(
-			"Item",
-			{"shopify_variant_id": shopify_item.attributes.get("variant_id")},
-			"item_code",
-		)
 
-	if not item_code:
-		item_code = frappe.db.get_value(
-			"Item",
-			{"shopify_product_id": shopify_item.attributes.get("product_id")},
-			"item_code",
-		)
+def get_item_codes(
+	shopify_items: List["LineItem"], shop_name: str = str()
+) -> List[Optional[str]]:
+	"""
+	Get the Item codes for a list of Shopify line items, resolving all of them
+	together through the store's item code index.
 
-	if not item_code:
-		item_code = frappe.db.get_value(
-			"Item",
-			{"item_name": shopify_item.attributes.get("title", "").strip()},
-			"item_code",
-		)
+	:param shopify_items: The Shopify line items
+	:param shop_name: (optional) The name of the Shopify configuration for the store
+	:return: The matching Item code for each line item, in the same order
+	"""
 
-	return item_code
+	return get_item_code_index(shop_name).get_item_codes(shopify_items)
 
 
 def make_item(
-	shopify_settings: "ShopifySettings", shopify_item: Union[Product, Variant]
+	shopify_settings: "ShopifySettings",
+	shopify_item: Union[Product, Variant],
+	update: bool = False,
+	commit: bool = True,
 ):
 	if shopify_settings.create_variant_items:
 		attributes = []
@@ -170,10 +803,14 @@ def make_item(
 			attributes = create_product_attributes(shopify_item)
 
 		if attributes:
-			sync_item(shopify_settings, shopify_item, attributes)
-			sync_item_variants(shopify_settings, shopify_item, attributes)
+			sync_item(
+				shopify_settings, shopify_item, attributes, update=update, commit=commit
+			)
+			sync_item_variants(
+				shopify_settings, shopify_item, attributes, commit=commit
+			)
 		else:
-			sync_item(shopify_settings, shopify_item)
+			sync_item(shopify_settings, shopify_item, update=update, commit=commit)
 	else:
 		# if template/variant creation is disabled, only create variant items
 		if any(
@@ -182,7 +819,7 @@ def make_item(
 				isinstance(shopify_item, Variant),
 			]
 		):
-			sync_item(shopify_settings, shopify_item)
+			sync_item(shopify_settings, shopify_item, update=update, commit=commit)
 
 
 def make_item_by_title(shopify_settings: "ShopifySettings", line_item_title: str):
@@ -219,35 +856,193 @@ def create_product_attributes(shopify_item: Product) -> List[Dict]:
 		attribute_option_name = attribute_option.attributes.get("name")
 		attribute_option_values = attribute_option.attributes.get("values") or []
 
-		if not frappe.db.exists("Item Attribute", attribute_option_name):
+		item_attr_values = get_item_attribute_values(attribute_option_name)
+
+		if not item_attr_values:
 			item_attr: "ItemAttribute" = frappe.new_doc("Item Attribute")
 			item_attr.attribute_name = attribute_option_name
 			update_item_attribute_values(item_attr, attribute_option_values)
 			item_attr.insert()
+			cache_item_attribute_values(item_attr)
+			item_attributes.append({"attribute": attribute_option_name})
+		elif not item_attr_values.numeric_values:
+			# only save the attribute if the product has new values
+			new_values = [
+				value
+				for value in attribute_option_values
+				if value.lower() not in item_attr_values.values
+			]
+
+			if new_values:
+				item_attr: "ItemAttribute" = frappe.get_doc(
+					"Item Attribute", attribute_option_name
+				)
+				update_item_attribute_values(item_attr, new_values)
+				item_attr.save()
+				cache_item_attribute_values(item_attr)
+
 			item_attributes.append({"attribute": attribute_option_name})
 		else:
-			# check for attribute values
-			item_attr: "ItemAttribute" = frappe.get_doc(
-				"Item Attribute", attribute_option_name
+			item_attributes.append(
+				{
+					"attribute": attribute_option_name,
+					"from_range": item_attr_values.from_range,
+					"to_range": item_attr_values.to_range,
+					"increment": item_attr_values.increment,
+					"numeric_values": item_attr_values.numeric_values,
+				}
 			)
-			if not item_attr.numeric_values:
-				update_item_attribute_values(item_attr, attribute_option_values)
-				item_attr.save()
-				item_attributes.append({"attribute": attribute_option_name})
-			else:
-				item_attributes.append(
-					{
-						"attribute": attribute_option_name,
-						"from_range": item_attr.get("from_range"),
-						"to_range": item_attr.get("to_range"),
-						"increment": item_attr.get("increment"),
-						"numeric_values": item_attr.get("numeric_values"),
-					}
-				)
 
 	return item_attributes
 
 
+def create_batch_attribute_values(products: List[Product]):
+	"""
+	Save the new option values of a batch of Shopify products, so that each Item
+	Attribute is saved once for the batch, instead of once for every product that
+	brings new values.
+
+	Variant items need their values to exist before they're created, so values
+	can't be deferred past the batch that uses them. Each Item Attribute is saved
+	and committed on its own, so that parallel syncs don't wait on its row lock
+	while they sync their items. If a parallel sync saved the attribute first,
+	it's reloaded and saved again; if it still can't be saved, each product
+	saves its own values instead.
+
+	This commits the current transaction, so it should only be called between
+	batches.
+
+	:param products: The Shopify product data
+	"""
+
+	# map each attribute to its option values, keyed by their lowercase names
+	option_values: Dict[str, Tuple[str, Dict[str, str]]] = {}
+	for product in products:
+		if not has_variants(product):
+			continue
+
+		for attribute_option in product.attributes.get("options"):
+			attribute_option: "Option"
+			attribute_name = attribute_option.attributes.get("name")
+			_name, values = option_values.setdefault(
+				attribute_name.lower(), (attribute_name, {})
+			)
+
+			for value in attribute_option.attributes.get("values") or []:
+				values.setdefault(value.lower(), value)
+
+	if not option_values:
+		return
+
+	for attribute_name, values in option_values.values():
+		for _attempt in range(ITEM_ATTRIBUTE_SAVE_ATTEMPTS):
+			try:
+				save_item_attribute_values(attribute_name, list(values.values()))
+				frappe.db.commit()
+				break
+			except Exception as e:
+				# reload the attribute in a new transaction before trying again
+				frappe.db.rollback()
+				get_item_attribute_cache().pop(attribute_name.lower(), None)
+
+				if not is_concurrent_update(e):
+					break
+
+
+def save_item_attribute_values(attribute_name: str, values: List[str]):
+	"""
+	Add any missing option values to an Item Attribute, or create the attribute
+	if it doesn't exist yet.
+
+	:param attribute_name: The name of the Item Attribute
+	:param values: The option values from Shopify
+	"""
+
+	item_attr_values = get_item_attribute_values(attribute_name)
+	if not item_attr_values:
+		item_attr: "ItemAttribute" = frappe.new_doc("Item Attribute")
+		item_attr.attribute_name = attribute_name
+		update_item_attribute_values(item_attr, values)
+		item_attr.insert()
+		cache_item_attribute_values(item_attr)
+		return
+
+	if item_attr_values.numeric_values:
+		return
+
+	new_values = [
+		value for value in values if value.lower() not in item_attr_values.values
+	]
+
+	if new_values:
+		item_attr: "ItemAttribute" = frappe.get_doc("Item Attribute", attribute_name)
+		update_item_attribute_values(item_attr, new_values)
+		item_attr.save()
+		cache_item_attribute_values(item_attr)
+
+
+def is_concurrent_update(exception: Exception) -> bool:
+	# the document was saved or locked by a parallel sync first
+	return (
+		isinstance(
+			exception, (frappe.TimestampMismatchError, frappe.DuplicateEntryError)
+		)
+		or frappe.db.is_deadlocked(exception)
+		or frappe.db.is_timedout(exception)
+	)
+
+
+def get_item_attribute_values(attribute_name: str) -> Optional[frappe._dict]:
+	"""
+	Get an Item Attribute's settings and values, which are loaded once per sync
+	run, since products mostly share the same few attributes.
+
+	:param attribute_name: The name of the Item Attribute
+	:return: The attribute's numeric settings, along with maps of its lowercase
+		values and abbreviations to their values, or None if the attribute
+		doesn't exist
+	"""
+
+	attribute_cache = get_item_attribute_cache()
+	if attribute_name.lower() not in attribute_cache:
+		if not frappe.db.exists("Item Attribute", attribute_name):
+			return
+
+		cache_item_attribute_values(frappe.get_doc("Item Attribute", attribute_name))
+
+	return attribute_cache.get(attribute_name.lower())
+
+
+def cache_item_attribute_values(item_attr: "ItemAttribute"):
+	attribute_cache = get_item_attribute_cache()
+	attribute_cache[item_attr.name.lower()] = frappe._dict(
+		{
+			"numeric_values": item_attr.get("numeric_values"),
+			"from_range": item_attr.get("from_range"),
+			"to_range": item_attr.get("to_range"),
+			"increment": item_attr.get("increment"),
+			"values": {
+				cstr(value.attribute_value).lower(): value.attribute_value
+				for value in item_attr.item_attribute_values
+			},
+			"abbrs": {
+				cstr(value.abbr).lower(): value.attribute_value
+				for value in item_attr.item_attribute_values
+			},
+		}
+	)
+
+
+def get_item_attribute_cache() -> Dict[str, frappe._dict]:
+	# the local cache is cleared for every request and background job,
+	# so the attribute cache lives for the duration of a single sync run
+	return frappe.local_cache("shopify_item_attribute_cache", "attributes", dict)
+
+
+def clear_item_attribute_cache():
+	get_item_attribute_cache().clear()
+
+
 def has_variants(product: Product):
 	# Shopify creates a product variant for ALL products, whether they actually
 	# have variants or not; the only way to tell if a product has variants is
@@ -283,6 +1078,7 @@ def sync_item(
 	attributes: List[Dict] = None,
 	variant_of: str = str(),
 	update: bool = False,
+	commit: bool = True,
 ):
 	"""
 	Sync a Shopify product or variant and create a new Item document. If `update` is set
@@ -293,6 +1089,8 @@ def sync_item(
 	:param attributes: The item attributes for the Shopify item, defaults to None
 	:param variant_of: (optional) If the item is a variant of an existing Item, defaults to an empty string
 	:param update: (optional) Set if existing items should be updated, defaults to False
+	:param commit: (optional) Set if the synced item should be committed,
+		defaults to True
 	"""
 
 	product_id = variant_id = item_name = None
@@ -312,13 +1110,14 @@ def sync_item(
 			item_name = f"{product_name} - {item_title}"
 		else:
 			# TODO: should we check if the product exists on Shopify?
-			products = shopify_settings.get_products(product_id, fields="title")
-			if products:
-				item_name = f"{products[0].title} - {item_title}"
+			product = get_parent_product(shopify_settings, shopify_item)
+			if product:
+				item_name = f"{product.attributes.get('title')} - {item_title}"
 
 	item_alias = get_item_alias(shopify_item)
 	item_code = cstr(item_alias or shopify_sku or variant_id or product_id or item_name)
 	item_description = shopify_item.attributes.get("body_html")
+	item_image = get_item_image(shopify_settings, shopify_item)
 	item_has_variants = (
 		has_variants(shopify_item) if shopify_settings.create_variant_items else False
 	)
@@ -360,9 +1159,32 @@ def sync_item(
 		for attribute in attributes:
 			attribute.update({"variant_of": variant_of})
 
+	# items are synced again when their prices start being written to
+	# another price list, so that the new price list gets their prices
+	price_list = None
+	if shopify_settings.update_price_in_erpnext_price_list:
+		price_list = shopify_settings.price_list
+
+	sync_hash = get_item_sync_hash(
+		item_data, attributes, item_image, get_item_rate(shopify_item), price_list
+	)
+	item_data["shopify_sync_hash"] = sync_hash
+
 	new_item_code = None
-	if frappe.db.exists("Item", item_data.get("item_code")):
-		if update:
+	existing_item = frappe.db.get_value(
+		"Item",
+		item_data.get("item_code"),
+		["name", "shopify_sync_hash", "disabled_on_shopify"],
+		as_dict=True,
+	)
+
+	if existing_item:
+		# skip loading and saving items that haven't changed on Shopify,
+		# unless they need to be re-enabled
+		if update and (
+			existing_item.disabled_on_shopify
+			or existing_item.shopify_sync_hash != sync_hash
+		):
 			new_item_code = update_item(
 				shopify_settings,
 				shopify_item,
@@ -382,7 +1204,43 @@ def sync_item(
 	):
 		add_to_price_list(shopify_settings, shopify_item, new_item_code)
 
-	frappe.db.commit()
+	if commit:
+		write_item_prices(shopify_settings)
+		frappe.db.commit()
+
+
+def get_item_sync_hash(
+	item_data: Dict,
+	attributes: Optional[List[Dict]] = None,
+	image: Optional[str] = None,
+	rate: float = 0,
+	price_list: Optional[str] = None,
+) -> str:
+	"""
+	Fingerprint the Shopify data that is synced into an Item, so that unchanged
+	items can be skipped during syncs.
+
+	:param item_data: The Item fields mapped from the Shopify item
+	:param attributes: (optional) The item attributes for the Shopify item
+	:param image: (optional) The image URL for the Shopify item
+	:param rate: (optional) The price of the Shopify item
+	:param price_list: (optional) The price list that the item's price is written to
+	:return: A hash of the synced Shopify data
+	"""
+
+	sync_data = {
+		"item": {
+			key: value for key, value in item_data.items() if key != "shopify_sync_hash"
+		},
+		"attributes": attributes or [],
+		"image": image,
+		"rate": cstr(rate),
+		"price_list": price_list,
+	}
+
+	return hashlib.sha1(
+		json.dumps(sync_data, sort_keys=True, default=cstr).encode("utf-8")
+	).hexdigest()
 
 
 def update_item(
@@ -458,6 +1316,7 @@ def sync_item_variants(
 	shopify_settings: "ShopifySettings",
 	shopify_item: Union[Product, Variant],
 	attributes: List[Dict],
+	commit: bool = True,
 ):
 	product_id = None
 	if isinstance(shopify_item, Product):
@@ -476,8 +1335,11 @@ def sync_item_variants(
 	)
 
 	if template_item:
-		variant: Variant
-		for variant in shopify_item.attributes.get("variants", []):
+		# avoid refetching the parent product for each of its variants
+		if isinstance(shopify_item, Product):
+			cache_product(shopify_settings, shopify_item)
+
+		def sync_variant(variant: Variant):
 			for index, variant_attr in enumerate(SHOPIFY_VARIANTS_ATTR_LIST):
 				if index < len(attributes) and variant.attributes.get(variant_attr):
 					attributes[index].update(
@@ -495,41 +1357,57 @@ def sync_item_variants(
 				attributes=attributes,
 				variant_of=template_item.name,
 				update=True,
+				commit=False,
 			)
 
+		sync_in_batches(
+			shopify_settings,
+			shopify_item.attributes.get("variants", []),
+			sync_variant,
+			commit=commit,
+		)
+
 
 def get_attribute_value(variant_attr_val: str, attribute: Dict = None):
 	if not attribute or not attribute.get("attribute"):
 		return cint(variant_attr_val)
 
-	attribute_values = frappe.get_all(
-		"Item Attribute Value",
-		filters={"parent": attribute.get("attribute")},
-		or_filters={"abbr": variant_attr_val, "attribute_value": variant_attr_val},
-		pluck="attribute_value",
-	)
-
-	if not attribute_values:
+	item_attr_values = get_item_attribute_values(attribute.get("attribute"))
+	if not item_attr_values:
 		return cint(variant_attr_val)
 
-	return attribute_values[0]
+	value = cstr(variant_attr_val).lower()
+	return (
+		item_attr_values.values.get(value)
+		or item_attr_values.abbrs.get(value)
+		or cint(variant_attr_val)
+	)
 
 
 def get_item_group(product_type: str = str()):
+	item_groups = get_master_cache("Item Group")
+	if product_type not in item_groups:
+		item_groups[product_type] = find_or_create_item_group(product_type)
+	return item_groups[product_type]
+
+
+def find_or_create_item_group(product_type: str = str()):
 	from frappe.utils.nestedset import get_root_of
 
-	parent_item_group = get_root_of("Item Group")
+	parent_item_group = get_item_group() if product_type else get_root_of("Item Group")
 	if product_type:
 		if not frappe.db.get_value("Item Group", product_type, "name"):
-			item_group = frappe.get_doc(
+			item_group = insert_master(
 				{
 					"doctype": "Item Group",
 					"item_group_name": product_type,
 					"parent_item_group": parent_item_group,
 					"is_group": "No",
 				}
-			).insert()
-			return item_group.name
+			)
+
+			if item_group:
+				return item_group
 		return product_type
 	return parent_item_group
 
@@ -539,6 +1417,172 @@ def add_to_price_list(
 	shopify_item: Union[Product, Variant],
 	item_code: str,
 ):
+	"""
+	Queue an item's Shopify price for the store's price list. Queued prices are
+	written together with `write_item_prices` when the sync commits.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param shopify_item: The Shopify `Product` or `Variant` data
+	:param item_code: The Item code to set the price for
+	"""
+
+	get_item_price_queue(shopify_settings.name).append(
+		(item_code, flt(get_item_rate(shopify_item)))
+	)
+
+
+def write_item_prices(shopify_settings: "ShopifySettings"):
+	"""
+	Write all queued item prices into the store's price list in bulk.
+
+	Existing Item Prices are loaded in a single query, unchanged rates are
+	skipped, and the remaining prices are updated and inserted in one query
+	each, without loading every Item Price document.
+
+	This bypasses Item Price validation and document hooks, so the writes are
+	kept to what validation would allow: only an item's current general price
+	in its stock UOM (not specific to a customer, supplier or batch, and without
+	an end date) is updated, and prices are only inserted for existing items
+	without such a price on the price list, with the details that validation
+	would otherwise set.
+
+	:param shopify_settings: The Shopify configuration for the store
+	"""
+
+	item_prices = get_item_price_queue(shopify_settings.name)
+	if not item_prices:
+		return
+
+	# the last queued rate wins, if an item was synced more than once
+	rates: Dict[str, float] = dict(item_prices)
+	item_prices.clear()
+
+	items = {
+		item.name: item
+		for item in frappe.get_all(
+			"Item",
+			filters={"name": ["in", list(rates)]},
+			fields=["name", "item_name", "description", "stock_uom", "brand"],
+		)
+	}
+
+	price_list = shopify_settings.price_list
+	existing_prices = frappe.get_all(
+		"Item Price",
+		filters={
+			"price_list": price_list,
+			"item_code": ["in", list(rates)],
+			"customer": ["is", "not set"],
+			"supplier": ["is", "not set"],
+			"batch_no": ["is", "not set"],
+			"valid_upto": ["is", "not set"],
+		},
+		fields=["name", "item_code", "uom", "price_list_rate"],
+		order_by="valid_from desc, creation desc",
+	)
+
+	# only the latest matching price of each item is updated
+	updated_prices = {}
+	for item_price in existing_prices:
+		item = items.get(item_price.item_code)
+		if not item or item_price.uom != item.stock_uom:
+			continue
+
+		rate = rates.pop(item_price.item_code, None)
+		if rate is not None and flt(item_price.price_list_rate) != rate:
+			updated_prices[item_price.name] = rate
+
+	if updated_prices:
+		update_item_prices(updated_prices)
+
+	if rates:
+		insert_item_prices(price_list, rates, items)
+
+
+def update_item_prices(rates: Dict[str, float]):
+	rate_cases = " ".join(["when %s then %s"] * len(rates))
+	values = [value for item_price in rates.items() for value in item_price]
+
+	frappe.db.sql(
+		f"""
+			UPDATE `tabItem Price`
+			SET price_list_rate = CASE name {rate_cases} END,
+				modified = %s, modified_by = %s
+			WHERE name IN ({", ".join(["%s"] * len(rates))})
+		""",
+		values + [now_datetime(), frappe.session.user] + list(rates),
+	)
+
+
+def insert_item_prices(
+	price_list: str, rates: Dict[str, float], items: Dict[str, frappe._dict]
+):
+	# set the fields that are usually set while validating Item Prices
+	price_list_details = frappe.get_cached_value(
+		"Price List", price_list, ["currency", "buying", "selling"], as_dict=True
+	)
+
+	timestamp = now_datetime()
+	fields = [
+		"name",
+		"owner",
+		"creation",
+		"modified",
+		"modified_by",
+		"docstatus",
+		"price_list",
+		"item_code",
+		"item_name",
+		"item_description",
+		"uom",
+		"brand",
+		"currency",
+		"buying",
+		"selling",
+		"price_list_rate",
+		"valid_from",
+	]
+
+	values = []
+	for item_code, rate in rates.items():
+		# Item Price validation rejects prices for missing items
+		item = items.get(item_code)
+		if not item:
+			continue
+
+		values.append(
+			(
+				frappe.generate_hash(length=10),
+				frappe.session.user,
+				timestamp,
+				timestamp,
+				frappe.session.user,
+				0,
+				price_list,
+				item_code,
+				item.item_name,
+				item.description,
+				item.stock_uom,
+				item.brand,
+				price_list_details.currency,
+				price_list_details.buying,
+				price_list_details.selling,
+				rate,
+				getdate(timestamp),
+			)
+		)
+
+	if values:
+		frappe.db.bulk_insert("Item Price", fields, values)
+
+
+def get_item_price_queue(shop_name: str) -> List[Tuple[str, float]]:
+	# the local cache is cleared for every request and background job,
+	# so queued prices never outlive a sync run
+	return frappe.local_cache("shopify_item_price_queue", shop_name, list)
+
+
+def get_item_rate(shopify_item: Union[Product, Variant]):
 	rate = 0
 	if isinstance(shopify_item, Product):
 		variants = shopify_item.attributes.get("variants", [])
@@ -547,43 +1591,18 @@ def add_to_price_list(
 	elif isinstance(shopify_item, Variant):
 		rate = shopify_item.attributes.get("price") or 0
 
-	item_price_name = frappe.db.get_value(
-		"Item Price",
-		{"item_code": item_code, "price_list": shopify_settings.price_list},
-		"name",
-	)
-
-	if item_price_name:
-		item_rate = frappe.get_doc("Item Price", item_price_name)
-		item_rate.price_list_rate = rate
-		item_rate.save()
-	else:
-		item_rate = frappe.new_doc("Item Price")
-		item_rate.price_list = shopify_settings.price_list
-		item_rate.item_code = item_code
-		item_rate.price_list_rate = rate
-		item_rate.insert()
+	return rate
 
 
 def get_item_image(
 	shopify_settings: "ShopifySettings", shopify_item: Union[Product, Variant]
 ):
 	image_url = None
-	products = []
-
-	if isinstance(shopify_item, Product):
-		products = [shopify_item]
-	elif isinstance(shopify_item, Variant):
-		# TODO: should we check if the product exists on Shopify?
-		products = shopify_settings.get_products(
-			shopify_item.attributes.get("product_id"), fields="image"
-		)
 
-	product: Product
-	for product in products:
-		if product.attributes.get("image"):
-			image_url = product.attributes.get("image").attributes.get("src")
-			break
+	# TODO: should we check if the product exists on Shopify?
+	product = get_parent_product(shopify_settings, shopify_item)
+	if product and product.attributes.get("image"):
+		image_url = product.attributes.get("image").attributes.get("src")
 
 	return image_url
 
@@ -594,47 +1613,237 @@ def get_supplier(
 	supplier = vendor = str()
 
 	# only Shopify products are assigned vendors
-	if isinstance(shopify_item, Product):
-		products = [shopify_item]
-	elif isinstance(shopify_item, Variant):
-		products: List[Product] = shopify_settings.get_products(
-			shopify_item.attributes.get("product_id"), fields="vendor"
-		)
-
-	for product in products:
-		if product.attributes.get("vendor"):
-			vendor = product.attributes.get("vendor")
-			break
+	product = get_parent_product(shopify_settings, shopify_item)
+	if product:
+		vendor = product.attributes.get("vendor")
 
 	if vendor:
-		suppliers = frappe.get_all(
-			"Supplier",
-			or_filters={
-				"name": vendor,
+		suppliers = get_master_cache("Supplier")
+		if vendor.lower() not in suppliers:
+			suppliers[vendor.lower()] = find_or_create_supplier(vendor)
+		return suppliers[vendor.lower()]
+	return supplier
+
+
+def find_or_create_supplier(vendor: str) -> str:
+	return find_supplier(vendor) or insert_supplier(vendor)
+
+
+def find_supplier(vendor: str) -> Optional[str]:
+	suppliers = frappe.get_all(
+		"Supplier",
+		or_filters={
+			"name": vendor,
+			"supplier_name": vendor,
+			"shopify_supplier_id": vendor.lower(),
+		},
+		pluck="name",
+	)
+	return suppliers[0] if suppliers else None
+
+
+def insert_supplier(vendor: str) -> str:
+	return (
+		frappe.get_doc(
+			{
+				"doctype": "Supplier",
 				"supplier_name": vendor,
 				"shopify_supplier_id": vendor.lower(),
-			},
+				"supplier_group": get_supplier_group(),
+			}
 		)
+		.insert()
+		.name
+	)
+
+
+def create_batch_suppliers(
+	shopify_settings: "ShopifySettings", shopify_items: List[Union[Product, Variant]]
+):
+	"""
+	Find or create the Suppliers for the vendors of a batch of Shopify products or
+	variants, before any of the batch's items are synced.
+
+	This commits the current transaction whenever a Supplier is created, so it
+	should only be called between batches.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param shopify_items: The Shopify `Product` or `Variant` data
+	"""
+
+	suppliers = get_master_cache("Supplier")
+
+	for shopify_item in shopify_items:
+		product = get_parent_product(shopify_settings, shopify_item)
+		vendor = product.attributes.get("vendor") if product else None
+		if not vendor or vendor.lower() in suppliers:
+			continue
+
+		try:
+			suppliers[vendor.lower()] = find_supplier(vendor) or create_supplier(vendor)
+		except Exception:
+			# the vendor's items fail and are logged on their own
+			frappe.db.rollback()
+
+
+def create_supplier(vendor: str) -> str:
+	"""
+	Create the Supplier for a Shopify vendor, unless another sync created it first.
+
+	The vendor is locked only while its Supplier is created, and the Supplier is
+	committed before the lock is released, so that syncs waiting for the lock
+	find it instead of creating it again.
+
+	:param vendor: The Shopify vendor
+	:return: The name of the vendor's Supplier
+	"""
+
+	cache = frappe.cache()
+	key = cache.make_key(SUPPLIER_LOCK_KEY.format(vendor.lower()))
+	token = frappe.generate_hash(length=10)
+
+	wait_until = time.monotonic() + SUPPLIER_LOCK_WAIT_SECONDS
+	while not cache.set(key, token, nx=True, ex=SUPPLIER_LOCK_TTL_SECONDS):
+		if time.monotonic() > wait_until:
+			frappe.throw(
+				_("Timed out waiting for another sync to create Supplier '{0}'").format(
+					vendor
+				)
+			)
+		time.sleep(0.5)
+
+	try:
+		# start a new snapshot, so that a Supplier committed by the
+		# sync that held the lock before is found
+		frappe.db.commit()
+		supplier = find_supplier(vendor) or insert_supplier(vendor)
+		frappe.db.commit()
+	finally:
+		cache.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
 
-		if not suppliers:
-			supplier = frappe.get_doc(
-				{
-					"doctype": "Supplier",
-					"supplier_name": vendor,
-					"shopify_supplier_id": vendor.lower(),
-					"supplier_group": get_supplier_group(),
-				}
-			).insert()
-			return supplier.name
-		return suppliers[0].name
 	return supplier
 
 
+def get_parent_product(
+	shopify_settings: "ShopifySettings", shopify_item: Union[Product, Variant]
+) -> Optional[Product]:
+	"""
+	Get the parent product of a Shopify product or variant.
+
+	Parent products are requested from Shopify at most once per sync run, and
+	kept in a bounded cache along with products that have already been received
+	from Shopify, so that syncing a product's variants doesn't refetch it.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param shopify_item: The Shopify `Product` or `Variant` data
+	:return: The parent product, if found
+	"""
+
+	if isinstance(shopify_item, Product):
+		return shopify_item
+
+	# variants nested in products carry the product ID in their prefix options
+	product_id = cstr(
+		shopify_item.attributes.get("product_id")
+		or shopify_item._prefix_options.get("product_id")
+	)
+
+	if not product_id:
+		return
+
+	product_cache = get_product_cache(shopify_settings.name)
+	if product_id in product_cache:
+		product_cache.move_to_end(product_id)
+		return product_cache[product_id]
+
+	products = shopify_settings.get_products(product_id, fields=PARENT_PRODUCT_FIELDS)
+	product = products[0] if products else None
+	cache_product(shopify_settings, product, product_id)
+	return product
+
+
+def cache_product(
+	shopify_settings: "ShopifySettings",
+	product: Optional[Product],
+	product_id: Optional[str] = None,
+):
+	"""
+	Keep a Shopify product in the sync run's product cache, to be used for
+	its variants.
+
+	:param shopify_settings: The Shopify configuration for the store
+	:param product: The Shopify product data, or None if the product was not found
+	:param product_id: (optional) The Shopify product ID, defaults to the product's ID
+	"""
+
+	product_id = cstr(product_id or (product.id if product else None))
+	if not product_id:
+		return
+
+	product_cache = get_product_cache(shopify_settings.name)
+	product_cache[product_id] = product
+	product_cache.move_to_end(product_id)
+
+	while len(product_cache) > PRODUCT_CACHE_SIZE:
+		product_cache.popitem(last=False)
+
+
+def get_product_cache(shop_name: str) -> "OrderedDict[str, Optional[Product]]":
+	# the local cache is cleared for every request and background job,
+	# so the product cache lives for the duration of a single sync run
+	return frappe.local_cache("shopify_product_cache", shop_name, OrderedDict)
+
+
 def get_supplier_group():
+	supplier_groups = get_master_cache("Supplier Group")
+	if "shopify" not in supplier_groups:
+		supplier_groups["shopify"] = find_or_create_supplier_group()
+	return supplier_groups["shopify"]
+
+
+def find_or_create_supplier_group():
 	supplier_group = frappe.db.get_value("Supplier Group", _("Shopify Supplier"))
 	if not supplier_group:
-		supplier_group = frappe.get_doc(
+		supplier_group = insert_master(
 			{"doctype": "Supplier Group", "supplier_group_name": _("Shopify Supplier")}
-		).insert()
-		return supplier_group.name
+		)
+		return supplier_group or _("Shopify Supplier")
 	return supplier_group
+
+
+def insert_master(doc: Dict) -> Optional[str]:
+	"""
+	Insert a missing master named after its title, such as an Item Group, found
+	during a sync.
+
+	Parallel syncs may try to insert the same master; the insert is isolated in a
+	savepoint, so that a duplicate entry doesn't fail the rest of the sync. The
+	duplicate insert waits for the other sync to commit, so the master's name can
+	be used as soon as this returns.
+
+	:param doc: The master document's data
+	:return: The name of the new master, or None if it already exists
+	"""
+
+	frappe.db.savepoint("shopify_master")
+	try:
+		return frappe.get_doc(doc).insert().name
+	except frappe.DuplicateEntryError:
+		frappe.db.rollback(save_point="shopify_master")
+
+
+def get_master_cache(doctype: str) -> Dict[str, str]:
+	# the local cache is cleared for every request and background job,
+	# so masters are resolved once during a single sync run
+	return frappe.local_cache("shopify_master_cache", doctype, dict)
+
+
+def clear_sync_caches():
+	"""
+	Clear the cached attributes and masters for the current sync run, once their
+	records may have been rolled back.
+	"""
+
+	clear_item_attribute_cache()
+	for doctype in ("Item Group", "Supplier", "Supplier Group"):
+		get_master_cache(doctype).clear()
@@ -2,6 +2,8 @@ import frappe
 from frappe import _
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
+from shopify_integration.utils import SHOPIFY_ORDER_DOCTYPES
+
 
 def get_setup_stages(args=None):
 	return [
@@ -46,6 +48,9 @@ def setup_custom_fields(args=None):
 				translatable=0),
 			dict(fieldname="shopify_sku", label="Shopify SKU", fieldtype="Data",
 				insert_after="shopify_variant_id", read_only=1, print_hide=1, translatable=0),
+			dict(fieldname="shopify_sync_hash", label="Shopify Sync Hash",
+				fieldtype="Data", insert_after="shopify_sku", hidden=1, read_only=1,
+				no_copy=1, print_hide=1, translatable=0),
 			dict(fieldname="disabled_on_shopify", label="Disabled on Shopify",
 				fieldtype="Check", insert_after="disabled", read_only=1, print_hide=1),
 			dict(fieldname="marketplace_item_group", label="Marketplace Item Group",
@@ -175,3 +180,9 @@ def setup_custom_fields(args=None):
 		})
 
 	create_custom_fields(custom_fields)
+
+	# sales documents are looked up by their Shopify order for every webhook and payout
+	for doctype in SHOPIFY_ORDER_DOCTYPES:
+		frappe.db.add_index(doctype,
+			["shopify_settings", "shopify_order_id", "docstatus"],
+			index_name="shopify_order_index")
@@ -14,7 +14,7 @@ frappe.ui.form.on('Shopify Log', {
 				})
 
 				if (!response.exc) {
-					frappe.msgprint(__("Order rescheduled for sync"));
+					frappe.msgprint(__("Log rescheduled for sync"));
 				}
 			}).addClass('btn-primary');
 		}
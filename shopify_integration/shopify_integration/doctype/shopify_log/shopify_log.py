@@ -12,21 +12,17 @@ from frappe.model.document import Document
 class ShopifyLog(Document):
 	@frappe.whitelist()
 	def resync(self):
+		from shopify_integration.webhooks import (
+			enqueue_webhook_job,
+			get_webhook_resource_id,
+		)
+
 		self.db_set("status", "Queued", update_modified=False)
 
 		request_data = json.loads(self.request_data)
-		if request_data.get("order_edit"):
-			order_id = request_data.get("order_edit", {}).get("order_id")
-		else:
-			order_id = request_data.get("id")
-
-		frappe.enqueue(
-			method=self.method,
-			queue="short",
-			timeout=300,
-			is_async=True,
-			**{"shop_name": self.shop, "order_id": order_id, "log_id": self.name}
-		)
+		id_field, resource_id = get_webhook_resource_id(self.method, request_data)
+
+		enqueue_webhook_job(self.shop, self.method, id_field, resource_id, self.name)
 
 
 def make_shopify_log(
@@ -36,6 +32,7 @@ def make_shopify_log(
 	response_data: Optional[Union[str, Dict]] = None,
 	exception: Optional[Union[Exception, List]] = None,
 	rollback: bool = False,
+	traceback: Optional[str] = None,
 ):
 	# if name not provided by log calling method then fetch existing queued state log
 	make_new = False
@@ -63,7 +60,7 @@ def make_shopify_log(
 			"shop": shop_name,
 			"message": error_message,
 			"response_data": response_data,
-			"traceback": frappe.get_traceback(),
+			"traceback": traceback or frappe.get_traceback(),
 			"status": status,
 		}
 	)
@@ -3,18 +3,20 @@
 # For license information, please see license.txt
 
 from collections import defaultdict
-from typing import TYPE_CHECKING
 
 import frappe
 from frappe.model.document import Document
 from frappe.utils import cint, flt
 
 from shopify_integration.invoices import create_sales_return
-from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import make_shopify_log
-from shopify_integration.utils import get_accounting_entry, get_tax_account_head
-
-if TYPE_CHECKING:
-	from shopify_integration.shopify_integration.doctype.shopify_settings.shopify_settings import ShopifySettings
+from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
+	make_shopify_log,
+)
+from shopify_integration.utils import (
+	get_accounting_entry,
+	get_shopify_settings,
+	get_tax_account_head,
+)
 
 
 class ShopifyPayout(Document):
@@ -57,7 +59,7 @@ class ShopifyPayout(Document):
 					"account_head": get_tax_account_head(self.shop_name, "fee"),
 					"description": transaction.transaction_type,
 					"tax_amount": -flt(transaction.fee),
-					"cost_center": frappe.db.get_value("Shopify Settings", self.shop_name, "cost_center")
+					"cost_center": get_shopify_settings(self.shop_name).cost_center
 				})
 
 			invoice.save()
@@ -65,7 +67,7 @@ class ShopifyPayout(Document):
 
 	def update_cancelled_shopify_orders(self):
 		doctypes = ["Delivery Note", "Sales Invoice", "Sales Order"]
-		settings: "ShopifySettings" = frappe.get_doc("Shopify Settings", self.shop_name)
+		settings = get_shopify_settings(self.shop_name)
 
 		for transaction in self.transactions:
 			if not transaction.source_order_id:
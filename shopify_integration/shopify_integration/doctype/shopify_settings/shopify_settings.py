@@ -2,10 +2,12 @@
 # Copyright (c) 2021, Parsimony, LLC and contributors
 # For license information, please see license.txt
 
-from typing import TYPE_CHECKING, Optional, Type
+import json
+from typing import TYPE_CHECKING, Dict, List, Optional, Type
 
-from shopify.collection import PaginatedCollection, PaginatedIterator
+from shopify.collection import PaginatedCollection
 from shopify.resources import (
+	GraphQL,
 	Order,
 	Payouts,
 	Product,
@@ -20,8 +22,10 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 from frappe.model.naming import get_default_naming_series
-from frappe.utils import get_datetime_str, get_first_day, today
+from frappe.utils import cstr, get_datetime_str, get_first_day, today
 
+from shopify_integration.client import get_api_client
+from shopify_integration.utils import clear_shop_domain_index
 from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
 	make_shopify_log,
 )
@@ -48,8 +52,36 @@ class ShopifySettings(Document):
 			or "DN-Shopify-",
 		}
 
-	def validate(self):
-		self.update_webhooks()
+	def on_update(self):
+		from shopify_integration.webhooks import (
+			clear_webhook_signing_keys,
+			store_previous_webhook_secret,
+		)
+
+		# keep accepting webhooks signed with the previous secret for a while
+		previous_settings = self.get_doc_before_save()
+		if (
+			previous_settings
+			and previous_settings.shared_secret
+			and previous_settings.shared_secret != self.shared_secret
+		):
+			store_previous_webhook_secret(self.name, previous_settings.shared_secret)
+
+		clear_shop_domain_index()
+		clear_webhook_signing_keys()
+		self.enqueue_webhook_update()
+
+	def after_rename(self, old_name: str, new_name: str, merge: bool = False):
+		from shopify_integration.webhooks import clear_webhook_signing_keys
+
+		clear_shop_domain_index()
+		clear_webhook_signing_keys()
+
+	def on_trash(self):
+		from shopify_integration.webhooks import clear_webhook_signing_keys
+
+		clear_shop_domain_index()
+		clear_webhook_signing_keys()
 
 	def get_shopify_access_token(self):
 		from shopify_integration.oauth import DEFAULT_TOKEN_USER
@@ -84,29 +116,94 @@ class ShopifySettings(Document):
 			return ShopifySession.temp(*args)
 		return ShopifySession(*args)
 
-	def get_resources(self, resource: Type["ShopifyResource"], *args, **kwargs):
+	def get_resources(
+		self,
+		resource: Type["ShopifyResource"],
+		*args,
+		stream: bool = False,
+		**kwargs
+	):
+		"""
+		Fetch resources from Shopify, following pagination for list requests.
+
+		:param resource: The Shopify resource class to query
+		:param stream: (optional) If set, return a generator that yields resources as
+			each page arrives, instead of a list of all resources, defaults to False
+		:return: A list of resources, or a generator of resources if streaming
+		"""
+
+		resources = self.iter_resources(resource, *args, **kwargs)
+		if stream:
+			return resources
+		return list(resources)
+
+	def iter_resources(
+		self,
+		resource: Type["ShopifyResource"],
+		*args,
+		page_size: Optional[int] = None,
+		**kwargs
+	):
+		"""
+		Lazily yield resources from Shopify, keeping only one page in memory.
+
+		The next page is only requested once the current page has been consumed,
+		so callers can start processing the first page while the catalog is
+		still being paged through. All requests are paced and retried by the
+		store's API client to stay within Shopify's rate limits.
+
+		Requests with a "limit" only return the first page; to request all pages
+		with a different page size, set `page_size` instead.
+		"""
+
+		paginate = "limit" not in kwargs
+		if page_size:
+			kwargs["limit"] = page_size
+
+		client = get_api_client(self.name)
 		with self.get_shopify_session(temp=True):
-			resources = resource.find(*args, **kwargs)
+			page = client.request(resource.find, *args, **kwargs)
+
+		# Shopify's API returns instance objects instead of collections
+		# for single-result responses
+		if not isinstance(page, PaginatedCollection):
+			yield page
+			return
+
+		while True:
+			yield from page
 
 			# if a limited number of documents are requested, don't keep looping;
 			# this is a side-effect from the way the library works, since it
 			# doesn't process the "limit" keyword
-			if "limit" in kwargs:
-				return (
-					resources
-					if isinstance(resources, PaginatedCollection)
-					else [resources]
-				)
+			if not paginate or not page.has_next_page():
+				return
+
+			# the session is only activated while fetching a page, so that it
+			# doesn't leak into the caller's code between pages
+			with self.get_shopify_session(temp=True):
+				page = client.request(page.next_page, no_cache=True)
+
+	def execute_graphql(self, query: str, variables: Optional[Dict] = None) -> Dict:
+		"""
+		Run a query against Shopify's GraphQL Admin API.
+
+		:param query: The GraphQL query or mutation
+		:param variables: (optional) The variables for the query, defaults to None
+		:return: The data returned by the query
+		"""
+
+		with self.get_shopify_session(temp=True):
+			response = json.loads(GraphQL().execute(query, variables=variables))
 
-			if isinstance(resources, PaginatedCollection):
-				# Shopify's API limits responses to 50 per page by default;
-				# we keep calling to retrieve all the resource documents
-				paged_resources = PaginatedIterator(resources)
-				return [resource for page in paged_resources for resource in page]
+		if response.get("errors"):
+			frappe.throw(
+				_("Shopify GraphQL request failed: {0}").format(
+					", ".join(error.get("message") for error in response.get("errors"))
+				)
+			)
 
-			# Shopify's API returns instance objects instead of collections
-			# for single-result responses
-			return [resources]
+		return response.get("data") or {}
 
 	def get_orders(self, *args, **kwargs):
 		return self.get_resources(Order, *args, **kwargs)
@@ -130,17 +227,51 @@ class ShopifySettings(Document):
 		return self.get_resources(Webhook, *args, **kwargs)
 
 	@frappe.whitelist()
-	def sync_products(self):
-		"Pull and sync products from Shopify, including variants"
-		from shopify_integration.products import sync_items_from_shopify
+	def sync_products(self, incremental: bool = False):
+		"""
+		Pull and sync products from Shopify, including variants. If `incremental`
+		is set, only products changed since the last product sync are pulled.
+		"""
+
+		from shopify_integration.bulk_operations import sync_items_from_bulk_operation
+		from shopify_integration.products import (
+			start_parallel_product_sync,
+			sync_items_from_shopify,
+		)
+
+		if self.product_sync_method == "Bulk Operation":
+			frappe.enqueue(
+				method=sync_items_from_bulk_operation,
+				queue="long",
+				timeout=4 * 60 * 60,
+				is_async=True,
+				**{"shop_name": self.name, "incremental": incremental}
+			)
+			return
+
+		if self.parallel_product_sync:
+			frappe.enqueue(
+				method=start_parallel_product_sync,
+				queue="long",
+				is_async=True,
+				**{"shop_name": self.name, "incremental": incremental}
+			)
+			return
 
 		frappe.enqueue(
 			method=sync_items_from_shopify,
 			queue="long",
 			is_async=True,
-			**{"shop_name": self.name}
+			**{"shop_name": self.name, "incremental": incremental}
 		)
 
+	@frappe.whitelist()
+	def get_product_sync_progress(self):
+		"Get the progress of the last parallel product sync"
+		from shopify_integration.products import get_product_sync_progress
+
+		return get_product_sync_progress(self.name)
+
 	@frappe.whitelist()
 	def sync_payouts(self, start_date: str = str()):
 		"Pull and sync payouts from Shopify Payments transactions"
@@ -155,6 +286,28 @@ class ShopifySettings(Document):
 			**{"shop_name": self.name, "start_date": start_date}
 		)
 
+	def enqueue_webhook_update(self):
+		"""
+		Register or remove the store's webhooks in a background job, if needed,
+		instead of calling Shopify while the settings are being saved.
+		"""
+
+		if frappe.conf.developer_mode or self.flags.skip_webhook_update:
+			return
+
+		if self.enable_shopify and not self.get_missing_webhook_topics():
+			return
+		if not self.enable_shopify and not self.webhooks:
+			return
+
+		frappe.enqueue(
+			method=update_shopify_webhooks,
+			queue="short",
+			is_async=True,
+			enqueue_after_commit=True,
+			**{"shop_name": self.name}
+		)
+
 	def update_webhooks(self):
 		if frappe.conf.developer_mode:
 			return
@@ -165,11 +318,21 @@ class ShopifySettings(Document):
 		):
 			return
 
-		if self.enable_shopify and not self.webhooks:
+		if self.enable_shopify and self.get_missing_webhook_topics():
 			self.register_webhooks()
 		elif not self.enable_shopify:
 			self.unregister_webhooks()
 
+	def get_missing_webhook_topics(self) -> List[str]:
+		from shopify_integration.webhooks import SHOPIFY_WEBHOOK_TOPIC_MAPPER
+
+		registered_topics = {webhook.method for webhook in self.webhooks}
+		return [
+			topic
+			for topic in SHOPIFY_WEBHOOK_TOPIC_MAPPER
+			if topic not in registered_topics
+		]
+
 	def register_webhooks(self):
 		from shopify_integration.webhooks import (
 			get_webhook_url,
@@ -179,22 +342,34 @@ class ShopifySettings(Document):
 		webhooks = []
 
 		try:
-			webhooks = self.get_webhooks()
+			webhooks = [
+				webhook
+				for webhook in self.get_webhooks()
+				if webhook.topic in SHOPIFY_WEBHOOK_TOPIC_MAPPER
+			]
 		except Exception as e:
-			make_shopify_log(
-				shop_name=self.name, status="Error", exception=e, rollback=True
-			)
+			make_shopify_log(shop_name=self.name, status="Error", exception=e)
+
+		# only create webhooks for topics that aren't registered on Shopify yet,
+		# so that new topics can be added to existing stores
+		existing_topics = {webhook.topic for webhook in webhooks}
+		for topic in SHOPIFY_WEBHOOK_TOPIC_MAPPER:
+			if topic in existing_topics:
+				continue
 
-		if not webhooks:
-			for topic in SHOPIFY_WEBHOOK_TOPIC_MAPPER:
-				with self.get_shopify_session(temp=True):
-					webhooks.append(Webhook.create(
-						{"topic": topic, "address": get_webhook_url(), "format": "json"}
-					))
+			with self.get_shopify_session(temp=True):
+				webhooks.append(Webhook.create(
+					{"topic": topic, "address": get_webhook_url(), "format": "json"}
+				))
+
+		registered_webhooks = {cstr(webhook.webhook_id) for webhook in self.webhooks}
 
 		webhook: Webhook
 		for webhook in webhooks:
 			if webhook.is_valid():
+				if cstr(webhook.id) in registered_webhooks:
+					continue
+
 				self.append(
 					"webhooks", {"webhook_id": webhook.id, "method": webhook.topic}
 				)
@@ -204,7 +379,6 @@ class ShopifySettings(Document):
 					status="Error",
 					response_data=webhook.to_dict(),
 					exception=webhook.errors.full_messages(),
-					rollback=True,
 				)
 
 	def unregister_webhooks(self):
@@ -218,20 +392,32 @@ class ShopifySettings(Document):
 			try:
 				existing_webhooks = self.get_webhooks(webhook.webhook_id)
 			except Exception as e:
-				make_shopify_log(
-					shop_name=self.name, status="Error", exception=e, rollback=True
-				)
+				make_shopify_log(shop_name=self.name, status="Error", exception=e)
 				continue
 
 			for existing_webhook in existing_webhooks:
 				try:
 					existing_webhook.destroy()
 				except Exception as e:
-					make_shopify_log(
-						shop_name=self.name, status="Error", exception=e, rollback=True
-					)
+					make_shopify_log(shop_name=self.name, status="Error", exception=e)
 				else:
 					deleted_webhooks.append(webhook)
 
 		for webhook in deleted_webhooks:
 			self.remove(webhook)
+
+
+def update_shopify_webhooks(shop_name: str):
+	"""
+	Background job to register missing webhooks for an enabled Shopify store, or
+	remove the webhooks of a disabled store, and save the registered webhooks.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	"""
+
+	shopify_settings: ShopifySettings = frappe.get_doc("Shopify Settings", shop_name)
+	shopify_settings.update_webhooks()
+
+	# don't enqueue another update for webhooks that couldn't be registered
+	shopify_settings.flags.skip_webhook_update = True
+	shopify_settings.save(ignore_permissions=True)
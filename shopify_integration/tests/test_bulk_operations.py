@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Parsimony LLC and Contributors
+# See license.txt
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+from shopify_integration.bulk_operations import (
+	get_legacy_id,
+	iter_bulk_products,
+	sync_items_from_bulk_operation,
+)
+from shopify_integration.products import has_variants
+
+BULK_PRODUCTS_FILE = os.path.join(
+	os.path.dirname(__file__), "test_data", "shopify_bulk_products.jsonl"
+)
+
+
+def download_bulk_products(url):
+	# the sync removes the downloaded file once it's done
+	with open(BULK_PRODUCTS_FILE) as fixture, tempfile.NamedTemporaryFile(
+		mode="w", suffix=".jsonl", delete=False
+	) as result_file:
+		shutil.copyfileobj(fixture, result_file)
+	return result_file.name
+
+
+def sync_product(shopify_settings, product, update=False, commit=True):
+	if product.attributes.get("product_type") == "Shirts":
+		raise ValueError("Invalid product price")
+
+
+class TestBulkOperations(unittest.TestCase):
+	def test_iter_bulk_products(self):
+		with open(BULK_PRODUCTS_FILE) as result_file:
+			products = list(iter_bulk_products(result_file))
+
+		self.assertEqual(len(products), 2)
+		tee, tote = products
+
+		self.assertEqual(tee.id, 7510000000001)
+		self.assertEqual(tee.attributes.get("product_type"), "Shirts")
+		self.assertEqual(tee.attributes.get("image").attributes.get("src"),
+			"https://cdn.shopify.com/s/files/classic-tee.png")
+		self.assertTrue(has_variants(tee))
+		self.assertFalse(has_variants(tote))
+
+		variants = tee.attributes.get("variants")
+		self.assertEqual([variant.id for variant in variants],
+			[4250000000011, 4250000000012])
+		self.assertEqual(variants[1].attributes.get("option1"), "Medium")
+		self.assertEqual(variants[1].attributes.get("option2"), "Black")
+		self.assertEqual(variants[1].attributes.get("weight_unit"), "kg")
+		self.assertEqual(variants[1]._prefix_options.get("product_id"), tee.id)
+
+		self.assertIsNone(tote.attributes.get("image"))
+		self.assertEqual(len(tote.attributes.get("variants")), 1)
+		tote_variant = tote.attributes.get("variants")[0]
+		self.assertEqual(tote_variant.attributes.get("weight_unit"), "oz")
+
+	def test_get_legacy_id(self):
+		self.assertEqual(get_legacy_id("gid://shopify/ProductVariant/42"), 42)
+		self.assertEqual(get_legacy_id(None), 0)
+
+	@patch("shopify_integration.products.make_shopify_log")
+	@patch("shopify_integration.products.frappe.cache", create=True)
+	@patch("shopify_integration.products.frappe.get_all", create=True,
+		return_value=["Parsimony Apparel"])
+	@patch("shopify_integration.products.frappe.local_cache", create=True)
+	@patch("shopify_integration.products.frappe.db", create=True)
+	@patch("shopify_integration.bulk_operations.update_product_sync_datetime")
+	@patch("shopify_integration.bulk_operations.sync_product", side_effect=sync_product)
+	@patch("shopify_integration.bulk_operations.download_bulk_operation_result",
+		side_effect=download_bulk_products)
+	@patch("shopify_integration.bulk_operations.run_bulk_operation",
+		return_value="https://example.com/bulk-products.jsonl")
+	@patch("shopify_integration.bulk_operations.frappe.get_doc", create=True)
+	@patch("shopify_integration.bulk_operations.frappe.set_user", create=True)
+	def test_failed_product_is_isolated(self, set_user, get_doc, run_bulk_operation,
+		download_bulk_operation_result, sync_product, update_product_sync_datetime,
+		db, local_cache, get_all, cache, make_shopify_log):
+		local_caches = {}
+		local_cache.side_effect = lambda namespace, key, generator: (
+			local_caches.setdefault((namespace, key), generator()))
+		get_doc.return_value = frappe._dict(name="Test Shopify", create_variant_items=0)
+
+		sync_items_from_bulk_operation("Test Shopify")
+
+		# the products' vendor is looked up once for the batch
+		get_all.assert_called_once()
+
+		# the failed product is rolled back on its own, and the
+		# rest of its batch is still synced and committed
+		self.assertEqual(sync_product.call_count, 2)
+		db.rollback.assert_called_once_with(save_point="shopify_item_7510000000001")
+		db.commit.assert_called_once()
+		make_shopify_log.assert_called_once()
+		self.assertIn("7510000000001", make_shopify_log.call_args.kwargs.get("message"))
+
+		# the failed product is kept to be synced again by the next sync,
+		# without holding back the watermark
+		cache.return_value.sadd.assert_called_once_with(
+			"shopify_failed_product_ids|Test Shopify", "7510000000001")
+		cache.return_value.srem.assert_called_once_with(
+			"shopify_failed_product_ids|Test Shopify", "7510000000002")
+		update_product_sync_datetime.assert_called_once()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Parsimony LLC and Contributors
+# See license.txt
+
+import unittest
+from unittest.mock import ANY, MagicMock, patch
+
+from pyactiveresource.connection import ClientError, Response, ServerError
+
+from shopify_integration.client import (
+	ShopifyAPIClient,
+	get_backoff_delay,
+	get_call_limit,
+)
+
+
+class TestShopifyAPIClient(unittest.TestCase):
+	def test_call_limit_header(self):
+		response = Response(200, "", {"x-shopify-shop-api-call-limit": "32/40"})
+		self.assertEqual(get_call_limit(response), (32, 40))
+		self.assertIsNone(get_call_limit(Response(200, "", {})))
+
+	def test_backoff_honors_retry_after(self):
+		self.assertGreaterEqual(get_backoff_delay(0, retry_after=2.0), 2.0)
+		self.assertLessEqual(get_backoff_delay(10), 60)
+
+	@patch("shopify_integration.client.time.sleep")
+	@patch("shopify_integration.client.ShopifyResource")
+	@patch("shopify_integration.client.frappe.cache", create=True)
+	def test_retry_throttled_requests(self, cache, resource, sleep):
+		cache.return_value.eval.return_value = "0"
+		cache.return_value.hmget.return_value = [None]
+		resource.connection.response = Response(
+			200, "", {"X-Shopify-Shop-Api-Call-Limit": "1/40"}
+		)
+
+		throttled = ClientError(message="Too Many Requests")
+		throttled.code = 429
+		throttled.response = Response(429, "", {"Retry-After": "2.0"})
+
+		method = MagicMock(side_effect=[throttled, ServerError(), "products"])
+		client = ShopifyAPIClient("Test Shopify")
+
+		self.assertEqual(client.request(method), "products")
+		self.assertEqual(client.stats.requests, 3)
+		self.assertEqual(client.stats.throttles, 1)
+		self.assertEqual(client.stats.retries, 2)
+
+		# the shared bucket is synced with the last response
+		cache.return_value.pipeline.return_value.hset.assert_called_with(
+			ANY, mapping={"level": 1, "size": 40, "updated": ANY}
+		)
+
+	@patch("shopify_integration.client.time.sleep")
+	@patch("shopify_integration.client.frappe.cache", create=True)
+	def test_pace_requests_near_limit(self, cache, sleep):
+		cache.return_value.eval.return_value = "1.5"
+		client = ShopifyAPIClient("Test Shopify")
+		client.wait()
+		sleep.assert_called_once_with(1.5)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Parsimony LLC and Contributors
+# See license.txt
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+from shopify import LineItem
+
+import frappe
+
+from shopify_integration.hook_events.item import invalidate_item_code_index
+from shopify_integration.item_index import INDEX_VERSION_KEY, ItemCodeIndex
+
+ITEMS = [
+	frappe._dict(
+		item_code="TEE-S",
+		name="TEE-S",
+		shopify_sku="tee-small",
+		shopify_variant_id="101",
+		shopify_product_id="100",
+		item_name="Classic Tee",
+	),
+	frappe._dict(
+		item_code="TOTE",
+		name="TOTE",
+		shopify_sku=None,
+		shopify_variant_id="201",
+		shopify_product_id="200",
+		item_name="Canvas Tote",
+	),
+]
+
+
+def make_line_item(**attributes) -> LineItem:
+	line_item = LineItem()
+	line_item.attributes.update(attributes)
+	return line_item
+
+
+def get_items(doctype, filters, fields, **kwargs):
+	((fieldname, (_operator, values)),) = filters.items()
+	values = {value.lower() for value in values}
+	return [
+		frappe._dict({field: item.get(field) for field in fields})
+		for item in ITEMS
+		if (item.get(fieldname) or "").lower() in values
+	]
+
+
+@patch("shopify_integration.item_index.frappe.get_installed_apps", create=True,
+	return_value=["frappe", "erpnext"])
+@patch("shopify_integration.item_index.frappe.cache", create=True)
+@patch("shopify_integration.item_index.frappe.get_all", create=True,
+	side_effect=get_items)
+class TestItemCodeIndex(unittest.TestCase):
+	def test_item_code_lookup(self, get_all, cache, get_installed_apps):
+		cache.return_value.get_value.return_value = "v1"
+		index = ItemCodeIndex("Test Shopify")
+
+		line_items = [
+			make_line_item(sku="tee-s", variant_id=101, title="Classic Tee"),
+			make_line_item(sku="", variant_id=201, product_id=200),
+			make_line_item(title="Canvas Tote"),
+			make_line_item(sku="TEE-SMALL"),
+			make_line_item(sku="MISSING", variant_id=999),
+		]
+
+		self.assertEqual(
+			index.get_item_codes(line_items), ["TEE-S", "TOTE", "TOTE", "TEE-S", None]
+		)
+
+		# matched keys are served from the index without querying again
+		get_all.reset_mock()
+		self.assertEqual(
+			index.get_item_codes(line_items[:3]), ["TEE-S", "TOTE", "TOTE"]
+		)
+		get_all.assert_not_called()
+
+	def test_misses_are_not_cached(self, get_all, cache, get_installed_apps):
+		cache.return_value.get_value.return_value = "v1"
+		index = ItemCodeIndex("Test Shopify")
+		line_item = make_line_item(sku="MUG", variant_id=301)
+
+		self.assertEqual(index.get_item_codes([line_item]), [None])
+
+		new_item = frappe._dict(item_code="MUG", name="MUG", shopify_variant_id="301")
+		with patch.dict(globals(), ITEMS=ITEMS + [new_item]):
+			self.assertEqual(index.get_item_codes([line_item]), ["MUG"])
+
+	def test_invalidation(self, get_all, cache, get_installed_apps):
+		versions = {INDEX_VERSION_KEY: "v1"}
+		cache.return_value.get_value.side_effect = (
+			lambda key, **kwargs: versions.get(key)
+		)
+		cache.return_value.set_value.side_effect = versions.__setitem__
+
+		index = ItemCodeIndex("Test Shopify")
+		line_item = make_line_item(variant_id=101)
+		self.assertEqual(index.get_item_codes([line_item]), ["TEE-S"])
+
+		# saving any Item drops the cached keys in every process
+		with patch("shopify_integration.item_index.frappe.generate_hash", create=True,
+			return_value="v2"):
+			invalidate_item_code_index(MagicMock(), "on_update")
+		self.assertEqual(versions[INDEX_VERSION_KEY], "v2")
+
+		get_all.reset_mock()
+		self.assertEqual(index.get_item_codes([line_item]), ["TEE-S"])
+		get_all.assert_called()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Parsimony LLC and Contributors
+# See license.txt
+
+import datetime
+import unittest
+from unittest.mock import patch
+
+from shopify import Product
+
+import frappe
+
+from shopify_integration.products import (
+	get_item_price_queue,
+	sync_in_batches,
+	update_item_prices,
+	write_item_prices,
+)
+
+TIMESTAMP = datetime.datetime(2024, 1, 15, 10, 0)
+
+ITEMS = [
+	frappe._dict(name="TEE-S", item_name="Classic Tee - Small", description=None,
+		stock_uom="Nos", brand=None),
+	frappe._dict(name="TOTE", item_name="Canvas Tote", description=None,
+		stock_uom="Nos", brand=None),
+	frappe._dict(name="MUG", item_name="Enamel Mug", description="A mug",
+		stock_uom="Nos", brand="Parsimony"),
+]
+
+ITEM_PRICES = [
+	# prices in other UOMs aren't the item's general price
+	frappe._dict(name="price-tee-box", item_code="TEE-S", uom="Box",
+		price_list_rate=200),
+	frappe._dict(name="price-tee", item_code="TEE-S", uom="Nos", price_list_rate=20),
+	frappe._dict(name="price-tee-old", item_code="TEE-S", uom="Nos",
+		price_list_rate=18),
+	frappe._dict(name="price-tote", item_code="TOTE", uom="Nos", price_list_rate=15),
+]
+
+
+def get_all(doctype, filters=None, fields=None, **kwargs):
+	return ITEMS if doctype == "Item" else ITEM_PRICES
+
+
+def make_product(product_id: int) -> Product:
+	product = Product()
+	product.attributes.update({"id": product_id, "title": f"Product {product_id}"})
+	return product
+
+
+@patch("shopify_integration.products.make_shopify_log")
+@patch("shopify_integration.products.frappe.cache", create=True)
+@patch("shopify_integration.products.frappe.local_cache", create=True)
+@patch("shopify_integration.products.frappe.db", create=True)
+class TestSyncInBatches(unittest.TestCase):
+	def test_failed_item_is_isolated(self, db, local_cache, cache, make_shopify_log):
+		local_caches = {}
+		local_cache.side_effect = lambda namespace, key, generator: (
+			local_caches.setdefault((namespace, key), generator()))
+		shopify_settings = frappe._dict(name="Test Shopify", product_sync_batch_size=2)
+		products = [make_product(product_id) for product_id in (1, 2, 3)]
+
+		def sync_product(product: Product):
+			get_item_price_queue("Test Shopify").append((f"ITEM-{product.id}", 10.0))
+			if product.id == 2:
+				raise ValueError("Invalid product")
+
+		written_prices = []
+
+		def write_item_prices(shopify_settings):
+			item_prices = get_item_price_queue(shopify_settings.name)
+			written_prices.append(list(item_prices))
+			item_prices.clear()
+
+		with patch("shopify_integration.products.write_item_prices",
+			side_effect=write_item_prices):
+			failed_items = sync_in_batches(shopify_settings, products, sync_product)
+
+		self.assertEqual(failed_items, 1)
+		self.assertEqual(db.savepoint.call_count, 3)
+
+		# only the failed item's savepoint is rolled back, and
+		# the rest of its batch is committed along with it
+		db.rollback.assert_called_once_with(save_point="shopify_item_2")
+		self.assertEqual(db.commit.call_count, 2)
+		self.assertEqual(written_prices, [[("ITEM-1", 10.0)], [("ITEM-3", 10.0)]])
+
+		# the log records which item failed
+		make_shopify_log.assert_called_once()
+		self.assertEqual(make_shopify_log.call_args.kwargs.get("message"),
+			"Failed to sync Shopify product '2': Invalid product")
+		cache.return_value.sadd.assert_called_once_with(
+			"shopify_failed_product_ids|Test Shopify", "2")
+
+
+@patch("shopify_integration.products.getdate", return_value=TIMESTAMP.date())
+@patch("shopify_integration.products.now_datetime", return_value=TIMESTAMP)
+@patch("shopify_integration.products.frappe.session", create=True,
+	new=frappe._dict(user="Administrator"))
+@patch("shopify_integration.products.frappe.db", create=True)
+class TestItemPrices(unittest.TestCase):
+	def test_update_item_prices(self, db, now_datetime, getdate):
+		update_item_prices({"price-tee": 25.0, "price-tote": 12.5})
+
+		query, values = db.sql.call_args.args
+		self.assertIn("CASE name when %s then %s when %s then %s END", query)
+		self.assertIn("WHERE name IN (%s, %s)", query)
+		self.assertEqual(values, ["price-tee", 25.0, "price-tote", 12.5, TIMESTAMP,
+			"Administrator", "price-tee", "price-tote"])
+
+	@patch("shopify_integration.products.frappe.generate_hash", create=True,
+		return_value="price-mug")
+	@patch("shopify_integration.products.frappe.get_cached_value", create=True,
+		return_value=frappe._dict(currency="USD", buying=0, selling=1))
+	@patch("shopify_integration.products.frappe.get_all", create=True,
+		side_effect=get_all)
+	@patch("shopify_integration.products.frappe.local_cache", create=True)
+	def test_write_item_prices(self, local_cache, get_all, get_cached_value,
+		generate_hash, db, now_datetime, getdate):
+		item_prices = [("TEE-S", 22.0), ("TOTE", 15.0), ("MUG", 9.0), ("GONE", 1.0),
+			("TEE-S", 25.0)]
+		local_cache.return_value = item_prices
+
+		write_item_prices(frappe._dict(name="Test Shopify", price_list="Shopify"))
+		self.assertEqual(item_prices, [])
+
+		# only the latest price in the item's stock UOM is updated, with the
+		# last queued rate, and unchanged prices are skipped
+		query, values = db.sql.call_args.args
+		self.assertIn("UPDATE `tabItem Price`", query)
+		self.assertEqual(values, ["price-tee", 25.0, TIMESTAMP, "Administrator",
+			"price-tee"])
+
+		# prices are only inserted for existing items
+		doctype, fields, values = db.bulk_insert.call_args.args
+		self.assertEqual(doctype, "Item Price")
+		self.assertEqual(len(values), 1)
+
+		mug_price = dict(zip(fields, values[0]))
+		self.assertEqual(mug_price.get("name"), "price-mug")
+		self.assertEqual(mug_price.get("item_code"), "MUG")
+		self.assertEqual(mug_price.get("uom"), "Nos")
+		self.assertEqual(mug_price.get("currency"), "USD")
+		self.assertEqual(mug_price.get("selling"), 1)
+		self.assertEqual(mug_price.get("price_list_rate"), 9.0)
+		self.assertEqual(mug_price.get("valid_from"), TIMESTAMP.date())
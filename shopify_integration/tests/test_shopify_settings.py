@@ -28,7 +28,7 @@ from shopify_integration.customers import create_customer
 from shopify_integration.fulfilments import create_shopify_delivery
 from shopify_integration.invoices import create_shopify_invoice
 from shopify_integration.orders import create_sales_order
-from shopify_integration.products import make_item
+from shopify_integration.products import disable_product_items, make_item
 from shopify_integration.setup import setup_custom_fields
 from shopify_integration.utils import get_shopify_document
 
@@ -130,6 +130,35 @@ class ShopifySettings(FrappeTestCase):
 		)
 		self.assertEqual(len(delivery_note.items), len(order.fulfillments))
 
+	def test_product_resync_after_delete(self):
+		shopify_settings = frappe.get_doc("Shopify Settings", "Test Shopify")
+		item = get_shopify_product()
+		make_item(shopify_settings, item)
+
+		item_filters = {"shopify_product_id": cstr(item.id)}
+		self.assertTrue(frappe.db.exists("Item", item_filters))
+
+		# deleting the product on Shopify disables its items
+		disable_product_items(item.id)
+		self.assertFalse(
+			frappe.db.exists("Item", {**item_filters, "disabled_on_shopify": False})
+		)
+
+		# syncing the unchanged product again re-enables them
+		make_item(shopify_settings, get_shopify_product(), update=True)
+		self.assertFalse(
+			frappe.db.exists("Item", {**item_filters, "disabled_on_shopify": True})
+		)
+
+
+def get_shopify_product():
+	with open(
+		os.path.join(os.path.dirname(__file__), "test_data", "shopify_item.json")
+	) as shopify_item:
+		item = Product()
+		item.attributes.update(prepare_product_format(json.load(shopify_item)))
+		return item
+
 
 def prepare_customer_format(customer_data):
 	# simulate the Shopify customer object with proper class instances
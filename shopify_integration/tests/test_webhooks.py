@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Parsimony LLC and Contributors
+# See license.txt
+
+import json
+import unittest
+from collections import defaultdict
+from unittest.mock import patch
+
+from shopify_integration.utils import RELEASE_LOCK_SCRIPT
+from shopify_integration.webhooks import (
+	COALESCED_ORDER_METHOD,
+	ORDER_EVENTS_KEY,
+	ORDER_EVENTS_PER_JOB,
+	ORDER_LOCK_KEY,
+	process_order_events,
+)
+
+SHOP_NAME = "Test Shopify"
+ORDER_ID = "450789469"
+EVENTS_KEY = f"test|{ORDER_EVENTS_KEY.format(SHOP_NAME, ORDER_ID)}"
+LOCK_KEY = f"test|{ORDER_LOCK_KEY.format(SHOP_NAME, ORDER_ID)}"
+
+
+class OrderEventCache:
+	"An in-memory stand-in for the few Redis commands used by order event queues"
+
+	def __init__(self):
+		self.values = {}
+		self.lists = defaultdict(list)
+
+	def make_key(self, key):
+		return f"test|{key}"
+
+	def set(self, key, value, nx=False, ex=None):
+		if nx and key in self.values:
+			return None
+		self.values[key] = value
+		return True
+
+	def eval(self, script, numkeys, key, token, *args):
+		if self.values.get(key) != token:
+			return 0
+		if script == RELEASE_LOCK_SCRIPT:
+			del self.values[key]
+		return 1
+
+	def lindex(self, key, index):
+		values = self.lists[key]
+		return values[index] if index < len(values) else None
+
+	def execute_command(self, command, key):
+		if command != "LPOP":
+			raise NotImplementedError(command)
+		return self.lists[key].pop(0) if self.lists[key] else None
+
+
+def make_event(
+	log_id: str, method: str = "shopify_integration.orders.update_shopify_order"
+):
+	return json.dumps({"method": method, "log_id": log_id})
+
+
+@patch("shopify_integration.webhooks.frappe.generate_hash", create=True,
+	return_value="token")
+@patch("shopify_integration.webhooks.enqueue_order_events_job")
+@patch("shopify_integration.webhooks.run_order_event")
+@patch("shopify_integration.webhooks.frappe.cache", create=True)
+class TestOrderEvents(unittest.TestCase):
+	def test_locked_order_is_left_to_lock_holder(self, cache, run_order_event,
+		enqueue_order_events_job, generate_hash):
+		cache.return_value = test_cache = OrderEventCache()
+		test_cache.values[LOCK_KEY] = "other-token"
+		test_cache.lists[EVENTS_KEY] = [make_event("log-1")]
+
+		process_order_events(SHOP_NAME, ORDER_ID)
+
+		# the worker holding the lock processes the event instead
+		run_order_event.assert_not_called()
+		enqueue_order_events_job.assert_not_called()
+		self.assertEqual(test_cache.lists[EVENTS_KEY], [make_event("log-1")])
+		self.assertEqual(test_cache.values[LOCK_KEY], "other-token")
+
+	def test_events_are_processed_in_order(self, cache, run_order_event,
+		enqueue_order_events_job, generate_hash):
+		cache.return_value = test_cache = OrderEventCache()
+		test_cache.lists[EVENTS_KEY] = [make_event("log-1"), make_event("log-2")]
+
+		process_order_events(SHOP_NAME, ORDER_ID)
+
+		self.assertEqual(
+			[call.args[2].get("log_id") for call in run_order_event.call_args_list],
+			["log-1", "log-2"],
+		)
+		self.assertEqual(test_cache.lists[EVENTS_KEY], [])
+		self.assertNotIn(LOCK_KEY, test_cache.values)
+		enqueue_order_events_job.assert_not_called()
+
+	@patch("shopify_integration.webhooks.frappe.db", create=True)
+	def test_consecutive_events_are_coalesced(self, db, cache, run_order_event,
+		enqueue_order_events_job, generate_hash):
+		cache.return_value = test_cache = OrderEventCache()
+		test_cache.lists[EVENTS_KEY] = [
+			make_event("log-create", COALESCED_ORDER_METHOD),
+			make_event("log-paid", COALESCED_ORDER_METHOD),
+			make_event("log-edit"),
+			make_event("log-fulfilled", COALESCED_ORDER_METHOD),
+		]
+
+		process_order_events(SHOP_NAME, ORDER_ID)
+
+		# only events followed by another coalesced event are skipped, so
+		# events for other methods still run in the order they arrived
+		self.assertEqual(
+			[call.args[2].get("log_id") for call in run_order_event.call_args_list],
+			["log-paid", "log-edit", "log-fulfilled"],
+		)
+		db.set_value.assert_called_once()
+		self.assertEqual(db.set_value.call_args.args[1], "log-create")
+		self.assertEqual(db.set_value.call_args.args[2].get("status"), "Skipped")
+		self.assertEqual(test_cache.lists[EVENTS_KEY], [])
+
+	def test_remaining_events_are_handed_to_new_job(self, cache, run_order_event,
+		enqueue_order_events_job, generate_hash):
+		cache.return_value = test_cache = OrderEventCache()
+		test_cache.lists[EVENTS_KEY] = [
+			make_event(f"log-{index}") for index in range(ORDER_EVENTS_PER_JOB + 1)
+		]
+
+		process_order_events(SHOP_NAME, ORDER_ID)
+
+		# the job stops after its share of events, and releases the
+		# lock before queueing a new job for the remaining event
+		self.assertEqual(run_order_event.call_count, ORDER_EVENTS_PER_JOB)
+		self.assertEqual(test_cache.lists[EVENTS_KEY],
+			[make_event(f"log-{ORDER_EVENTS_PER_JOB}")])
+		self.assertNotIn(LOCK_KEY, test_cache.values)
+		enqueue_order_events_job.assert_called_once_with(SHOP_NAME, ORDER_ID)
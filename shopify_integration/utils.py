@@ -1,12 +1,37 @@
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional
+
+import pytz
+from shopify.utils.shop_url import sanitize_shop_domain
 
 import frappe
 from frappe import _
-from frappe.utils import cstr
+from frappe.utils import cstr, get_datetime, get_time_zone
 
 if TYPE_CHECKING:
 	from shopify import Order
 
+	from shopify_integration.shopify_integration.doctype.shopify_settings.shopify_settings import (
+		ShopifySettings,
+	)
+
+# the maximum number of records Shopify's REST API returns per request,
+# which is also the maximum number of IDs accepted by the `ids` filter
+SHOPIFY_PAGE_LIMIT = 250
+
+SHOP_DOMAIN_INDEX_KEY = "shopify_shop_domain_index"
+
+# the sales documents created for Shopify orders
+SHOPIFY_ORDER_DOCTYPES = ("Sales Order", "Sales Invoice", "Delivery Note")
+
+# only release a Redis lock if it is still held with the same token, since an
+# expired lock may have been acquired by another worker
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+	return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 
 def get_accounting_entry(
 	account,
@@ -52,6 +77,25 @@ def get_debit_or_credit(amount, account):
 		return debit_field if amount < 0 else credit_field
 
 
+def get_shopify_settings(shop_name: str) -> "ShopifySettings":
+	"""
+	Get a store's Shopify configuration from the document cache, so that it is
+	only loaded once per request or job. The cached document is cleared
+	whenever the configuration is saved.
+
+	The returned document is shared, and must not be modified; use
+	`frappe.get_doc` to make changes instead.
+
+	Args:
+		shop_name (str): The name of the Shopify configuration for the store.
+
+	Returns:
+		ShopifySettings: The cached Shopify configuration.
+	"""
+
+	return frappe.get_cached_doc("Shopify Settings", shop_name)
+
+
 def get_tax_account_head(shop_name: str, tax_type: str):
 	tax_map = {
 		"payout": "cash_bank_account",
@@ -67,7 +111,7 @@ def get_tax_account_head(shop_name: str, tax_type: str):
 		tax_type_label = frappe.unscrub(tax_type)
 		frappe.throw(_(f"Account not specified for '{tax_type_label}'"))
 
-	tax_account = frappe.db.get_value("Shopify Settings", shop_name, tax_field)
+	tax_account = get_shopify_settings(shop_name).get(tax_field)
 	if not tax_account:
 		tax_account_label = frappe.unscrub(tax_field)
 		frappe.throw(_(f"Account not specified for '{tax_account_label}'"))
@@ -79,7 +123,9 @@ def get_shopify_document(
 	shop_name: str,
 	doctype: str,
 	order: Optional["Order"] = None,
-	order_id: Optional[str] = None
+	order_id: Optional[str] = None,
+	exists_only: bool = False,
+	fields: Optional[List[str]] = None
 ):
 	"""
 	Check if a Shopify order exists, including references from other apps.
@@ -89,26 +135,41 @@ def get_shopify_document(
 		doctype (str): The doctype records to check against.
 		order (Order, optional): The Shopify order data.
 		order_id (str, optional): The Shopify order ID.
+		exists_only (bool, optional): Only return the name of the document, without
+			loading it. Defaults to False.
+		fields (list, optional): Only return these fields of the document, without
+			loading it.
 
 	Returns:
 		list(BaseDocument) | BaseDocument: The document object if a Shipstation
 			order exists for the Shopify order, otherwise an empty list. If
 			Delivery Notes need to be checked, then all found delivery documents
-			are returned.
+			are returned. If `exists_only` is set, the document's name is returned
+			instead, and if `fields` are set, a dict of the fields (and the name).
 	"""
 
+	shopify_order_id = cstr(order.id) if order else order_id
+
+	if exists_only or fields:
+		if not shopify_order_id:
+			return None
+
+		existing_docs = frappe.db.get_all(doctype,
+			filters=get_shopify_document_filters(shop_name, shopify_order_id),
+			fields=["name"] + list(fields or []),
+			limit=1)
+
+		if not existing_docs:
+			return None
+		return existing_docs[0].name if exists_only else existing_docs[0]
+
 	shopify_docs = [] if doctype == "Delivery Note" else frappe._dict()
 
-	shopify_order_id = cstr(order.id) if order else order_id
 	if not shopify_order_id:
 		return shopify_docs
 
 	existing_docs = frappe.db.get_all(doctype,
-		filters={
-			"docstatus": ["<", 2],
-			"shopify_settings": shop_name,
-			"shopify_order_id": shopify_order_id,
-		})
+		filters=get_shopify_document_filters(shop_name, shopify_order_id))
 
 	if existing_docs:
 		# multiple deliveries can be made against a single order
@@ -117,3 +178,142 @@ def get_shopify_document(
 		shopify_docs = frappe.get_doc(doctype, existing_docs[0].name)
 
 	return shopify_docs
+
+
+def get_shopify_documents(
+	shop_name: str,
+	order_ids: Iterable[str],
+	fields: Optional[Dict[str, List[str]]] = None
+) -> Dict[str, Dict]:
+	"""
+	Find the sales documents for many Shopify orders at once, with one query
+	for each doctype, instead of checking every order separately.
+
+	Args:
+		shop_name (str): The name of the Shopify configuration for the store.
+		order_ids (iterable): The Shopify order IDs.
+		fields (dict, optional): Additional fields to return for each doctype,
+			for example `{"Sales Order": ["per_delivered"]}`.
+
+	Returns:
+		dict: A map of each doctype in `SHOPIFY_ORDER_DOCTYPES` to a map of order
+			IDs to dicts of the document's name, `shopify_order_id` and any
+			additional fields.
+	"""
+
+	fields = fields or {}
+	order_ids = list({cstr(order_id) for order_id in order_ids if order_id})
+	shopify_docs = {doctype: {} for doctype in SHOPIFY_ORDER_DOCTYPES}
+
+	if not order_ids:
+		return shopify_docs
+
+	for doctype in SHOPIFY_ORDER_DOCTYPES:
+		existing_docs = frappe.db.get_all(doctype,
+			filters=get_shopify_document_filters(shop_name, ["in", order_ids]),
+			fields=["name", "shopify_order_id"] + list(fields.get(doctype) or []),
+			order_by="modified")
+
+		# only the most recently modified document is kept for each order, even
+		# for Delivery Notes, where an order can have several
+		for doc in existing_docs:
+			shopify_docs[doctype][doc.shopify_order_id] = doc
+
+	return shopify_docs
+
+
+def get_shopify_document_filters(shop_name: str, shopify_order_id) -> Dict:
+	return {
+		"docstatus": ["<", 2],
+		"shopify_settings": shop_name,
+		"shopify_order_id": shopify_order_id,
+	}
+
+
+def get_shopify_datetime(value) -> str:
+	"""
+	Format a system datetime for Shopify's API filters, such as `updated_at_min`,
+	which expect ISO 8601 timestamps with a UTC offset.
+
+	Args:
+		value (str | datetime): The datetime, in the system's timezone.
+
+	Returns:
+		str: The ISO 8601 timestamp.
+	"""
+
+	return pytz.timezone(get_time_zone()).localize(get_datetime(value)).isoformat()
+
+
+def create_batches(values: Iterable, size: int = SHOPIFY_PAGE_LIMIT) -> Iterator[List]:
+	"""
+	Split a list of values into batches, for example to request resources from
+	Shopify using the `ids` filter.
+
+	Args:
+		values (iterable): The values to split.
+		size (int, optional): The maximum size of each batch.
+			Defaults to Shopify's page limit.
+
+	Yields:
+		list: The next batch of values.
+	"""
+
+	batch = []
+	for value in values:
+		batch.append(value)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+
+	if batch:
+		yield batch
+
+
+def get_shop_for_domain(shop_domain: str) -> Optional[str]:
+	"""
+	Find the enabled Shopify configuration for a shop domain.
+
+	Args:
+		shop_domain (str): The shop's domain or URL, for example "shop.myshopify.com".
+
+	Returns:
+		str: The name of the Shopify configuration, if any.
+	"""
+
+	shop_domain = sanitize_shop_domain(shop_domain)
+	if not shop_domain:
+		return None
+
+	return get_shop_domain_index().get(shop_domain)
+
+
+def get_shop_domain_index() -> Dict[str, str]:
+	"""
+	Get the index of normalized shop domains to enabled Shopify configurations.
+	The index is cached in Redis until any Shopify configuration is changed.
+
+	Returns:
+		dict: A map of shop domains to Shopify configuration names.
+	"""
+
+	def build_shop_domain_index():
+		shops = frappe.get_all(
+			"Shopify Settings",
+			filters={"enable_shopify": True},
+			fields=["name", "shopify_url"],
+			order_by="creation",
+		)
+
+		index = {}
+		for shop in shops:
+			shop_domain = sanitize_shop_domain(shop.shopify_url)
+			if shop_domain:
+				index.setdefault(shop_domain, shop.name)
+		return index
+
+	return frappe.cache().get_value(SHOP_DOMAIN_INDEX_KEY, build_shop_domain_index)
+
+
+def clear_shop_domain_index():
+	frappe.cache().delete_value(SHOP_DOMAIN_INDEX_KEY)
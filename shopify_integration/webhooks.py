@@ -2,20 +2,24 @@ import base64
 import hashlib
 import hmac
 import json
-from typing import TYPE_CHECKING, Dict, List, Optional
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 import frappe
 from frappe import _
-from frappe.utils import get_url
+from frappe.utils import cstr, get_url
+from frappe.utils.password import decrypt, encrypt, get_decrypted_password
+
+from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
+	make_shopify_log,
+)
+from shopify_integration.utils import RELEASE_LOCK_SCRIPT, get_shop_for_domain
 
 if TYPE_CHECKING:
-	from frappe.integrations.doctype.connected_app.connected_app import ConnectedApp
 	from shopify_integration.shopify_integration.doctype.shopify_log.shopify_log import (
 		ShopifyLog,
 	)
-	from shopify_integration.shopify_integration.doctype.shopify_settings.shopify_settings import (
-		ShopifySettings,
-	)
 
 SHOPIFY_WEBHOOK_TOPIC_MAPPER = {
 	"orders/create": "shopify_integration.orders.create_shopify_documents",
@@ -23,11 +27,73 @@ SHOPIFY_WEBHOOK_TOPIC_MAPPER = {
 	"orders/paid": "shopify_integration.invoices.prepare_sales_invoice",
 	"orders/fulfilled": "shopify_integration.fulfilments.prepare_delivery_note",
 	"orders/cancelled": "shopify_integration.orders.cancel_shopify_order",
+	"products/create": "shopify_integration.products.sync_shopify_product",
+	"products/update": "shopify_integration.products.sync_shopify_product",
+	"products/delete": "shopify_integration.products.delete_shopify_product",
 }
 
+SHOPIFY_PRODUCT_WEBHOOK_TOPICS = (
+	"products/create",
+	"products/update",
+	"products/delete",
+)
+
+# signing keys are cached in each process for a short while, and dropped in
+# all processes as soon as a store's secret may have changed
+SIGNING_KEY_TTL_SECONDS = 5 * 60
+SIGNING_KEY_VERSION_KEY = "shopify_webhook_signing_key_version"
+
+# after a secret is rotated, Shopify may still sign webhooks with the previous
+# secret for a while, so the previous secret is kept (encrypted) in Redis
+PREVIOUS_SECRET_KEY = "shopify_webhook_previous_secret|{0}"
+PREVIOUS_SECRET_TTL_SECONDS = 24 * 60 * 60
+
+# Shopify retries webhooks for up to 48 hours, with the same webhook ID
+WEBHOOK_ID_KEY = "shopify_webhook_id|{0}"
+WEBHOOK_ID_TTL_SECONDS = 48 * 60 * 60
+
+# these order events are all handled by creating any missing documents for the
+# order, so consecutive queued events are coalesced into the latest of them
+COALESCED_ORDER_TOPICS = ("orders/create", "orders/paid", "orders/fulfilled")
+COALESCED_ORDER_METHOD = "shopify_integration.orders.create_shopify_documents"
+
+# jobs for the same order are processed one at a time, in the order that their
+# webhooks were received, by whichever worker holds the order's lock; jobs for
+# different orders still run in parallel; an event is only removed from the
+# queue once it has run, so an event from a killed job is retried by the next
+# job for the order
+ORDER_EVENTS_KEY = "shopify_order_events|{0}|{1}"
+ORDER_EVENTS_TTL_SECONDS = 24 * 60 * 60
+ORDER_EVENT_TIMEOUT_SECONDS = 5 * 60
+ORDER_EVENTS_PER_JOB = 10
+ORDER_EVENTS_JOB_TIMEOUT = ORDER_EVENTS_PER_JOB * ORDER_EVENT_TIMEOUT_SECONDS
+# the lock is extended before each event, and must outlast a single event
+ORDER_LOCK_KEY = "shopify_order_lock|{0}|{1}"
+ORDER_LOCK_TTL_SECONDS = 2 * ORDER_EVENT_TIMEOUT_SECONDS
+
+# only extend a lock if it is still held with the same token, since an expired
+# lock may have been acquired by another worker
+EXTEND_ORDER_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+	return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_signing_keys: Dict[str, Tuple[Optional[str], float, List[bytes]]] = {}
+_signing_keys_lock = threading.Lock()
+
 
 @frappe.whitelist(allow_guest=True)
 def store_request_data():
+	"""
+	Acknowledge a Shopify webhook as quickly as possible, since Shopify retries
+	webhooks that aren't acknowledged within a few seconds.
+
+	Only the request's HMAC is verified here; the raw request body is queued
+	as-is, and is parsed and logged by a background job instead.
+	"""
+
 	if not frappe.request:
 		return
 
@@ -39,76 +105,447 @@ def store_request_data():
 	if not shop_name:
 		return
 
-	shop: "ShopifySettings" = frappe.get_doc("Shopify Settings", shop_name)
 	validate_webhooks_request(
-		shop=shop,
+		shop_name=shop_name,
 		hmac_key="X-Shopify-Hmac-SHA256",
 	)
 
-	data: Dict = json.loads(frappe.request.data)
+	# acknowledge retried deliveries without processing them again
+	webhook_id = frappe.request.headers.get("X-Shopify-Webhook-Id")
+	if webhook_id and not mark_webhook_received(webhook_id):
+		return
+
+	try:
+		frappe.enqueue(
+			method="shopify_integration.webhooks.process_webhook_request",
+			queue="short",
+			timeout=300,
+			is_async=True,
+			**{
+				"shop_name": shop_name,
+				"event": event,
+				"request_data": frappe.request.data,
+			},
+		)
+	except Exception:
+		# let Shopify retry the webhook
+		if webhook_id:
+			unmark_webhook_received(webhook_id)
+		raise
+
+
+def mark_webhook_received(webhook_id: str) -> bool:
+	"""
+	Mark a webhook delivery as received.
+
+	:param webhook_id: The webhook's `X-Shopify-Webhook-Id` header
+	:return: True if the webhook was not received before, otherwise False
+	"""
+
+	cache = frappe.cache()
+	return bool(
+		cache.set(
+			cache.make_key(WEBHOOK_ID_KEY.format(webhook_id)),
+			1,
+			nx=True,
+			ex=WEBHOOK_ID_TTL_SECONDS,
+		)
+	)
+
+
+def unmark_webhook_received(webhook_id: str):
+	cache = frappe.cache()
+	cache.delete(cache.make_key(WEBHOOK_ID_KEY.format(webhook_id)))
+
+
+def process_webhook_request(shop_name: str, event: str, request_data: bytes):
+	"""
+	Background consumer for webhooks acknowledged by `store_request_data`,
+	to log the webhook and dispatch it to its handler.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param event: The webhook topic
+	:param request_data: The raw webhook request body
+	"""
+
+	data: Dict = json.loads(request_data)
 	enqueue_webhook_event(shop_name, data, event)
 
 
-def validate_webhooks_request(shop: "ShopifySettings", hmac_key: str):
+def validate_webhooks_request(shop_name: str, hmac_key: str):
 	if frappe.flags.in_test:
 		return
 
-	key = None
-	if shop.app_type == "Custom":
-		key = shop.shared_secret.encode("utf8")
-	elif shop.app_type in ("Custom (OAuth)", "Public"):
-		connected_app: "ConnectedApp" = frappe.get_doc(
-			"Connected App", shop.connected_app
+	signing_keys = get_webhook_signing_keys(shop_name)
+	if not signing_keys:
+		frappe.throw(_("Missing secret to validate webhook request"))
+
+	request_hmac = cstr(frappe.get_request_header(hmac_key)).encode("utf-8")
+
+	# try the current secret first, and then the previous secret, if any
+	for key in signing_keys:
+		digest = hmac.new(
+			key=key,
+			msg=frappe.request.data,
+			digestmod=hashlib.sha256,
+		).digest()
+
+		if hmac.compare_digest(base64.b64encode(digest), request_hmac):
+			return
+
+	frappe.throw(_("Unverified Shopify Webhook data"))
+
+
+def get_webhook_signing_keys(shop_name: str) -> List[bytes]:
+	"""
+	Get the secrets that a store's webhooks may be signed with, from the
+	current process' cache if possible.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:return: The current secret and, if it was rotated recently, the previous secret
+	"""
+
+	version = frappe.cache().get_value(SIGNING_KEY_VERSION_KEY, expires=True)
+	now = time.monotonic()
+
+	with _signing_keys_lock:
+		cached_keys = _signing_keys.get(shop_name)
+
+	if cached_keys:
+		cached_version, expires_at, signing_keys = cached_keys
+		if cached_version == version and expires_at > now:
+			return signing_keys
+
+	signing_keys = [
+		secret
+		for secret in (
+			get_webhook_secret(shop_name),
+			get_previous_webhook_secret(shop_name),
 		)
-		key = connected_app.get_password("client_secret").encode("utf8")
+		if secret
+	]
+
+	with _signing_keys_lock:
+		_signing_keys[shop_name] = (
+			version,
+			now + SIGNING_KEY_TTL_SECONDS,
+			signing_keys,
+		)
+
+	return signing_keys
 
-	if not key:
-		frappe.throw(_("Missing secret to validate webhook request"))
 
-	digest = hmac.new(
-		key=key,
-		msg=frappe.request.data,
-		digestmod=hashlib.sha256,
-	).digest()
-	computed_hmac = base64.b64encode(digest)
+def clear_webhook_signing_keys():
+	"Invalidate the cached webhook signing keys in all processes"
 
-	hmac_key = frappe.get_request_header(hmac_key)
-	if not hmac.compare_digest(computed_hmac, hmac_key.encode("utf-8")):
-		frappe.throw(_("Unverified Shopify Webhook data"))
+	frappe.cache().set_value(SIGNING_KEY_VERSION_KEY, frappe.generate_hash(length=10))
+
+
+def store_previous_webhook_secret(shop_name: str, secret: str):
+	"""
+	Keep accepting webhooks signed with a store's previous secret for a while,
+	after the secret is changed.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param secret: The store's previous secret
+	"""
+
+	frappe.cache().set_value(
+		PREVIOUS_SECRET_KEY.format(shop_name),
+		encrypt(secret),
+		expires_in_sec=PREVIOUS_SECRET_TTL_SECONDS,
+	)
+
+
+def get_previous_webhook_secret(shop_name: str) -> Optional[bytes]:
+	secret = frappe.cache().get_value(
+		PREVIOUS_SECRET_KEY.format(shop_name), expires=True
+	)
+	return decrypt(secret).encode("utf8") if secret else None
+
+
+def get_webhook_secret(shop_name: str) -> Optional[bytes]:
+	"""
+	Get the secret that Shopify signs a store's webhooks with, without loading
+	the full Shopify Settings and Connected App documents.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:return: The webhook signing secret, if set
+	"""
+
+	shop = frappe.db.get_value(
+		"Shopify Settings",
+		shop_name,
+		["app_type", "shared_secret", "connected_app"],
+		as_dict=True,
+	)
+
+	secret = None
+	if shop.app_type == "Custom":
+		secret = shop.shared_secret
+	elif shop.app_type in ("Custom (OAuth)", "Public") and shop.connected_app:
+		secret = get_decrypted_password(
+			"Connected App", shop.connected_app, "client_secret", raise_exception=False
+		)
+
+	return secret.encode("utf8") if secret else None
 
 
 def enqueue_webhook_event(shop_name: str, data: Dict, event: str = "orders/create"):
 	frappe.set_user("Administrator")
-	log = create_shopify_log(shop_name, data, event)
 
-	# since webhooks are registered for orders only, get order from Shopify webhook data
-	if event == "orders/edited":
-		order_id = data.get("order_edit", {}).get("order_id")
-	else:
-		order_id = data.get("id")
+	# order creation, payment and fulfillment are all processed by one handler
+	method = SHOPIFY_WEBHOOK_TOPIC_MAPPER.get(event)
+	if event in COALESCED_ORDER_TOPICS:
+		method = COALESCED_ORDER_METHOD
+
+	log = create_shopify_log(shop_name, data, event, method=method)
 
-	if not order_id:
+	id_field, resource_id = get_webhook_resource_id(method, data)
+	if not resource_id:
 		log.status = "Error"
-		log.message = "Order ID not found in webhook data"
+		log.message = f"{frappe.unscrub(id_field)} not found in webhook data"
 		log.save(ignore_permissions=True)
 		return
 
+	enqueue_webhook_job(shop_name, method, id_field, resource_id, log.name)
+
+
+def enqueue_webhook_job(
+	shop_name: str, method: str, id_field: str, resource_id: str, log_id: str
+):
+	"""
+	Enqueue the handler for a webhook. Order handlers are queued behind any
+	earlier events for the same order.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param method: The handler method for the webhook topic
+	:param id_field: The handler's keyword argument for the resource ID
+	:param resource_id: The Shopify resource ID
+	:param log_id: The ID of the Shopify Log for the webhook
+	"""
+
+	if id_field == "order_id":
+		enqueue_order_event(shop_name, resource_id, method, log_id)
+		return
+
 	frappe.enqueue(
-		method=SHOPIFY_WEBHOOK_TOPIC_MAPPER.get(event),
+		method=method,
 		queue="short",
 		timeout=300,
 		is_async=True,
-		**{"shop_name": shop_name, "order_id": order_id, "log_id": log.name},
+		**{"shop_name": shop_name, id_field: resource_id, "log_id": log_id},
+	)
+
+
+def enqueue_order_event(shop_name: str, order_id: str, method: str, log_id: str):
+	"""
+	Add an event to a Shopify order's queue, and start a job to process the
+	queue. If another job is already processing the order, that job picks up
+	the event instead.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param order_id: The Shopify order ID
+	:param method: The handler method for the event
+	:param log_id: The ID of the Shopify Log for the event
+	"""
+
+	cache = frappe.cache()
+	key = cache.make_key(ORDER_EVENTS_KEY.format(shop_name, order_id))
+
+	pipeline = cache.pipeline()
+	pipeline.rpush(key, json.dumps({"method": method, "log_id": log_id}))
+	pipeline.expire(key, ORDER_EVENTS_TTL_SECONDS)
+	pipeline.execute()
+
+	enqueue_order_events_job(shop_name, order_id)
+
+
+def enqueue_order_events_job(shop_name: str, order_id: str):
+	frappe.enqueue(
+		method="shopify_integration.webhooks.process_order_events",
+		queue="short",
+		timeout=ORDER_EVENTS_JOB_TIMEOUT,
+		is_async=True,
+		shop_name=shop_name,
+		order_id=order_id,
+	)
+
+
+def process_order_events(shop_name: str, order_id: str):
+	"""
+	Process the queued events for a Shopify order, one at a time, unless
+	another job is already processing them.
+
+	:param shop_name: The name of the Shopify configuration for the store
+	:param order_id: The Shopify order ID
+	"""
+
+	cache = frappe.cache()
+	events_key = cache.make_key(ORDER_EVENTS_KEY.format(shop_name, order_id))
+
+	while True:
+		token = acquire_order_lock(shop_name, order_id)
+		if not token:
+			return
+
+		try:
+			for _index in range(ORDER_EVENTS_PER_JOB):
+				# events are only appended by other processes, so the head of the
+				# queue stays the same until it is removed here
+				event = cache.lindex(events_key, 0)
+				if not event:
+					break
+
+				event = json.loads(event)
+				next_event = cache.lindex(events_key, 1)
+				if is_coalesced_event(event, next_event):
+					skip_order_event(order_id, event)
+				else:
+					extend_order_lock(shop_name, order_id, token)
+					run_order_event(shop_name, order_id, event)
+
+				# the cache's own list methods prefix keys again, so the
+				# prefixed key is used with the raw command instead
+				cache.execute_command("LPOP", events_key)
+			else:
+				# hand the remaining events over to a new job, to stay within the
+				# job timeout; the lock is released first so that it can proceed
+				release_order_lock(shop_name, order_id, token)
+				token = None
+				enqueue_order_events_job(shop_name, order_id)
+				return
+		finally:
+			if token:
+				release_order_lock(shop_name, order_id, token)
+
+		# an event may have been queued after the queue was drained, but before
+		# the lock was released, in which case its own job found the lock taken
+		if not cache.lindex(events_key, 0):
+			return
+
+
+def run_order_event(shop_name: str, order_id: str, event: Dict):
+	frappe.flags.log_id = event.get("log_id")
+
+	try:
+		frappe.get_attr(event.get("method"))(
+			shop_name=shop_name, order_id=order_id, log_id=event.get("log_id")
+		)
+		frappe.db.commit()
+	except Exception as e:
+		# keep processing the order's later events
+		make_shopify_log(shop_name, status="Error", exception=e, rollback=True)
+	finally:
+		frappe.flags.log_id = None
+
+
+def is_coalesced_event(event: Dict, next_event: Optional[str]) -> bool:
+	"""
+	Check if an order event can be left to the event queued right after it, which
+	handles the order with the same method and newer order data.
+
+	:param event: The queued order event
+	:param next_event: The next queued event for the order, if any
+	:return: True if the event can be skipped
+	"""
+
+	if not next_event or event.get("method") != COALESCED_ORDER_METHOD:
+		return False
+
+	return json.loads(next_event).get("method") == COALESCED_ORDER_METHOD
+
+
+def skip_order_event(order_id: str, event: Dict):
+	frappe.db.set_value(
+		"Shopify Log",
+		event.get("log_id"),
+		{
+			"status": "Skipped",
+			"message": f"Processed with a later event for Shopify order '{order_id}'",
+		},
 	)
+	frappe.db.commit()
+
+
+def acquire_order_lock(shop_name: str, order_id: str) -> Optional[str]:
+	"""
+	Lock a Shopify order for processing its queued events.
 
+	:param shop_name: The name of the Shopify configuration for the store
+	:param order_id: The Shopify order ID
+	:return: The lock's token, or None if the order is already locked
+	"""
 
-def create_shopify_log(shop_name: str, data: Dict, event: str = "orders/create"):
+	cache = frappe.cache()
+	token = frappe.generate_hash(length=10)
+
+	if cache.set(
+		cache.make_key(ORDER_LOCK_KEY.format(shop_name, order_id)),
+		token,
+		nx=True,
+		ex=ORDER_LOCK_TTL_SECONDS,
+	):
+		return token
+
+
+def extend_order_lock(shop_name: str, order_id: str, token: str):
+	cache = frappe.cache()
+	cache.eval(
+		EXTEND_ORDER_LOCK_SCRIPT,
+		1,
+		cache.make_key(ORDER_LOCK_KEY.format(shop_name, order_id)),
+		token,
+		ORDER_LOCK_TTL_SECONDS,
+	)
+
+
+def release_order_lock(shop_name: str, order_id: str, token: str):
+	cache = frappe.cache()
+	cache.eval(
+		RELEASE_LOCK_SCRIPT,
+		1,
+		cache.make_key(ORDER_LOCK_KEY.format(shop_name, order_id)),
+		token,
+	)
+
+
+def get_webhook_resource_id(method: str, data: Dict) -> Tuple[str, Optional[str]]:
+	"""
+	Get the Shopify resource that a webhook handler should process.
+
+	:param method: The handler method for the webhook topic
+	:param data: The webhook data
+	:return: The handler's keyword argument for the resource ID, and the ID itself
+	"""
+
+	product_methods = {
+		SHOPIFY_WEBHOOK_TOPIC_MAPPER.get(topic)
+		for topic in SHOPIFY_PRODUCT_WEBHOOK_TOPICS
+	}
+
+	if method in product_methods:
+		return "product_id", data.get("id")
+
+	# order edits are sent as a separate resource, which references the order
+	if data.get("order_edit"):
+		return "order_id", data.get("order_edit", {}).get("order_id")
+
+	return "order_id", data.get("id")
+
+
+def create_shopify_log(
+	shop_name: str,
+	data: Dict,
+	event: str = "orders/create",
+	method: Optional[str] = None,
+):
 	log: "ShopifyLog" = frappe.get_doc(
 		{
 			"doctype": "Shopify Log",
 			"shop": shop_name,
 			"request_data": json.dumps(data, indent=1),
-			"method": SHOPIFY_WEBHOOK_TOPIC_MAPPER.get(event),
+			"method": method or SHOPIFY_WEBHOOK_TOPIC_MAPPER.get(event),
 		}
 	).insert(ignore_permissions=True)
 	frappe.db.commit()
@@ -116,18 +553,8 @@ def create_shopify_log(shop_name: str, data: Dict, event: str = "orders/create")
 
 
 def get_shop_for_webhook() -> Optional[str]:
-	active_shops: List["ShopifySettings"] = frappe.get_all(
-		"Shopify Settings",
-		filters={"enable_shopify": True},
-		fields=["name", "shopify_url"],
-	)
-
 	shop_domain: str = frappe.request.headers.get("X-Shopify-Shop-Domain")
-	for active_shop in active_shops:
-		# sometimes URLs can include HTTP schemes, so only check if
-		# the domain is in the Shopify URL
-		if shop_domain in active_shop.shopify_url:
-			return active_shop.name
+	return get_shop_for_domain(shop_domain)
 
 
 def get_webhook_url():